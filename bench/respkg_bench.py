@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+# benchmarks of the hot paths of respkg, building, reading, downloading, installing, recording and verifying packages of
+# generated trees.  Each operation is run in a forked child process, so it's peak RSS is it's own.  The trees are generated
+# from fixed seeds, and the packages are built reproducibly, so every run works on the same bytes.
+#
+#   bench/respkg_bench.py --save before.json
+#   ... make changes ...
+#   bench/respkg_bench.py --baseline before.json
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import optparse
+import resource
+import platform
+import threading
+import multiprocessing
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )  # bench the respkg this is part of, not the installed one
+
+from respkg import manager  # noqa
+from respkg import RespkgBuilder, RespkgReader, RespkgManager, RespkgVerifier, RespkgInstaller  # noqa
+from respkg.verifier import hashFile  # noqa
+
+WORK_DIR = '/tmp/respkg_bench'
+REPO_COMPONENT = 'bench'
+SOURCE_DATE_EPOCH = 1500000000
+CHUNK_SIZE = 1024 * 1024
+TEXT_TABLE = bytes( [ b'abcdefghijklmnopqrstuvwxyz \n{}=;'[ i % 32 ] for i in range( 256 ) ] )  # 5 bits per byte, about as compressible as text/code
+
+# name: ( description, function( rnd, scale ) that yields ( relative path, size ) )
+TREE_MAP = {}
+OPERATION_LIST = ( 'build', 'read', 'download', 'install', 'reinstall', 'record', 'verify', 'verify-full' )  # in the order they are run
+NEEDS_MAP = { 'read': 'build', 'download': 'build', 'install': 'build', 'reinstall': 'install', 'record': 'install', 'verify': 'install', 'verify-full': 'install' }
+
+
+def _smallFiles( rnd, scale ):
+  for i in range( max( 1, int( 5000 * scale ) ) ):
+    yield ( 'dir{0:03d}/file{1:05d}.txt'.format( i % 100, i ), rnd.randint( 256, 4096 ) )
+
+
+def _hugeFiles( rnd, scale ):
+  for i in range( 4 ):
+    yield ( 'huge{0}.bin'.format( i ), max( CHUNK_SIZE, int( 32 * CHUNK_SIZE * scale ) ) )
+
+
+def _deepTree( rnd, scale ):
+  for chain in range( max( 1, int( 40 * scale ) ) ):
+    path = 'chain{0:02d}'.format( chain )
+    for depth in range( 25 ):
+      path = os.path.join( path, 'level{0:02d}'.format( depth ) )
+      yield ( os.path.join( path, 'file.txt' ), rnd.randint( 128, 8192 ) )
+
+
+TREE_MAP[ 'small' ] = ( 'many small files', _smallFiles )
+TREE_MAP[ 'huge' ] = ( 'few huge files', _hugeFiles )
+TREE_MAP[ 'deep' ] = ( 'deep directory tree', _deepTree )
+
+
+def _content( rnd, size ):  # half text like, half random, so compression has something to do without being the whole cost
+  result = []
+  while size > 0:
+    length = min( size, CHUNK_SIZE )
+    buff = rnd.getrandbits( length * 8 ).to_bytes( length, 'little' )
+    half = length // 2
+    result.append( buff[ :half ].translate( TEXT_TABLE ) + buff[ half: ] )
+    size -= length
+
+  return b''.join( result )
+
+
+def _makeTree( name, data_dir, scale ):  # returns ( file count, total bytes )
+  shutil.rmtree( data_dir, ignore_errors=True )
+  rnd = random.Random( name )
+  file_count = 0
+  total = 0
+  for ( file_path, size ) in TREE_MAP[ name ][1]( rnd, scale ):
+    file_path = os.path.join( data_dir, file_path )
+    os.makedirs( os.path.dirname( file_path ), exist_ok=True )
+    with open( file_path, 'wb' ) as fp:
+      fp.write( _content( rnd, size ) )
+
+    os.utime( file_path, ( SOURCE_DATE_EPOCH, SOURCE_DATE_EPOCH ) )
+    file_count += 1
+    total += size
+
+  return ( file_count, total )
+
+
+class _Tree( object ):  # the paths of everything for one tree
+  def __init__( self, work_dir, name ):
+    self.name = name
+    self.dir = os.path.join( work_dir, name )
+    self.data = os.path.join( self.dir, 'data' )
+    self.package = os.path.join( work_dir, 'repo', 'bench_{0}_1.0.respkg'.format( name ) )
+    self.target = os.path.join( self.dir, 'target' )
+    self.extract = os.path.join( self.dir, 'extract' )
+    self.state = os.path.join( self.dir, 'state' )
+    self.file_count = 0
+    self.size = 0
+
+
+class _Counter( object ):  # counts the statements and commits of the db connections it is attached to
+  def __init__( self ):
+    self.statements = 0
+    self.commits = 0
+
+  def __call__( self, statement ):
+    self.statements += 1
+    if statement.startswith( 'COMMIT' ):
+      self.commits += 1
+
+
+def _manager( tree, counter, reset=False ):
+  if reset:
+    shutil.rmtree( tree.state, ignore_errors=True )
+    os.makedirs( tree.state )
+
+  manager.STATE_DB_FILE_NAME = os.path.join( tree.state, 'manager.db' )
+  result = RespkgManager()
+  result.conn.set_trace_callback( counter )
+  return result
+
+
+# each operation is ( setup, run ), setup is not timed, it returns the argument for run, run returns ( bytes, files ) it processed
+
+def _setupBuild( tree, options, counter ):
+  if os.path.exists( tree.package ):
+    os.unlink( tree.package )
+
+
+def _runBuild( tree, options, counter, arg ):
+  builder = RespkgBuilder()
+  builder.data = tree.data
+  builder.name = 'bench_{0}'.format( tree.name )
+  builder.version = '1.0'
+  builder.description = TREE_MAP[ tree.name ][0]
+  builder.compression = options.compression
+  builder.jobs = options.jobs
+  builder.reproducible = True
+  builder.source_date_epoch = SOURCE_DATE_EPOCH
+  builder.setInit( '#!/bin/sh\nexit 0\n' )
+  builder.write( tree.package )
+  return ( tree.size, tree.file_count )
+
+
+def _setupRead( tree, options, counter ):
+  shutil.rmtree( tree.extract, ignore_errors=True )
+  os.makedirs( tree.extract )
+
+
+def _runRead( tree, options, counter, arg ):
+  reader = RespkgReader( tree.package )
+  try:
+    reader.getIndex()
+    reader.extract( tree.extract )
+  finally:
+    reader.close()
+
+  return ( tree.size, tree.file_count )
+
+
+def _setupDownload( tree, options, counter ):
+  result = _manager( tree, counter, True )
+  result.package_cache_size = 0  # every run downloads
+  result.addRepo( 'bench', options.repo_url, REPO_COMPONENT, None )
+  return result
+
+
+def _runDownload( tree, options, counter, arg ):
+  ( file_name, ) = arg.getPackageFiles( 'bench', [ 'bench_{0}'.format( tree.name ) ], options.jobs )
+  if file_name is None:
+    raise Exception( 'Download failed' )
+
+  size = os.path.getsize( file_name )
+  arg.releasePackageFile( file_name )
+  return ( size, 1 )
+
+
+def _setupInstall( tree, options, counter ):
+  shutil.rmtree( tree.target, ignore_errors=True )
+  os.makedirs( tree.target )
+  installer = RespkgInstaller( _manager( tree, counter, True ), tree.target, options.jobs )
+  installer.continue_cb = lambda: True
+  return installer
+
+
+def _setupReinstall( tree, options, counter ):  # over what install left, so the files are unchanged
+  installer = RespkgInstaller( _manager( tree, counter ), tree.target, options.jobs )
+  installer.continue_cb = lambda: True
+  return installer
+
+
+def _runInstall( tree, options, counter, arg ):
+  if not arg.install( [ tree.package ] ):
+    raise Exception( 'Install failed' )
+
+  return ( tree.size, tree.file_count )
+
+
+def _setupRecord( tree, options, counter ):
+  arg = _manager( tree, counter )
+  file_list = [ ( '{0}.record'.format( file_path ), sha256, size, mtime, inode ) for ( file_path, ( sha256, size, mtime, inode ) ) in arg.getFileSignatures( [ 'bench_{0}'.format( tree.name ) ] ).items() ]
+  arg.removeFileSums( 'bench_record', [ i[0] for i in file_list ] )  # from the last run
+  return ( arg, file_list )
+
+
+def _runRecord( tree, options, counter, arg ):  # one at a time, the way the per file api is used
+  ( record_manager, file_list ) = arg
+  for ( file_path, sha256, size, mtime, inode ) in file_list:
+    record_manager.setFileSum( 'bench_record', file_path, sha256, size, mtime, inode )
+
+  return ( 0, len( file_list ) )
+
+
+def _setupVerify( tree, options, counter ):
+  return _manager( tree, counter ).getFileSignatures( [ 'bench_{0}'.format( tree.name ) ] )
+
+
+def _runVerify( tree, options, counter, arg, full ):
+  result = RespkgVerifier( options.jobs ).verify( arg, full=full )
+  if result[ 'bad' ] or result[ 'missing' ] or result[ 'error' ]:
+    raise Exception( 'Verify failed' )
+
+  return ( tree.size if full else 0, len( arg ) )
+
+
+OPERATION_MAP = {
+                  'build': ( _setupBuild, _runBuild ),
+                  'read': ( _setupRead, _runRead ),
+                  'download': ( _setupDownload, _runDownload ),
+                  'install': ( _setupInstall, _runInstall ),
+                  'reinstall': ( _setupReinstall, _runInstall ),
+                  'record': ( _setupRecord, _runRecord ),
+                  'verify': ( _setupVerify, partial( _runVerify, full=False ) ),
+                  'verify-full': ( _setupVerify, partial( _runVerify, full=True ) )
+                }
+
+
+def _runChild( tree, operation, options, queue ):
+  try:
+    sys.stdout = open( os.devnull, 'w' )  # respkg prints progress, that is not what is being measured
+    counter = _Counter()
+    ( setup, run ) = OPERATION_MAP[ operation ]
+    arg = setup( tree, options, counter )
+    counter.__init__()
+
+    start = time.perf_counter()
+    ( size, file_count ) = run( tree, options, counter, arg )
+    seconds = time.perf_counter() - start
+
+    peak_rss = max( resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss, resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss )  # KiB on linux
+    queue.put( { 'seconds': seconds, 'bytes': size, 'files': file_count, 'peak_rss_kib': peak_rss, 'commits': counter.commits, 'statements': counter.statements } )
+
+  except Exception as e:
+    queue.put( { 'error': '{0}: {1}'.format( type( e ).__name__, e ) } )
+
+
+def _runOperation( tree, operation, options ):  # returns the result of the fastest of options.repeat runs
+  context = multiprocessing.get_context( 'fork' )
+  best = None
+  for _ in range( options.repeat ):
+    queue = context.Queue()
+    child = context.Process( target=_runChild, args=( tree, operation, options, queue ) )
+    child.start()
+    result = queue.get()
+    child.join()
+    if 'error' in result:
+      return result
+
+    if best is None or result[ 'seconds' ] < best[ 'seconds' ]:
+      best = result
+
+  return best
+
+
+class _RepoHandler( SimpleHTTPRequestHandler ):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message( self, *args ):
+    pass
+
+
+def _startRepo( repo_dir, tree_list ):  # serve the packages as a repo on a local port, returns the url
+  manifest = {}
+  for tree in tree_list:
+    manifest[ 'bench_{0}'.format( tree.name ) ] = [ { 'type': 'respkg', 'version': '1.0', 'path': os.path.basename( tree.package ), 'sha256': hashFile( tree.package ) } ]
+
+  os.makedirs( os.path.join( repo_dir, '_repo_{0}'.format( REPO_COMPONENT ) ), exist_ok=True )
+  with open( os.path.join( repo_dir, '_repo_{0}'.format( REPO_COMPONENT ), 'MANIFEST_all.json' ), 'w' ) as fp:
+    json.dump( manifest, fp )
+
+  server = ThreadingHTTPServer( ( '127.0.0.1', 0 ), partial( _RepoHandler, directory=repo_dir ) )
+  server.daemon_threads = True
+  threading.Thread( target=server.serve_forever, daemon=True ).start()
+  return 'http://127.0.0.1:{0}/'.format( server.server_address[1] )
+
+
+def _format( result ):
+  if 'error' in result:
+    return 'ERROR {0}'.format( result[ 'error' ] )
+
+  seconds = max( result[ 'seconds' ], 1e-9 )
+  return '{0:9.3f}s {1:9.1f} MiB/s {2:10.0f} files/s {3:8.1f} MiB RSS {4:6d} commits {5:8d} statements'.format( result[ 'seconds' ], result[ 'bytes' ] / seconds / 1048576, result[ 'files' ] / seconds,
+                                                                                                                result[ 'peak_rss_kib' ] / 1024, result[ 'commits' ], result[ 'statements' ] )
+
+
+def _compare( result, baseline, threshold ):  # returns ( text, regressed )
+  if 'error' in result or baseline is None or 'error' in baseline:
+    return ( '', False )
+
+  regressed = []
+  part_list = []
+  for ( key, label ) in ( ( 'seconds', 'time' ), ( 'peak_rss_kib', 'rss' ), ( 'commits', 'commits' ) ):
+    if not baseline[ key ]:
+      if result[ key ]:
+        regressed.append( label )
+
+      continue
+
+    change = ( result[ key ] - baseline[ key ] ) / baseline[ key ]
+    part_list.append( '{0} {1:+.0%}'.format( label, change ) )
+    if change > threshold:
+      regressed.append( label )
+
+  text = ', '.join( part_list )
+  if regressed:
+    text += '  REGRESSED ({0})'.format( ', '.join( regressed ) )
+
+  return ( text, bool( regressed ) )
+
+
+def main():
+  oparser = optparse.OptionParser( description='respkg benchmarks' )
+  oparser.add_option( '--work-dir', help='Directory to generate the trees, packages and state in (default: {0})'.format( WORK_DIR ), dest='work_dir', default=WORK_DIR )
+  oparser.add_option( '--trees', help='Comma seperated trees to bench (default: {0})'.format( ','.join( sorted( TREE_MAP ) ) ), dest='trees', default=','.join( sorted( TREE_MAP ) ) )
+  oparser.add_option( '--operations', help='Comma seperated operations to bench (default: {0})'.format( ','.join( OPERATION_LIST ) ), dest='operations', default=','.join( OPERATION_LIST ) )
+  oparser.add_option( '--scale', help='Multiply the size of the trees by this (default: 1.0)', dest='scale', type='float', default=1.0 )
+  oparser.add_option( '--repeat', help='Run each operation this many times, and report the fastest (default: 3)', dest='repeat', type='int', default=3 )
+  oparser.add_option( '-j', '--jobs', help='Number of parallel workers (default: number of cpus)', dest='jobs', type='int', default=None )
+  oparser.add_option( '-z', '--compression', help='Compression for the packages (default: gzip)', dest='compression', default='gzip' )
+  oparser.add_option( '--save', help='Save the results as JSON to this file', dest='save', metavar='FILENAME' )
+  oparser.add_option( '--baseline', help='Compare to the results saved with --save, exit 1 if anything regressed', dest='baseline', metavar='FILENAME' )
+  oparser.add_option( '--threshold', help='Percent worse than the baseline that is a regression (default: 10)', dest='threshold', type='float', default=10.0 )
+  oparser.add_option( '--keep', help='Leave the work dir when done', dest='keep', action='store_true', default=False )
+  ( options, args ) = oparser.parse_args()
+
+  tree_name_list = [ i for i in options.trees.split( ',' ) if i ]
+  operation_list = [ i for i in options.operations.split( ',' ) if i ]
+  for name in tree_name_list:
+    if name not in TREE_MAP:
+      oparser.error( 'Unknown tree "{0}"'.format( name ) )
+
+  for operation in operation_list:
+    if operation not in OPERATION_MAP:
+      oparser.error( 'Unknown operation "{0}"'.format( operation ) )
+
+  for operation in list( operation_list ):  # and what they need, ie: everything needs the packages built
+    while operation in NEEDS_MAP:
+      operation = NEEDS_MAP[ operation ]
+      if operation not in operation_list:
+        operation_list.append( operation )
+
+  baseline = None
+  if options.baseline:
+    baseline = json.load( open( options.baseline, 'r' ) )
+
+  shutil.rmtree( options.work_dir, ignore_errors=True )
+  os.makedirs( os.path.join( options.work_dir, 'repo' ) )
+
+  tree_list = []
+  for name in tree_name_list:
+    tree = _Tree( options.work_dir, name )
+    ( tree.file_count, tree.size ) = _makeTree( name, tree.data, options.scale )
+    print( 'Generated "{0}", {1}: {2} files, {3:.1f} MiB'.format( name, TREE_MAP[ name ][0], tree.file_count, tree.size / 1048576 ) )
+    tree_list.append( tree )
+
+  options.repo_url = None
+  result_map = {}
+  regressed = False
+  for operation in [ i for i in OPERATION_LIST if i in operation_list ]:
+    if operation == 'download' and options.repo_url is None:
+      options.repo_url = _startRepo( os.path.join( options.work_dir, 'repo' ), tree_list )
+
+    for tree in tree_list:
+      key = '{0}/{1}'.format( tree.name, operation )
+      result = _runOperation( tree, operation, options )
+      result_map[ key ] = result
+      line = '{0:20s} {1}'.format( key, _format( result ) )
+      if baseline is not None:
+        ( text, key_regressed ) = _compare( result, baseline[ 'results' ].get( key ), options.threshold / 100.0 )
+        regressed |= key_regressed
+        line += '  ' + text
+
+      print( line, flush=True )
+
+  if options.save:
+    with open( options.save, 'w' ) as fp:
+      json.dump( { 'python': platform.python_version(), 'scale': options.scale, 'jobs': options.jobs, 'compression': options.compression, 'results': result_map }, fp, indent=2, sort_keys=True )
+
+  if baseline is not None and ( baseline[ 'scale' ], baseline[ 'compression' ] ) != ( options.scale, options.compression ):
+    print( 'WARNING: the baseline was run with scale {0} and compression {1}'.format( baseline[ 'scale' ], baseline[ 'compression' ] ) )
+
+  if not options.keep:
+    shutil.rmtree( options.work_dir, ignore_errors=True )
+
+  if regressed:
+    sys.exit( 1 )
+
+  sys.exit( 0 )
+
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,6 @@
 from respkg.builder import RespkgBuilder  # noqa
 from respkg.reader import RespkgReader  # noqa
 from respkg.manager import RespkgManager, __VERSION__  # noqa
+from respkg.verifier import RespkgVerifier  # noqa
+from respkg.resolver import RespkgResolver, ResolveError  # noqa
+from respkg.installer import RespkgInstaller  # noqa
@@ -1,10 +1,24 @@
 import json
 import os
+import stat
+import shutil
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from gzip import GzipFile
 from tarfile import TarFile, TarInfo
 from io import BytesIO
 
+from respkg.compression import DEFAULT_CODEC, checkCodec, openWriter, openBlockWriter
+from respkg.reader import RespkgReader
+
+DATA_SPOOL_SIZE = 64 * 1024 * 1024  # DATA larger than this is spooled to disk while building
+FILE_SPOOL_SIZE = 4 * 1024 * 1024  # same for each file as it is packed
+READ_BUFFER_SIZE = 1024 * 1024
+FORMAT_VERSIONS = ( 1, 2 )
+DEFAULT_FORMAT_VERSION = 1
+
 
 class RespkgBuilder( object ):
   def __init__( self ):
@@ -12,39 +26,267 @@ class RespkgBuilder( object ):
                      'respkg_version': '1',
                      'created': datetime.utcnow().isoformat()
                    }
+    self.reproducible = False  # the same data makes the same package, the mtime, owner and group of everything is normalized, and created is source_date_epoch
+    self.source_date_epoch = None  # seconds since the epoch, see https://reproducible-builds.org/specs/source-date-epoch/
+    self.delta_base = None  # file name of a previous version of this package, if set only what changed since then is put in the package
+    self._base_checksums = {}
+    try:
+      self.source_date_epoch = int( os.environ[ 'SOURCE_DATE_EPOCH' ] )
+      self.created = datetime.utcfromtimestamp( self.source_date_epoch )
+    except ( KeyError, ValueError ):
+      pass
+
     self.init = None
     self.data = None
+    self.tmp_dir = None
+    self.compression = DEFAULT_CODEC
+    self.compression_level = None  # None for the codec's default
+    self.jobs = None  # threads to read, hash and compress with, None for one per cpu, the package is the same no matter how many
+    self.format_version = DEFAULT_FORMAT_VERSION
 
-  def write( self, file_name ):
-    if not self.data or not os.path.isdir( self.data ):
-      raise Exception( 'Must set data before building' )
-
-    gzfile = GzipFile( file_name, 'w' )
-    tar = TarFile( fileobj=gzfile, mode='w' )
-
-    buff = BytesIO( json.dumps( self.control ).encode() )
-    info = TarInfo( name='./CONTROL' )
+  @staticmethod
+  def _addBuffer( tar, name, value ):
+    buff = BytesIO( value )
+    info = TarInfo( name=name )
     info.size = buff.getbuffer().nbytes
     tar.addfile( tarinfo=info, fileobj=buff )
 
-    if self.init is not None:
-      buff = BytesIO( self.init.encode() )
-      info = TarInfo( name='./INIT' )
-      info.size = buff.getbuffer().nbytes
-      tar.addfile( tarinfo=info, fileobj=buff )
+  def _walk( self ):  # yields ( path, arcname ) for everything in data, in the same order TarFile.add does
+    stack = [ ( self.data, '', True ) ]
+    while stack:
+      ( path, arcname, is_dir ) = stack.pop()
+      yield ( path, arcname )
+      if is_dir:
+        with os.scandir( path ) as dir_iter:  # scandir has the type from reading the directory, no need to stat for it
+          entry_list = sorted( [ ( entry.name, entry.is_dir( follow_symlinks=False ) ) for entry in dir_iter ], reverse=True )
+
+        for ( name, is_dir ) in entry_list:
+          stack.append( ( os.path.join( path, name ), '{0}/{1}'.format( arcname, name ).lstrip( '/' ), is_dir ) )
+
+  def _packFile( self, path, codec ):  # returns ( file like, sha256 ) of the contents of path compressed with codec
+    packed = tempfile.SpooledTemporaryFile( max_size=FILE_SPOOL_SIZE, dir=self.tmp_dir )
+    sha256 = hashlib.sha256()
+    compressor = openWriter( packed, codec, self.compression_level )
+    with open( path, 'rb' ) as source:
+      buff = source.read( READ_BUFFER_SIZE )
+      while buff:
+        sha256.update( buff )
+        compressor.write( buff )
+        buff = source.read( READ_BUFFER_SIZE )
+
+    compressor.close()
+    packed.seek( 0 )
+    return ( packed, sha256.hexdigest() )
+
+  def _hashFile( self, path ):  # returns ( file like, sha256 ) of path, opened at the start, for when there is nothing to compress
+    source = open( path, 'rb' )
+    sha256 = hashlib.sha256()
+    buff = source.read( READ_BUFFER_SIZE )
+    while buff:
+      sha256.update( buff )
+      buff = source.read( READ_BUFFER_SIZE )
+
+    source.seek( 0 )
+    return ( source, sha256.hexdigest() )
+
+  # yields ( info, packed ) for everything in data, in _walk order, packed is the result of _packFile (or _hashFile when codec is
+  # 'none', the file is then read from where it is as it is added, instead of being copied to a temp file first) for files, None
+  # for everything else
+  # the files are packed by a pool of threads working ahead of what has been yielded, reading, hashing and compressing all release the GIL
+  def _packAll( self, codec ):
+    jobs = self.jobs or os.cpu_count() or 1
+    scratch = TarFile( fileobj=BytesIO(), mode='w' )  # for gettarinfo, so the metadata and hardlink detection is the same as TarFile.add
+    pending = deque()
+    with ThreadPoolExecutor( max_workers=jobs ) as executor:
+      for ( path, arcname ) in self._walk():
+        info = scratch.gettarinfo( path, arcname )
+        if info is None:  # sockets and such, skipped the same as TarFile.add
+          continue
+
+        if self.reproducible:
+          info.mtime = self.source_date_epoch or 0
+          info.uid = 0
+          info.gid = 0
+          info.uname = 'root'
+          info.gname = 'root'
+
+        if info.isfile() and codec == 'none':
+          pending.append( ( info, executor.submit( self._hashFile, path ) ) )
+        elif info.isfile():
+          pending.append( ( info, executor.submit( self._packFile, path, codec ) ) )
+        else:
+          pending.append( ( info, None ) )
+
+        while len( pending ) > jobs * 4:
+          result = self._packResult( *pending.popleft() )
+          if result is not None:
+            yield result
+
+      while pending:
+        result = self._packResult( *pending.popleft() )
+        if result is not None:
+          yield result
+
+  def _packResult( self, info, future ):  # None for files that are the same as in delta_base
+    if future is None:
+      return ( info, None )
+
+    ( packed, sha256 ) = future.result()
+    if self._base_checksums.get( info.name ) == sha256:
+      packed.close()
+      return None
+
+    return ( info, ( packed, sha256 ) )
+
+  def _loadDeltaBase( self ):  # sets up delta_from and removed in control, and _base_checksums for what to leave out
+    base = RespkgReader( self.delta_base, self.tmp_dir )
+    try:
+      if base.name != self.name:
+        raise ValueError( 'Delta base is for package "{0}", not "{1}"'.format( base.name, self.name ) )
+
+      if base.delta_from is not None:  # it only has what changed, so what was removed since can't be worked out from it
+        raise ValueError( 'Delta base "{0}" is a delta from version "{1}", build from a full package'.format( self.delta_base, base.delta_from ) )
+
+      if not base.getChecksums():
+        raise ValueError( 'Delta base "{0}" does not have checksums, rebuild it with this version of respkg'.format( self.delta_base ) )
+
+      self._base_checksums = base.getChecksums()
+      self.control[ 'delta_from' ] = base.version
+
+    finally:
+      base.close()
+
+    removed_list = []
+    for name in sorted( self._base_checksums ):  # files in the base that are not files any more
+      try:
+        if stat.S_ISREG( os.lstat( os.path.join( self.data, name ) ).st_mode ):
+          continue
+      except FileNotFoundError:
+        pass
+
+      removed_list.append( name )
+
+    self.control[ 'removed' ] = removed_list
+
+  def _buildData( self, data ):  # compresses each file into data on it's own, returns the index
+    index = []
+    for ( info, packed ) in self._packAll( self.compression ):
+      if not info.name:  # the root of data is the target dir, that is not ours to change
+        continue
+
+      entry = { 'name': info.name, 'mode': info.mode, 'mtime': info.mtime, 'uid': info.uid, 'gid': info.gid, 'uname': info.uname, 'gname': info.gname,
+                'linkname': info.linkname, 'size': 0, 'offset': None, 'length': None, 'sha256': None }
+      if info.isfile():
+        ( source, sha256 ) = packed
+        entry[ 'type' ] = 'file'
+        entry[ 'size' ] = info.size
+        entry[ 'offset' ] = data.tell()
+        shutil.copyfileobj( source, data, READ_BUFFER_SIZE )
+        source.close()
+        entry[ 'length' ] = data.tell() - entry[ 'offset' ]
+        entry[ 'sha256' ] = sha256
 
-    data = BytesIO()
+      elif info.isdir():
+        entry[ 'type' ] = 'dir'
+      elif info.issym():
+        entry[ 'type' ] = 'symlink'
+      elif info.islnk():
+        entry[ 'type' ] = 'link'
+      elif info.isfifo():
+        entry[ 'type' ] = 'fifo'
+      else:
+        raise ValueError( '"{0}" is not a supported file type'.format( info.name ) )
+
+      index.append( entry )
+
+    return index
+
+  def _buildDataTar( self, data ):  # tars data into data, the same as TarFile.add, returns { name: sha256 } of the files
+    checksum_map = {}
     datatar = TarFile( fileobj=data, mode='w' )
-    datatar.add( self.data, '/' )
+    for ( info, packed ) in self._packAll( 'none' ):
+      if packed is None:
+        datatar.addfile( info )
+        continue
+
+      ( source, sha256 ) = packed
+      datatar.addfile( info, source )
+      source.close()
+      checksum_map[ info.name ] = sha256
+
     datatar.close()
+
+    return checksum_map
+
+  def _writeV1( self, outfile ):
+    data = tempfile.SpooledTemporaryFile( max_size=DATA_SPOOL_SIZE, dir=self.tmp_dir )  # the size of DATA is needed before it can be added, so it has to be built somewhere first
+    checksum_map = self._buildDataTar( data )
+
+    compressor = openBlockWriter( outfile, self.compression, self.compression_level, self.jobs or os.cpu_count() or 1 )
+    tar = TarFile( fileobj=compressor, mode='w' )
+
+    self._addBuffer( tar, './CONTROL', json.dumps( self.control, sort_keys=True ).encode() )
+    self._addBuffer( tar, './CHECKSUMS', json.dumps( checksum_map, separators=( ',', ':' ), sort_keys=True ).encode() )
+
+    if self.init is not None:
+      self._addBuffer( tar, './INIT', self.init.encode() )
+
+    info = TarInfo( name='./DATA' )
+    info.size = data.tell()
     data.seek( 0 )
+    tar.addfile( tarinfo=info, fileobj=data )
+    data.close()
+
+    tar.close()
+    compressor.close()
+
+  def _writeV2( self, outfile ):  # the outer tar is not compressed, so the reader can get to INDEX and the files in DATA directly
+    self.control[ 'compression' ] = self.compression
+    tar = TarFile( fileobj=outfile, mode='w' )
+
+    data = tempfile.SpooledTemporaryFile( max_size=DATA_SPOOL_SIZE, dir=self.tmp_dir )
+    index = self._buildData( data )
+
+    self._addBuffer( tar, './CONTROL', json.dumps( self.control, sort_keys=True ).encode() )
+    self._addBuffer( tar, './INDEX', json.dumps( index, separators=( ',', ':' ), sort_keys=True ).encode() )
+
+    if self.init is not None:
+      self._addBuffer( tar, './INIT', self.init.encode() )
 
     info = TarInfo( name='./DATA' )
-    info.size = data.getbuffer().nbytes
+    info.size = data.tell()
+    data.seek( 0 )
     tar.addfile( tarinfo=info, fileobj=data )
+    data.close()
 
     tar.close()
-    gzfile.close()
+
+  def write( self, file_name ):
+    if not self.data or not os.path.isdir( self.data ):
+      raise Exception( 'Must set data before building' )
+
+    if self.format_version not in FORMAT_VERSIONS:
+      raise ValueError( 'Unknown format version "{0}"'.format( self.format_version ) )
+
+    checkCodec( self.compression )
+
+    if self.reproducible:
+      self.created = datetime.utcfromtimestamp( self.source_date_epoch or 0 )
+
+    self.control[ 'respkg_version' ] = str( self.format_version )
+    self.control.pop( 'compression', None )
+    self.control.pop( 'delta_from', None )
+    self.control.pop( 'removed', None )
+    self._base_checksums = {}
+
+    if self.delta_base is not None:
+      self._loadDeltaBase()
+
+    with open( file_name, 'wb' ) as outfile:
+      if self.format_version == 1:
+        self._writeV1( outfile )
+      else:
+        self._writeV2( outfile )
 
   @property
   def name( self ):
@@ -0,0 +1,167 @@
+import zlib
+import gzip
+import lzma
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+CODEC_LIST = ( 'gzip', 'xz', 'zstd', 'none' )
+DEFAULT_CODEC = 'gzip'
+
+MAGIC_MAP = {
+              b'\x1f\x8b': 'gzip',
+              b'\xfd7zXZ\x00': 'xz',
+              b'\x28\xb5\x2f\xfd': 'zstd'
+            }
+MAGIC_SIZE = max( [ len( i ) for i in MAGIC_MAP ] )
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class _Uncompressed( object ):  # so 'none' can be treated like the others, close dosen't close the underlying file
+  def __init__( self, fileobj ):
+    self.fileobj = fileobj
+
+  def read( self, size=-1 ):
+    return self.fileobj.read( size )
+
+  def write( self, buff ):
+    return self.fileobj.write( buff )
+
+  def tell( self ):
+    return self.fileobj.tell()
+
+  def close( self ):
+    pass
+
+
+class _BlockWriter( object ):
+  # each BLOCK_SIZE of what is written is compressed on it's own, by a pool of threads, and written out in order as
+  # a complete gzip member/xz stream/zstd frame.  The readers treat the concatenated blocks as one stream.  The block
+  # boundaries do not depend on the number of threads, so neither does the output.
+  def __init__( self, fileobj, codec, level, jobs ):
+    self.fileobj = fileobj
+    self.codec = codec
+    self.level = level
+    self._buffer = bytearray()
+    self._position = 0
+    self._block_count = 0
+    self._pending = deque()
+    self._max_pending = jobs * 2  # so we are not holding more than a few blocks in memory
+    self._executor = ThreadPoolExecutor( max_workers=jobs )
+
+  def _submit( self, block ):
+    self._pending.append( self._executor.submit( compressBlock, block, self.codec, self.level ) )
+    self._block_count += 1
+    while len( self._pending ) > self._max_pending:
+      self.fileobj.write( self._pending.popleft().result() )
+
+  def write( self, buff ):
+    self._buffer += buff
+    self._position += len( buff )
+    while len( self._buffer ) >= BLOCK_SIZE:
+      self._submit( bytes( self._buffer[ :BLOCK_SIZE ] ) )
+      del self._buffer[ :BLOCK_SIZE ]
+
+    return len( buff )
+
+  def tell( self ):
+    return self._position
+
+  def close( self ):
+    if self._executor is None:
+      return
+
+    if self._buffer or not self._block_count:  # an empty stream still needs one block to be valid
+      self._submit( bytes( self._buffer ) )
+      self._buffer = bytearray()
+
+    while self._pending:
+      self.fileobj.write( self._pending.popleft().result() )
+
+    self._executor.shutdown()
+    self._executor = None
+
+
+def checkCodec( codec ):
+  if codec not in CODEC_LIST:
+    raise ValueError( 'Unknown compression "{0}", must be one of "{1}"'.format( codec, '", "'.join( CODEC_LIST ) ) )
+
+  if codec == 'zstd' and zstandard is None:
+    raise ValueError( 'zstd compression requires the zstandard python module' )
+
+
+def detectCodec( fileobj ):  # by the magic bytes at the start of the file, fileobj must be seekable
+  start = fileobj.tell()
+  header = fileobj.read( MAGIC_SIZE )
+  fileobj.seek( start )
+  for ( magic, codec ) in MAGIC_MAP.items():
+    if header.startswith( magic ):
+      return codec
+
+  return 'none'
+
+
+# returns a file like object that compresses what is written to it into fileobj
+# closing it finishes the compression, but dosen't close fileobj
+# level is codec specific, None for the codec's default, threads is only used by zstd, -1 for one per cpu
+def openWriter( fileobj, codec, level=None, threads=0 ):
+  checkCodec( codec )
+
+  if codec == 'gzip':
+    return gzip.GzipFile( fileobj=fileobj, mode='wb', compresslevel=9 if level is None else level, mtime=0 )  # no time in the header, so the same data compresses the same
+
+  if codec == 'xz':
+    return lzma.LZMAFile( fileobj, mode='wb', preset=level )
+
+  if codec == 'zstd':
+    return zstandard.ZstdCompressor( level=3 if level is None else level, threads=threads ).stream_writer( fileobj, closefd=False )
+
+  return _Uncompressed( fileobj )
+
+
+def compressBlock( block, codec, level=None ):  # returns block compressed as a complete stream, the compressors release the GIL so this can be run in threads
+  if codec == 'gzip':
+    compressor = zlib.compressobj( 9 if level is None else level, zlib.DEFLATED, 31 )  # 31 = gzip header and trailer
+    return compressor.compress( block ) + compressor.flush()
+
+  if codec == 'xz':
+    return lzma.compress( block, preset=level )
+
+  if codec == 'zstd':
+    return zstandard.ZstdCompressor( level=3 if level is None else level ).compress( block )
+
+  return block
+
+
+# like openWriter, but compresses BLOCK_SIZE blocks in parallel with jobs threads, see _BlockWriter
+def openBlockWriter( fileobj, codec, level=None, jobs=1 ):
+  checkCodec( codec )
+
+  if codec == 'none':
+    return _Uncompressed( fileobj )
+
+  return _BlockWriter( fileobj, codec, level, jobs )
+
+
+# returns a file like object that decompresses fileobj, if codec is None, it is detected
+# closing it dosen't close fileobj
+def openReader( fileobj, codec=None ):
+  if codec is None:
+    codec = detectCodec( fileobj )
+
+  checkCodec( codec )
+
+  if codec == 'gzip':
+    return gzip.GzipFile( fileobj=fileobj, mode='rb' )
+
+  if codec == 'xz':
+    return lzma.LZMAFile( fileobj, mode='rb' )
+
+  if codec == 'zstd':
+    return zstandard.ZstdDecompressor().stream_reader( fileobj, read_across_frames=True, closefd=False )  # block written packages are many frames
+
+  return _Uncompressed( fileobj )
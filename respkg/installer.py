@@ -0,0 +1,674 @@
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from respkg.reader import RespkgReader, RECORDED_TYPES
+from respkg.resolver import RespkgResolver, ResolveError
+
+INIT_FILE_PATH = '/tmp/respkg.init'
+STAGING_PREFIX = '.respkg_staging.'  # staged installs are extracted to a temp dir in the target dir, so it's on the same filesystem
+BACKUP_DIR_NAME = '.respkg_backup'  # in the target dir, what staged installs replace/remove is moved here, for rollback
+DEDUP_MODES = ( 'hardlink', 'reflink' )
+FICLONE = 0x40049409  # from linux/fs.h
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _unchangedFiles( reader, target_dir, signature_map ):  # names of the files in the package that are installed, have the same contents, and have not been touched since
+  checksum_map = reader.getChecksums()
+  result = set()
+  for entry in reader.getIndex():
+    if entry[ 'type' ] != 'file' or entry[ 'name' ] not in checksum_map:
+      continue
+
+    try:
+      ( sha256, size, mtime, inode ) = signature_map[ os.path.join( target_dir, entry[ 'name' ] ) ]
+      file_stat = os.lstat( os.path.join( target_dir, entry[ 'name' ] ) )
+    except ( KeyError, FileNotFoundError ):
+      continue
+
+    if sha256 != checksum_map[ entry[ 'name' ] ] or ( file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino ) != ( size, mtime, inode ):
+      continue
+
+    if int( file_stat.st_mtime ) != int( entry[ 'mtime' ] ) or stat.S_IMODE( file_stat.st_mode ) != stat.S_IMODE( entry[ 'mode' ] ):  # same contents, but the package has a diffrent mtime/mode for it
+      continue
+
+    result.add( entry[ 'name' ] )
+
+  return result
+
+
+def _sameAttributes( entry, file_path ):  # would extracting entry give file_path's mode, mtime and owner
+  file_stat = os.lstat( file_path )
+  if stat.S_IMODE( file_stat.st_mode ) != stat.S_IMODE( entry[ 'mode' ] ) or int( file_stat.st_mtime ) != int( entry[ 'mtime' ] ):
+    return False
+
+  if hasattr( os, 'geteuid' ) and os.geteuid() == 0:
+    return ( file_stat.st_uid, file_stat.st_gid ) == RespkgReader.entryOwner( entry )
+
+  return file_stat.st_uid == os.geteuid()
+
+
+def _clone( source, target_path ):  # reflink source to target_path where the filesystem supports it, else copy it
+  with open( source, 'rb' ) as source_file, open( target_path, 'wb' ) as target_file:
+    try:
+      fcntl.ioctl( target_file.fileno(), FICLONE, source_file.fileno() )
+      return
+    except OSError:  # not supported by the filesystem, or not the same filesystem
+      pass
+
+    shutil.copyfileobj( source_file, target_file, COPY_BUFFER_SIZE )
+
+
+def _dedupFile( entry, source, target_path, hardlink ):  # put the contents of source, which are the same as entry, at target_path
+  upper_dirs = os.path.dirname( target_path )
+  if upper_dirs:
+    os.makedirs( upper_dirs, exist_ok=True )
+
+  tmp_path = '{0}.respkg_dedup'.format( target_path )
+  if os.path.lexists( tmp_path ):
+    os.unlink( tmp_path )
+
+  linked = False
+  if hardlink and _sameAttributes( entry, source ):  # a hardlink shares the attributes, so only if they are the same
+    try:
+      os.link( source, tmp_path )
+      linked = True
+    except OSError:  # not the same filesystem, to many links, ...
+      pass
+
+  if not linked:
+    _clone( source, tmp_path )
+    RespkgReader.setAttributes( entry, tmp_path )
+
+  os.replace( tmp_path, target_path )
+
+
+# extracts the package and removes the files in removed_list, returns ( [ ( file_path, sha256, size, mtime, inode ) ], error message )
+# on error the list is of what was written before it
+# the files in dedup_map ( { name: file_path of an installed file with the same contents } ) are linked/cloned from there instead
+# data_file is the DATA of a version 1 package allready spooled by _prepare, see RespkgReader
+# this is run in the worker processes, so it can't touch the db
+def _extractPackage( file_name, target_dir, skip, removed_list, verbose, dedup_map=None, hardlink=False, data_file=None ):
+  file_sum_list = []
+
+  def _addsum( package, file_path, sha256 ):
+    file_stat = os.lstat( file_path )
+    file_sum_list.append( ( file_path, sha256, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino ) )
+
+  def _progress( package, file_path ):
+    print( 'Extracting {0}...'.format( file_path ), flush=True )
+
+  reader = None
+  try:
+    reader = RespkgReader( file_name, data_file_name=data_file )
+    if dedup_map:
+      skip = set( skip )
+      for entry in reader.getIndex():
+        if entry[ 'type' ] != 'file' or entry[ 'name' ] not in dedup_map:
+          continue
+
+        target_path = os.path.join( target_dir, entry[ 'name' ] )
+        if verbose:
+          print( 'Deduplicating {0} from {1}...'.format( target_path, dedup_map[ entry[ 'name' ] ] ), flush=True )
+
+        try:
+          _dedupFile( entry, dedup_map[ entry[ 'name' ] ], target_path, hardlink )
+        except OSError:  # the source is gone or such, it is extracted instead
+          continue
+
+        _addsum( reader.name, target_path, reader.getChecksums()[ entry[ 'name' ] ] )
+        skip.add( entry[ 'name' ] )
+
+    # the files are checked against the checksums in the package as they are extracted, so what is recorded is what the package was built with
+    reader.extract( target_dir, _addsum, _progress if verbose else None, skip )
+
+    if removed_list:
+      replaced_set = set( [ os.path.join( target_dir, entry[ 'name' ] ) for entry in reader.getIndex() ] )  # ie: a file that is now a symlink, is not unlinked after it is extracted
+      for file_path in removed_list:  # no longer part of the package
+        if file_path in replaced_set:
+          continue
+
+        if verbose:
+          print( 'Removing {0}...'.format( file_path ), flush=True )
+
+        try:
+          os.unlink( file_path )
+        except FileNotFoundError:
+          pass
+
+  except ( ValueError, OSError ) as e:  # returned as this package's error, so the rest of the step is still recorded
+    return ( file_sum_list, str( e ) )
+
+  finally:
+    if reader is not None:
+      reader.close()
+
+  return ( file_sum_list, None )
+
+
+def _move( source, target ):  # rename, for files, symlinks and such it atomicly replaces target
+  upper_dirs = os.path.dirname( target )
+  if upper_dirs:
+    os.makedirs( upper_dirs, exist_ok=True )
+
+  try:
+    os.replace( source, target )
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+
+    shutil.move( source, target )  # something mounted inside the target dir, copy, this one is not atomic
+
+
+def _planSwap( entry_list, removed_list, staging_dir, target_dir ):  # returns [ ( action, file_path ) ] to move what was extracted to staging_dir into target_dir
+  result = []
+  new_set = set()
+  for ( name, entry_type ) in entry_list:
+    file_path = os.path.join( target_dir, name )
+    new_set.add( file_path )
+    if entry_type == 'dir':
+      if os.path.isdir( file_path ):  # existing directories are left as they are, including symlinks to directories
+        continue
+
+      if os.path.lexists( file_path ):
+        result.append( ( 'replaced', file_path ) )
+
+      result.append( ( 'mkdir', file_path ) )
+      continue
+
+    if not os.path.lexists( os.path.join( staging_dir, name ) ):  # unchanged, not extracted
+      continue
+
+    if os.path.isdir( file_path ) and not os.path.islink( file_path ):
+      raise ValueError( '"{0}" is a directory'.format( file_path ) )
+
+    result.append( ( 'replaced' if os.path.lexists( file_path ) else 'added', file_path ) )
+
+  for file_path in removed_list:
+    if file_path not in new_set and os.path.lexists( file_path ):
+      result.append( ( 'removed', file_path ) )
+
+  return result
+
+
+def _swap( action_list, staging_dir, target_dir, backup_dir ):
+  dir_list = []
+  for ( action, file_path ) in action_list:
+    name = os.path.relpath( file_path, target_dir )
+    if action in ( 'replaced', 'removed' ):
+      _move( file_path, os.path.join( backup_dir, name ) )
+
+    if action == 'mkdir':
+      os.mkdir( file_path )
+      dir_list.append( ( os.path.join( staging_dir, name ), file_path ) )
+
+    elif action in ( 'replaced', 'added' ):
+      _move( os.path.join( staging_dir, name ), file_path )
+
+  for ( source, file_path ) in reversed( dir_list ):  # set after, moving the contents in changes the mtime
+    shutil.copystat( source, file_path )
+    if hasattr( os, 'geteuid' ) and os.geteuid() == 0:
+      source_stat = os.stat( source )
+      os.chown( file_path, source_stat.st_uid, source_stat.st_gid )
+
+
+def _unswap( action_list, target_dir, backup_dir ):  # undo _swap, from any point it got to
+  for ( action, file_path ) in reversed( action_list ):
+    if action == 'mkdir':
+      try:
+        os.rmdir( file_path )
+      except OSError:  # allready gone, or something else has been put in it
+        pass
+
+    elif action == 'added':
+      try:
+        os.unlink( file_path )
+      except FileNotFoundError:
+        pass
+
+    else:
+      backup = os.path.join( backup_dir, os.path.relpath( file_path, target_dir ) )
+      if os.path.lexists( backup ):
+        _move( backup, file_path )
+
+
+class RespkgInstaller( object ):
+  # installs a batch of package files into target_dir.  Everything is checked before anything is installed, the depends and
+  # conflicts of the whole batch (with RespkgResolver), and that no file is in more than one package.  The packages are installed
+  # in the steps from RespkgResolver.plan(), the packages in a step are extracted at the same time by a pool of processes, then their
+  # init scripts are run, one at a time, and the step is recorded in the db.  Only this process writes to the db.
+  # With staged set, each package is extracted to a staging dir in the target dir, then moved into place with os.replace, what
+  # it replaces is kept in BACKUP_DIR_NAME, and what was done is recorded in the db first, so it can be rolled back with
+  # rollback(), if the init fails it is rolled back right away.  The backups of the last staged install of each package are kept.
+  def __init__( self, manager, target_dir, jobs=None ):
+    self.manager = manager
+    self.target_dir = target_dir
+    self.jobs = jobs or os.cpu_count() or 1
+    self.verbose = False
+    self.overwrite_all = False  # on upgrade/re-install write every file, not just the ones that have changed
+    self.leave_init = False
+    self.staged = False
+    self.dedup = None  # one of DEDUP_MODES, files with the same contents as an installed file on the same filesystem are hardlinked/reflinked from it
+    self.remove_orphans = False  # after installing, remove the files recorded for packages that are not installed, see removeOrphans()
+    self.tmp_dir = None  # where the DATA of version 1 packages is spooled until the package is extracted, None for the system's temp dir
+    self.continue_cb = None  # called after a warning, return True to install anyway, if not set the install stops
+
+  def _continue( self ):
+    return self.continue_cb is not None and self.continue_cb()
+
+  def _prepare( self, file_name, target_dir ):  # returns a dict of what is needed to install the package, None if it should not be
+    reader = RespkgReader( file_name, self.tmp_dir, keep_data_file=True )  # the spooled DATA of version 1 packages is handed to the worker, so it is only decompressed once
+    result = None
+    try:
+      prev = self.manager.getPackage( reader.name )
+      if reader.delta_from is not None and ( not prev or prev[ 'version' ] != reader.delta_from or target_dir != prev[ 'target_dir' ] ):
+        print( 'ERROR: Package "{0}" is a delta from version "{1}", it can only be installed over that version, in the same target directory.'.format( reader.name, reader.delta_from ) )
+        return None
+
+      if prev:
+        if prev[ 'version' ] > reader.version:  # TODO: split by '.' and compare as numbers
+          print( 'WARNING: Previosully install package "{0}" has a greater version number.'.format( reader.name ) )
+          if not self._continue():
+            return None
+
+        if target_dir != prev[ 'target_dir' ]:
+          print( 'WARNING: Installing "{0}" to diffrent target directory than last time.'.format( reader.name ) )
+          print( 'Previous Install Location: "{0}"'.format( prev[ 'target_dir' ] ) )
+          print( 'Curent Install Location: "{0}"'.format( target_dir ) )
+          if not self._continue():
+            return None
+
+      else:
+        prev = { 'version': '*NEW*' }
+
+      if prev[ 'version' ] != reader.version:
+        print( 'Upgrading "{0}" from "{1}" to "{2}"'.format( reader.name, prev[ 'version' ], reader.version ) )
+      else:
+        print( 'Re-Installing "{0}" version "{1}"'.format( reader.name, reader.version ) )
+
+      unchanged_list = set()
+      removed_list = []  # files of the previous version that are not files in this one
+      if reader.delta_from is not None:  # the delta only has what changed, it says what was removed
+        removed_list = [ os.path.join( target_dir, i ) for i in reader.removed ]
+
+      elif prev[ 'version' ] != '*NEW*' and target_dir == prev[ 'target_dir' ]:
+        signature_map = self.manager.getFileSignatures( [ reader.name ] )
+        if not self.overwrite_all:
+          unchanged_list = _unchangedFiles( reader, target_dir, signature_map )
+
+        new_file_set = set( [ os.path.join( target_dir, entry[ 'name' ] ) for entry in reader.getIndex() if entry[ 'type' ] in RECORDED_TYPES ] )
+        target_prefix = os.path.join( target_dir, '' )  # rows left from installs to other target dirs are not ours to remove
+        removed_list = sorted( [ file_path for file_path in signature_map if file_path not in new_file_set and file_path.startswith( target_prefix ) ] )
+
+      dedup_map = {}
+      if self.dedup is not None:
+        dedup_map = self._dedupSources( reader, target_dir, unchanged_list )
+
+      entry_list = [ ( entry[ 'name' ], entry[ 'type' ] ) for entry in reader.getIndex() ]
+      if self.staged:  # the staged hardlinks are made to what is in the staging dir, so what they link to has to be there
+        unchanged_list -= set( [ entry[ 'linkname' ] for entry in reader.getIndex() if entry[ 'type' ] == 'link' ] )
+
+      result = { 'file_name': file_name, 'data_file': reader.data_file_name, 'name': reader.name, 'version': reader.version, 'description': reader.description, 'created': reader.created,
+                 'depends': reader.depends, 'conflicts': reader.conflicts, 'provides': reader.provides, 'init': reader.readInit(), 'prev_version': prev[ 'version' ],
+                 'file_list': [ os.path.join( target_dir, entry[ 'name' ] ) for entry in reader.getIndex() if entry[ 'type' ] in RECORDED_TYPES ], 'unchanged': unchanged_list, 'removed': removed_list,
+                 'entry_list': entry_list, 'dedup': dedup_map }
+      return result
+
+    finally:
+      reader.close()
+      if result is None and reader.data_file_name is not None:
+        os.unlink( reader.data_file_name )
+
+  @staticmethod
+  def _releaseData( package ):  # remove the spooled DATA from _prepare
+    if package[ 'data_file' ] is not None:
+      try:
+        os.unlink( package[ 'data_file' ] )
+      except FileNotFoundError:
+        pass
+
+      package[ 'data_file' ] = None
+
+  # returns { name: file_path } for the files in the package that are not in unchanged_list, of an installed file with the same
+  # contents, on the same filesystem as target_dir, that has not been changed since it was installed
+  def _dedupSources( self, reader, target_dir, unchanged_list ):
+    checksum_map = dict( [ ( name, sha256 ) for ( name, sha256 ) in reader.getChecksums().items() if name not in unchanged_list ] )
+    candidate_map = self.manager.getFilesByChecksum( checksum_map.values() )
+    target_dev = os.stat( target_dir ).st_dev
+    result = {}
+    for ( name, sha256 ) in checksum_map.items():
+      for ( file_path, size, mtime, inode ) in candidate_map.get( sha256, [] ):
+        if file_path == os.path.join( target_dir, name ):
+          continue
+
+        try:
+          file_stat = os.lstat( file_path )
+        except OSError:
+          continue
+
+        if not stat.S_ISREG( file_stat.st_mode ) or file_stat.st_dev != target_dev or ( file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino ) != ( size, mtime, inode ):
+          continue
+
+        result[ name ] = file_path
+        break
+
+    return result
+
+  def _checkOverlaps( self, package_map ):  # true -> ok to install, ie: no file is in more than one package in the batch, or allready installed by another package
+    owner_map = {}
+    duplicate_list = []
+    for name in sorted( package_map ):
+      for file_path in package_map[ name ][ 'file_list' ]:
+        if file_path in owner_map:
+          duplicate_list.append( ( file_path, owner_map[ file_path ], name ) )
+        else:
+          owner_map[ file_path ] = name
+
+    if duplicate_list:
+      print( 'ERROR: these files are in more than one of the packages being installed:' )
+      print( '\n'.join( [ '{0}\t{1}\t{2}'.format( *i ) for i in sorted( duplicate_list ) ] ) )
+      return False
+
+    overlap_map = {}
+    for ( file_path, owner ) in self.manager.getFileOwners( owner_map.keys() ).items():
+      if owner != owner_map[ file_path ]:
+        overlap_map[ file_path ] = owner
+
+    if overlap_map:
+      print( 'ERROR: these files are allready installed by another package:' )
+      print( '\n'.join( [ '{0}\t{1}'.format( file_path, overlap_map[ file_path ] ) for file_path in sorted( overlap_map ) ] ) )
+      return False
+
+    return True
+
+  def _runInit( self, package, target_dir ):
+    if package[ 'init' ] is None:
+      return True
+
+    init = open( INIT_FILE_PATH, 'w' )  # TODO: replace INIT_FILE_PATH with a tmpfile
+    init.write( package[ 'init' ] )
+    init.close()
+    os.chmod( INIT_FILE_PATH, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IRGRP | stat.S_IXGRP )
+
+    if self.verbose:
+      print( 'Running init for "{0}"...'.format( package[ 'name' ] ) )
+
+    rc = subprocess.call( [ INIT_FILE_PATH, target_dir, package[ 'version' ], package[ 'prev_version' ] ] )
+
+    if self.leave_init:
+      print( 'WARNING: leaving init, to execute run:' )
+      print()
+      print( ' '.join( [ INIT_FILE_PATH, target_dir, package[ 'version' ], package[ 'prev_version' ] ] ) )
+      print()
+
+    else:
+      os.unlink( INIT_FILE_PATH )
+
+    if rc != 0:
+      print( 'WARNING: init for "{0}" returned "{1}"'.format( package[ 'name' ], rc ) )
+      return False
+
+    return True
+
+  def _backupDir( self, target_dir, transaction_id ):
+    return os.path.join( target_dir, BACKUP_DIR_NAME, str( transaction_id ) )
+
+  def _swapIn( self, package, file_sum_list, target_dir ):  # move the staged package into target_dir, returns ( transaction id, file_sum_list for where the files are now )
+    staging_dir = package[ 'extract_dir' ]
+    try:
+      action_list = _planSwap( package[ 'entry_list' ], package[ 'removed' ], staging_dir, target_dir )
+      transaction_id = self.manager.startTransaction( package[ 'name' ], package[ 'version' ], target_dir, lambda transaction_id: self._backupDir( target_dir, transaction_id ), action_list )
+      try:
+        _swap( action_list, staging_dir, target_dir, self._backupDir( target_dir, transaction_id ) )
+      except OSError:
+        self._rollback( self.manager.getTransaction( transaction_id ) )
+        raise
+
+    finally:
+      shutil.rmtree( staging_dir, ignore_errors=True )
+
+    return ( transaction_id, [ ( os.path.join( target_dir, os.path.relpath( item[0], staging_dir ) ), ) + tuple( item[ 1: ] ) for item in file_sum_list ] )
+
+  def _rollback( self, transaction ):
+    if self.verbose:
+      print( 'Rolling back "{0}" version "{1}"...'.format( transaction[ 'package' ], transaction[ 'version' ] ) )
+
+    _unswap( transaction[ 'action_list' ], transaction[ 'target_dir' ], transaction[ 'backup_dir' ] )
+    self.manager.rollbackTransaction( transaction[ 'id' ] )
+    shutil.rmtree( transaction[ 'backup_dir' ], ignore_errors=True )
+
+  def rollback( self, name ):  # undo the last staged install of package name, returns True if it was rolled back
+    transaction = self.manager.getLastTransaction( name )
+    if transaction is None or transaction[ 'state' ] not in ( 'started', 'done' ):
+      print( 'ERROR: There is no staged install of "{0}" to roll back.'.format( name ) )
+      return False
+
+    installed = self.manager.getPackage( name )
+    if transaction[ 'state' ] == 'done' and ( installed is None or ( installed[ 'version' ], installed[ 'target_dir' ] ) != ( transaction[ 'version' ], transaction[ 'target_dir' ] ) ):
+      print( 'ERROR: "{0}" has changed since it\'s last staged install, it can not be rolled back.'.format( name ) )
+      return False
+
+    if transaction[ 'state' ] == 'done' and transaction[ 'prev_state' ] is not None:
+      print( 'Rolling back "{0}" from "{1}" to "{2}"'.format( name, transaction[ 'version' ], transaction[ 'prev_state' ][ 'version' ] ) )
+    else:
+      print( 'Rolling back "{0}" version "{1}"'.format( name, transaction[ 'version' ] ) )
+
+    self._rollback( transaction )
+    return True
+
+  def _removeFiles( self, file_list, dry_run ):
+    for file_path in file_list:
+      if dry_run:
+        print( file_path )
+        continue
+
+      if self.verbose:
+        print( 'Removing {0}...'.format( file_path ) )
+
+      try:
+        os.unlink( file_path )
+      except FileNotFoundError:
+        pass
+      except OSError as e:
+        print( 'WARNING: Unable to remove "{0}": {1}'.format( file_path, e ) )
+
+  # remove the files of the packages in name_list, and everything about them from the db, the directories are left, with dry_run
+  # the files are listed and nothing is removed, returns True if they were removed
+  def uninstall( self, name_list, dry_run=False ):
+    installed_list = self.manager.getInstalledPackages()
+    missing_list = [ name for name in name_list if name not in installed_list ]
+    if missing_list:
+      print( 'ERROR: Package(s) "{0}" are not installed.'.format( '", "'.join( missing_list ) ) )
+      return False
+
+    file_list = sorted( self.manager.getFileSignatures( name_list ) )
+    if dry_run:
+      print( 'Uninstalling "{0}" would remove:'.format( '", "'.join( name_list ) ) )
+      self._removeFiles( file_list, True )
+      return True
+
+    print( 'Uninstalling "{0}"'.format( '", "'.join( name_list ) ) )
+    self._removeFiles( file_list, False )  # the files first, if this is interrupted, uninstalling again finishes it
+
+    backup_dir_list = []
+    with self.manager.transaction():
+      for name in name_list:
+        backup_dir_list += self.manager.removePackage( name )
+
+    for backup_dir in backup_dir_list:
+      shutil.rmtree( backup_dir, ignore_errors=True )
+
+    return True
+
+  # remove the files recorded for packages that are not installed, see RespkgManager.getOrphanFiles, package_list limits it to
+  # those packages.  With dry_run they are only listed
+  def removeOrphans( self, package_list=None, dry_run=False ):
+    orphan_map = self.manager.getOrphanFiles( package_list )
+    if not orphan_map:
+      print( 'No orphaned files.' )
+      return
+
+    if dry_run:
+      print( 'Orphaned files that would be removed:' )
+
+    self._removeFiles( sorted( orphan_map ), dry_run )
+    if dry_run:
+      return
+
+    package_map = {}
+    for ( file_path, package ) in orphan_map.items():
+      package_map.setdefault( package, [] ).append( file_path )
+
+    with self.manager.transaction():
+      for ( package, file_list ) in package_map.items():
+        self.manager.removeFileSums( package, file_list )
+
+  def _installStep( self, package_list, target_dir ):
+    if self.verbose:
+      print( 'Installing: {0}'.format( ', '.join( [ package[ 'name' ] for package in package_list ] ) ) )
+      for package in package_list:
+        print( 'Skipping {0} unchanged files of "{1}"'.format( len( package[ 'unchanged' ] ), package[ 'name' ] ) )
+
+    for package in package_list:
+      if self.staged:
+        package[ 'extract_dir' ] = tempfile.mkdtemp( prefix=STAGING_PREFIX, dir=target_dir )
+      else:
+        package[ 'extract_dir' ] = target_dir
+
+    argument_list = [ ( package[ 'file_name' ], package[ 'extract_dir' ], package[ 'unchanged' ], [] if self.staged else package[ 'removed' ], self.verbose, package[ 'dedup' ], self.dedup == 'hardlink',
+                        package[ 'data_file' ] ) for package in package_list ]
+    try:
+      if len( package_list ) == 1 or self.jobs == 1:
+        result_list = [ _extractPackage( *arguments ) for arguments in argument_list ]
+      else:
+        with ProcessPoolExecutor( max_workers=min( self.jobs, len( package_list ) ) ) as executor:
+          result_list = [ future.result() for future in [ executor.submit( _extractPackage, *arguments ) for arguments in argument_list ] ]
+
+    finally:  # extracted or not, the spooled DATA is not needed any more, so it is not held for the rest of the batch
+      for package in package_list:
+        self._releaseData( package )
+
+    if not self.staged:  # recorded before the inits run, so what is written is known even if the package is not installed, see removeOrphans()
+      with self.manager.transaction():
+        for ( package, ( file_sum_list, error ) ) in zip( package_list, result_list ):
+          if error is None:
+            self.manager.removeFileSums( package[ 'name' ], package[ 'removed' ] )
+
+          self.manager.setFileSums( package[ 'name' ], file_sum_list )
+
+    rc = True
+    done_list = []
+    for ( package, ( file_sum_list, error ) ) in zip( package_list, result_list ):
+      if error is not None:
+        print( 'ERROR: "{0}": {1}'.format( package[ 'name' ], error ) )
+        if self.staged:
+          shutil.rmtree( package[ 'extract_dir' ], ignore_errors=True )
+
+        rc = False
+        continue
+
+      transaction_id = None
+      if self.staged:
+        try:
+          ( transaction_id, file_sum_list ) = self._swapIn( package, file_sum_list, target_dir )
+        except ( OSError, ValueError ) as e:
+          print( 'ERROR: "{0}": {1}'.format( package[ 'name' ], e ) )
+          rc = False
+          continue
+
+      if not self._runInit( package, target_dir ):
+        if transaction_id is not None:
+          print( 'Init failed, rolling back "{0}"'.format( package[ 'name' ] ) )
+          self._rollback( self.manager.getTransaction( transaction_id ) )
+
+        rc = False
+        continue
+
+      done_list.append( ( package, file_sum_list, transaction_id ) )
+
+    with self.manager.transaction():  # record the whole step at once, the unchanged files are allready recorded
+      for ( package, file_sum_list, transaction_id ) in done_list:
+        if self.staged:
+          self.manager.removeFileSums( package[ 'name' ], package[ 'removed' ] )
+          self.manager.setFileSums( package[ 'name' ], file_sum_list )
+
+        self.manager.packageInstalled( package[ 'name' ], package[ 'version' ], package[ 'description' ], package[ 'created' ], target_dir, package[ 'conflicts' ], package[ 'provides' ] )
+        if transaction_id is not None:
+          self.manager.finishTransaction( transaction_id )
+
+    for ( package, file_sum_list, transaction_id ) in done_list:  # only the last one can be rolled back, and not at all after a plain install
+      for backup_dir in self.manager.expireTransactions( package[ 'name' ], transaction_id ):
+        shutil.rmtree( backup_dir, ignore_errors=True )
+
+    return rc
+
+  # plan is from RespkgResolver.plan(), if the depends and conflicts of the packages have allready been checked
+  # returns True if everything was installed
+  def install( self, file_list, plan=None ):
+    if not os.path.isdir( self.target_dir ):
+      print( 'Target dir "{0}" does not exist or is not a directory.'.format( self.target_dir ) )
+      return False
+
+    target_dir = os.path.realpath( self.target_dir )
+
+    package_map = {}
+    try:
+      return self._install( file_list, plan, target_dir, package_map )
+
+    finally:
+      for package in package_map.values():
+        self._releaseData( package )
+
+  def _install( self, file_list, plan, target_dir, package_map ):
+    for file_name in file_list:
+      package = self._prepare( file_name, target_dir )
+      if package is None:
+        print( 'Bailing.' )
+        return False
+
+      if package[ 'name' ] in package_map:
+        print( 'ERROR: Package "{0}" is being installed more than once.'.format( package[ 'name' ] ) )
+        print( 'Bailing.' )
+        self._releaseData( package )
+        return False
+
+      package_map[ package[ 'name' ] ] = package
+
+    if plan is None:
+      resolver = RespkgResolver( self.manager.getState() )
+      for package in package_map.values():
+        resolver.add( package[ 'name' ], package[ 'version' ], package[ 'depends' ], package[ 'conflicts' ], package[ 'provides' ] )
+
+      try:
+        plan = resolver.plan()
+      except ResolveError as e:
+        print( 'ERROR: {0}'.format( e ) )
+        print( 'Bailing.' )
+        return False
+
+    if not self._checkOverlaps( package_map ):
+      print( 'Bailing.' )
+      return False
+
+    written_set = set()  # don't dedup from files that are being written/removed by the batch, they may be changing while they are copied
+    for package in package_map.values():
+      written_set.update( package[ 'file_list' ] )
+      written_set.update( package[ 'removed' ] )
+
+    for package in package_map.values():
+      package[ 'dedup' ] = dict( [ ( name, file_path ) for ( name, file_path ) in package[ 'dedup' ].items() if file_path not in written_set ] )
+
+    for step in plan:  # each step only needs the ones before it, if something fails, don't install what may depend on it
+      if not self._installStep( [ package_map[ name ] for name in step ], target_dir ):
+        print( 'Bailing.' )
+        return False
+
+    if self.remove_orphans:
+      self.removeOrphans()
+
+    return True
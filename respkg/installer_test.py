@@ -0,0 +1,345 @@
+import os
+import shutil
+from respkg import manager
+from respkg import RespkgBuilder, RespkgReader, RespkgManager, RespkgInstaller, RespkgVerifier
+
+TEST_DIR = '/tmp/respkg_installer_test'
+TEST_TARGET_DIR = os.path.join( TEST_DIR, 'target' )
+INIT_LOG = os.path.join( TEST_DIR, 'init.log' )
+
+
+def _init_workspace():
+  manager.STATE_DB_FILE_NAME = os.path.join( TEST_DIR, 'manager.db' )
+  shutil.rmtree( TEST_DIR, ignore_errors=True )
+  os.makedirs( TEST_TARGET_DIR )
+
+
+# file_map is { name: contents }, link_map is { name: name in file_map it is a hardlink to }, symlink_map is { name: where it points }
+def _build( name, version, file_map, depends=None, conflicts=None, format_version=None, link_map=None, symlink_map=None ):
+  data_dir = os.path.join( TEST_DIR, 'data', name )
+  shutil.rmtree( data_dir, ignore_errors=True )
+  for ( file_name, contents ) in file_map.items():
+    os.makedirs( os.path.dirname( os.path.join( data_dir, file_name ) ), exist_ok=True )
+    open( os.path.join( data_dir, file_name ), 'w' ).write( contents )
+
+  for ( file_name, link_to ) in ( link_map or {} ).items():
+    os.link( os.path.join( data_dir, link_to ), os.path.join( data_dir, file_name ) )
+
+  for ( file_name, link_to ) in ( symlink_map or {} ).items():
+    os.symlink( link_to, os.path.join( data_dir, file_name ) )
+
+  builder = RespkgBuilder()
+  builder.data = data_dir
+  builder.name = name
+  builder.version = version
+  builder.description = 'the {0} package'.format( name )
+  builder.depends = depends or []
+  builder.conflicts = conflicts or []
+  if format_version is not None:
+    builder.format_version = format_version
+
+  builder.reproducible = True  # so the mtimes of files that have not changed are the same between versions
+  builder.setInit( '#!/bin/sh\necho "{0} $2 $3" >> {1}\n'.format( name, INIT_LOG ) )
+
+  file_name = os.path.join( TEST_DIR, '{0}_{1}.respkg'.format( name, version ) )
+  builder.write( file_name )
+  return file_name
+
+
+def _installer( jobs=2 ):
+  installer = RespkgInstaller( RespkgManager(), TEST_TARGET_DIR, jobs )
+  installer.continue_cb = lambda: True
+  return installer
+
+
+def test_batch():
+  _init_workspace()
+  file_list = [ _build( 'app', '1.0', { 'app/bin': 'app' }, [ 'lib' ] ),
+                _build( 'lib', '1.0', { 'lib/lib': 'lib' }, [ 'base' ] ),
+                _build( 'base', '1.0', { 'base/base': 'base' } ),
+                _build( 'other', '1.0', { 'other/other': 'other' } ) ]
+  installer = _installer()
+  assert installer.install( file_list ) is True
+  assert open( INIT_LOG, 'r' ).read().splitlines() == [ 'base 1.0 *NEW*', 'other 1.0 *NEW*', 'lib 1.0 *NEW*', 'app 1.0 *NEW*' ]
+  assert open( os.path.join( TEST_TARGET_DIR, 'lib', 'lib' ), 'r' ).read() == 'lib'
+  assert installer.manager.getInstalledPackages() == [ 'app', 'base', 'lib', 'other' ]
+  assert sorted( installer.manager.getFileChecksums() ) == [ os.path.join( TEST_TARGET_DIR, i ) for i in ( 'app/bin', 'base/base', 'lib/lib', 'other/other' ) ]
+
+
+def test_bad_batch():  # nothing is installed if anything in the batch is bad
+  _init_workspace()
+  base = _build( 'base', '1.0', { 'base/base': 'base' } )
+  lib = _build( 'lib', '1.0', { 'lib/lib': 'lib' }, [ 'base' ] )
+  assert _installer().install( [ lib ] ) is False  # missing depends
+
+  assert _installer().install( [ base, _build( 'conflict', '1.0', { 'conflict/file': 'c' }, conflicts=[ 'base' ] ) ] ) is False
+  assert _installer().install( [ base, _build( 'overlap', '1.0', { 'base/base': 'not base' } ) ] ) is False
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base' ) )
+  assert RespkgManager().getInstalledPackages() == []
+
+  assert _installer().install( [ base ] ) is True
+  assert _installer().install( [ _build( 'overlap', '1.0', { 'base/base': 'not base' } ) ] ) is False  # allready installed by base
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'base' ), 'r' ).read() == 'base'
+
+
+def test_upgrade():
+  _init_workspace()
+  assert _installer().install( [ _build( 'base', '1.0', { 'base/same': 'same', 'base/changed': 'old', 'base/removed': 'removed' } ) ] ) is True
+  ctime = os.stat( os.path.join( TEST_TARGET_DIR, 'base', 'same' ) ).st_ctime_ns
+
+  installer = _installer()
+  package = installer._prepare( _build( 'base', '2.0', { 'base/same': 'same', 'base/changed': 'new' } ), TEST_TARGET_DIR )
+  assert package[ 'prev_version' ] == '1.0'
+  assert package[ 'removed' ] == [ os.path.join( TEST_TARGET_DIR, 'base', 'removed' ) ]
+
+  assert installer.install( [ package[ 'file_name' ] ] ) is True
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'changed' ), 'r' ).read() == 'new'
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'removed' ) )
+  assert os.stat( os.path.join( TEST_TARGET_DIR, 'base', 'same' ) ).st_ctime_ns == ctime  # not re-written
+  assert sorted( installer.manager.getFileChecksums() ) == [ os.path.join( TEST_TARGET_DIR, 'base', i ) for i in ( 'changed', 'same' ) ]
+
+
+def test_staged():
+  _init_workspace()
+  installer = _installer()
+  installer.staged = True
+  assert installer.install( [ _build( 'base', '1.0', { 'base/same': 'same', 'base/changed': 'old', 'base/removed': 'removed' } ) ] ) is True
+  v1_signatures = installer.manager.getFileSignatures()
+
+  assert installer.install( [ _build( 'base', '2.0', { 'base/same': 'same', 'base/changed': 'new', 'base/new/added': 'added' } ) ] ) is True
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'changed' ), 'r' ).read() == 'new'
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'new', 'added' ), 'r' ).read() == 'added'
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'removed' ) )
+  assert sorted( os.listdir( TEST_TARGET_DIR ) ) == [ '.respkg_backup', 'base' ]  # the staging dir is cleaned up
+  assert installer.manager.getPackage( 'base' )[ 'version' ] == '2.0'
+
+  assert installer.rollback( 'base' ) is True
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'changed' ), 'r' ).read() == 'old'
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'removed' ), 'r' ).read() == 'removed'
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'new' ) )
+  assert installer.manager.getPackage( 'base' )[ 'version' ] == '1.0'
+  assert installer.manager.getFileSignatures() == v1_signatures
+  assert installer.rollback( 'base' ) is False  # only the last one
+
+  assert installer.rollback( 'other' ) is False
+
+
+def test_staged_bad_init():  # the files are put back if the init fails
+  _init_workspace()
+  installer = _installer()
+  installer.staged = True
+  assert installer.install( [ _build( 'base', '1.0', { 'base/file': 'old' } ) ] ) is True
+
+  file_name = _build( 'base', '2.0', { 'base/file': 'new', 'base/added': 'added' } )
+  init_installer = _installer()
+  init_installer.staged = True
+  init_installer._runInit = lambda package, target_dir: False
+  assert init_installer.install( [ file_name ] ) is False
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'file' ), 'r' ).read() == 'old'
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'added' ) )
+  assert init_installer.manager.getPackage( 'base' )[ 'version' ] == '1.0'
+  assert init_installer.manager.getLastTransaction( 'base' )[ 'state' ] == 'rolledback'
+
+
+def test_bad_init():  # what is written for a package that fails it's init is recorded, so it can be cleaned up
+  _init_workspace()
+  installer = _installer()
+  installer._runInit = lambda package, target_dir: False
+  assert installer.install( [ _build( 'base', '1.0', { 'base/file': 'file' }, symlink_map={ 'base/link': 'file' } ) ] ) is False
+  assert installer.manager.getInstalledPackages() == []
+  assert installer.manager.getOrphanFiles() == { os.path.join( TEST_TARGET_DIR, 'base', 'file' ): 'base', os.path.join( TEST_TARGET_DIR, 'base', 'link' ): 'base' }
+
+  installer.removeOrphans()
+  assert os.listdir( os.path.join( TEST_TARGET_DIR, 'base' ) ) == []
+
+
+def test_symlinks():  # symlinks are recorded, so they are removed when the package no longer has them
+  _init_workspace()
+  installer = _installer()
+  for format_version in ( 1, 2 ):
+    assert installer.install( [ _build( 'base', '1.0', { 'base/file': 'file' }, format_version=format_version, symlink_map={ 'base/link': 'file', 'base/gone': 'file' } ) ] ) is True
+    assert RespkgVerifier().verify( installer.manager.getFileSignatures(), full=True )[ 'good' ] == [ os.path.join( TEST_TARGET_DIR, 'base', i ) for i in ( 'file', 'gone', 'link' ) ]
+
+    assert installer.install( [ _build( 'base', '2.0', { 'base/file': 'file' }, format_version=format_version, symlink_map={ 'base/link': 'file' } ) ] ) is True
+    assert not os.path.lexists( os.path.join( TEST_TARGET_DIR, 'base', 'gone' ) )
+    assert os.readlink( os.path.join( TEST_TARGET_DIR, 'base', 'link' ) ) == 'file'
+
+    assert installer.uninstall( [ 'base' ] ) is True
+    assert os.listdir( os.path.join( TEST_TARGET_DIR, 'base' ) ) == []
+
+
+def test_uninstall():
+  _init_workspace()
+  installer = _installer()
+  assert installer.install( [ _build( 'base', '1.0', { 'base/base': 'base', 'base/sub/file': 'file' } ), _build( 'other', '1.0', { 'other/other': 'other' } ) ] ) is True
+  assert installer.uninstall( [ 'base', 'nothere' ] ) is False
+
+  assert installer.uninstall( [ 'base' ], dry_run=True ) is True
+  assert os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'base' ) )
+  assert installer.manager.getInstalledPackages() == [ 'base', 'other' ]
+
+  assert installer.uninstall( [ 'base' ] ) is True
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'base' ) )
+  assert not os.path.exists( os.path.join( TEST_TARGET_DIR, 'base', 'sub', 'file' ) )
+  assert os.path.isdir( os.path.join( TEST_TARGET_DIR, 'base', 'sub' ) )
+  assert installer.manager.getInstalledPackages() == [ 'other' ]
+  assert sorted( installer.manager.getFileChecksums() ) == [ os.path.join( TEST_TARGET_DIR, 'other', 'other' ) ]
+  assert installer.manager.getState() == { 'installed': { 'other': '1.0' }, 'provides': {}, 'conflicts': {} }
+
+
+def test_orphans():
+  _init_workspace()
+  installer = _installer()
+  assert installer.install( [ _build( 'base', '1.0', { 'base/base': 'base' } ) ] ) is True
+  os.makedirs( os.path.join( TEST_DIR, 'other_target' ) )
+  installer = RespkgInstaller( RespkgManager(), os.path.join( TEST_DIR, 'other_target' ), 2 )
+  installer.continue_cb = lambda: True
+  assert installer.install( [ _build( 'base', '1.0', { 'base/base': 'base' } ) ] ) is True  # also installed in another target dir
+
+  first_file = os.path.join( TEST_TARGET_DIR, 'base', 'base' )
+  second_file = os.path.join( TEST_DIR, 'other_target', 'base', 'base' )
+  assert installer.manager.getOrphanFiles() == {}  # both are live installs
+
+  gone_file = os.path.join( TEST_TARGET_DIR, 'gone' )
+  open( gone_file, 'w' ).write( 'gone' )
+  installer.manager.setFileSum( 'gone', gone_file, '0000' )  # package that is not installed
+  assert installer.manager.getOrphanFiles() == { gone_file: 'gone' }
+  assert installer.manager.getOrphanFiles( [ 'base' ] ) == {}
+
+  installer.removeOrphans( dry_run=True )
+  assert os.path.exists( gone_file )
+
+  installer.removeOrphans()
+  assert not os.path.exists( gone_file )
+  assert os.path.exists( first_file )
+  assert os.path.exists( second_file )
+  assert installer.manager.getOrphanFiles() == {}
+  assert sorted( installer.manager.getFileChecksums() ) == sorted( [ first_file, second_file ] )
+
+
+def test_dedup():
+  _init_workspace()
+  assert _installer().install( [ _build( 'base', '1.0', { 'base/same': 'same', 'base/other': 'other' } ) ] ) is True
+
+  installer = _installer()
+  installer.dedup = 'hardlink'
+  assert installer.install( [ _build( 'copy', '1.0', { 'copy/same': 'same', 'copy/new': 'new' } ) ] ) is True
+  base_same = os.path.join( TEST_TARGET_DIR, 'base', 'same' )
+  copy_same = os.path.join( TEST_TARGET_DIR, 'copy', 'same' )
+  assert os.stat( base_same ).st_ino == os.stat( copy_same ).st_ino
+  assert os.stat( os.path.join( TEST_TARGET_DIR, 'copy', 'new' ) ).st_nlink == 1
+  assert installer.manager.getFileSignatures( [ 'copy' ] )[ copy_same ][0] == installer.manager.getFileSignatures( [ 'base' ] )[ base_same ][0]
+
+  assert _installer().install( [ _build( 'base', '2.0', { 'base/same': 'changed', 'base/other': 'other' } ) ] ) is True  # not written through the link
+  assert open( copy_same, 'r' ).read() == 'same'
+
+  installer = _installer()
+  installer.dedup = 'reflink'
+  assert installer.install( [ _build( 'clone', '1.0', { 'clone/other': 'other' } ) ] ) is True
+  clone_other = os.path.join( TEST_TARGET_DIR, 'clone', 'other' )
+  assert open( clone_other, 'r' ).read() == 'other'
+  assert os.stat( clone_other ).st_ino != os.stat( os.path.join( TEST_TARGET_DIR, 'base', 'other' ) ).st_ino
+
+
+def test_dedup_targets():  # upgrading one target does not write through to another target it was dedup'd with
+  _init_workspace()
+  other_target = os.path.join( TEST_DIR, 'other_target' )
+  os.makedirs( other_target )
+  for target_dir in ( TEST_TARGET_DIR, other_target ):
+    installer = RespkgInstaller( RespkgManager(), target_dir, 2 )
+    installer.continue_cb = lambda: True
+    installer.dedup = 'hardlink'
+    assert installer.install( [ _build( 'base', '1.0', { 'd/a': 'one' }, format_version=1, link_map={ 'd/b': 'd/a' } ) ] ) is True
+
+  assert os.stat( os.path.join( TEST_TARGET_DIR, 'd', 'a' ) ).st_ino == os.stat( os.path.join( other_target, 'd', 'b' ) ).st_ino
+
+  assert installer.install( [ _build( 'base', '2.0', { 'd/a': 'two' }, format_version=1, link_map={ 'd/b': 'd/a' } ) ] ) is True
+  assert open( os.path.join( other_target, 'd', 'a' ), 'r' ).read() == 'two'
+  assert open( os.path.join( other_target, 'd', 'b' ), 'r' ).read() == 'two'
+  assert open( os.path.join( TEST_TARGET_DIR, 'd', 'a' ), 'r' ).read() == 'one'
+  assert open( os.path.join( TEST_TARGET_DIR, 'd', 'b' ), 'r' ).read() == 'one'
+  assert os.stat( os.path.join( other_target, 'd', 'a' ) ).st_ino == os.stat( os.path.join( other_target, 'd', 'b' ) ).st_ino
+
+  assert installer.install( [ _build( 'base', '2.0', { 'd/a': 'two' }, format_version=1, link_map={ 'd/b': 'd/a' } ) ] ) is True  # reinstall keeps the links
+  assert os.stat( os.path.join( other_target, 'd', 'a' ) ).st_ino == os.stat( os.path.join( other_target, 'd', 'b' ) ).st_ino
+
+
+def test_shared_dirs():  # packages in the same step extracting into the same directories at the same time
+  _init_workspace()
+  file_list = [ _build( 'share{0}'.format( i ), '1.0', dict( [ ( 'shared/d{0}/share{1}'.format( j, i ), 'share' ) for j in range( 20 ) ] ) ) for i in range( 4 ) ]
+  installer = _installer( 4 )
+  assert installer.install( file_list ) is True
+  assert installer.manager.getInstalledPackages() == [ 'share0', 'share1', 'share2', 'share3' ]
+  assert len( os.listdir( os.path.join( TEST_TARGET_DIR, 'shared', 'd0' ) ) ) == 4
+
+
+def test_step_error():  # one package failing does not drop the rest of the step
+  _init_workspace()
+  good = _build( 'good', '1.0', { 'good/file': 'good' } )
+  bad = _build( 'bad', '1.0', { 'bad/file': 'bad' } )
+  os.makedirs( os.path.join( TEST_TARGET_DIR, 'bad', 'file' ) )  # a directory where the file goes
+  installer = _installer()
+  assert installer.install( [ good, bad ] ) is False
+  assert installer.manager.getInstalledPackages() == [ 'good' ]
+
+
+def test_spool_once():  # the DATA of a version 1 package is decompressed once per install, not for _prepare and again for extracting
+  _init_workspace()
+  file_name = _build( 'base', '1.0', { 'base/file': 'base' }, format_version=1 )
+  spool_list = []
+  spool_data = RespkgReader._spoolData
+
+  def _spoolData( reader ):
+    if reader.data_file_name is None:
+      spool_list.append( reader )
+
+    spool_data( reader )
+
+  RespkgReader._spoolData = _spoolData
+  try:
+    assert _installer().install( [ file_name ] ) is True
+  finally:
+    RespkgReader._spoolData = spool_data
+
+  assert len( spool_list ) == 1
+  assert not os.path.exists( spool_list[0].data_file_name )  # cleaned up
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'file' ), 'r' ).read() == 'base'
+
+
+def test_spool_release():  # the spooled DATA of each package is removed once it's step is extracted, not at the end of the batch
+  _init_workspace()
+  tmp_dir = os.path.join( TEST_DIR, 'tmp' )
+  os.makedirs( tmp_dir )
+  file_list = [ _build( 'base', '1.0', { 'base/file': 'base' }, format_version=1 ), _build( 'app', '1.0', { 'app/file': 'app' }, [ 'base' ], format_version=1 ) ]
+  spool_map = {}
+
+  def _runInit( package, target_dir ):
+    spool_map[ package[ 'name' ] ] = os.listdir( tmp_dir )
+    return True
+
+  installer = _installer()
+  installer.tmp_dir = tmp_dir
+  installer._runInit = _runInit
+  assert installer.install( file_list ) is True
+  assert spool_map == { 'base': [ spool_map[ 'base' ][0] ], 'app': [] }  # app's is still there while base is being installed
+  assert os.listdir( tmp_dir ) == []
+
+
+def test_staged_then_plain():  # a plain install after a staged one can't be rolled back past
+  _init_workspace()
+  installer = _installer()
+  assert installer.install( [ _build( 'base', '1.0', { 'base/a': '1' } ) ] ) is True
+  installer.staged = True
+  assert installer.install( [ _build( 'base', '2.0', { 'base/a': '2', 'base/b': '2' } ) ] ) is True
+  installer.staged = False
+  assert installer.install( [ _build( 'base', '3.0', { 'base/a': '3', 'base/b': '3', 'base/c': '3' } ) ] ) is True
+
+  assert installer.rollback( 'base' ) is False
+  assert installer.manager.getPackage( 'base' )[ 'version' ] == '3.0'
+  assert open( os.path.join( TEST_TARGET_DIR, 'base', 'a' ), 'r' ).read() == '3'
+  assert os.listdir( os.path.join( TEST_TARGET_DIR, '.respkg_backup' ) ) == []
+
+  installer.staged = True  # the version check, for a transaction that somehow was not expired
+  assert installer.install( [ _build( 'base', '4.0', { 'base/a': '4' } ) ] ) is True
+  installer.manager.packageInstalled( 'base', '5.0', None, None, installer.manager.getPackage( 'base' )[ 'target_dir' ], [], [] )
+  assert installer.rollback( 'base' ) is False
@@ -1,11 +1,24 @@
-import socket
 import json
 import sqlite3
 import hashlib
 import os
-from urllib import request
+import time
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from respkg.transport import HTTPClient, HTTPError
 
 STATE_DB_FILE_NAME = '/var/lib/respkg/manager.db'
+MANIFEST_CACHE_DIR_NAME = 'manifests'  # in the same directory as STATE_DB_FILE_NAME
+MANIFEST_CACHE_TTL = 300  # seconds
+PACKAGE_CACHE_DIR_NAME = 'cache'  # in the same directory as STATE_DB_FILE_NAME
+PACKAGE_CACHE_SIZE = 2 * 1024 * 1024 * 1024  # bytes, 0 to disable the package cache
+STALE_DOWNLOAD_AGE = 24 * 3600  # seconds, partial downloads in the package cache not written to for this long are removed when trimming
+DOWNLOAD_JOBS = 4  # default number of concurrent package downloads
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5  # number of times to try resuming a download before giving up
 
 __VERSION__ = '0.2'
 
@@ -14,6 +27,18 @@ class RespkgManager( object ):
   def __init__( self ):
     self._checkDB( STATE_DB_FILE_NAME )  # check db before we connect to it
     self.conn = sqlite3.connect( STATE_DB_FILE_NAME )
+    self.conn.execute( 'PRAGMA synchronous=NORMAL;' )  # with WAL, this is still safe from corruption, the last transaction(s) may be lost on power failure
+    self.conn.execute( 'PRAGMA temp_store=MEMORY;' )
+    self.conn.execute( 'PRAGMA cache_size=-16384;' )  # 16MiB
+    self._in_transaction = False
+    self._manifest_map = {}
+    self._http = HTTPClient( 'respkg {0}'.format( __VERSION__ ) )
+    self.download_buffer_size = DOWNLOAD_BUFFER_SIZE
+    self.package_cache_size = PACKAGE_CACHE_SIZE
+    self._package_cache_lock = threading.Lock()
+    self._package_cache_in_use = {}  # { file_path: count } of cached files handed out and not yet released, trimming leaves them
+    self.manifest_ttl = MANIFEST_CACHE_TTL
+    self.refresh_manifests = False  # ignore the ttl, and re-validate cached manifests with the server
 
   @staticmethod
   def _checkDB( state_db ):
@@ -76,50 +101,215 @@ class RespkgManager( object ):
 
       conn.execute( 'UPDATE "control" SET "value" = "2" WHERE "key" = "version";' )
 
+    if version < '3':
+      conn.execute( 'CREATE INDEX "files_package" ON "files" ( "package" );' )
+      conn.execute( 'CREATE INDEX "conflicts_with" ON "conflicts" ( "with" );' )
+      conn.execute( 'CREATE INDEX "conflicts_package" ON "conflicts" ( "package" );' )
+      conn.execute( 'CREATE INDEX "provides_package" ON "provides" ( "package" );' )
+      conn.execute( 'CREATE INDEX "provides_target" ON "provides" ( "target" );' )
+
+      conn.execute( 'UPDATE "control" SET "value" = "3" WHERE "key" = "version";' )
+
+    if version < '4':  # stat signature of the file as installed, so verifying can skip files that havn't changed
+      conn.execute( 'ALTER TABLE "files" ADD COLUMN "size" integer;' )
+      conn.execute( 'ALTER TABLE "files" ADD COLUMN "mtime" integer;' )
+      conn.execute( 'ALTER TABLE "files" ADD COLUMN "inode" integer;' )
+
+      conn.execute( 'UPDATE "control" SET "value" = "4" WHERE "key" = "version";' )
+
+    if version < '5':  # staged installs, what was done to the files and the db rows from before, so it can be rolled back
+      conn.execute( """CREATE TABLE "transactions" (
+      "id" integer PRIMARY KEY,
+      "package" char(50) NOT NULL,
+      "version" char(20) NOT NULL,
+      "target_dir" char(200) NOT NULL,
+      "backup_dir" char(512),
+      "state" char(20) NOT NULL,
+      "prev_state" text,
+      "created" datetime DEFAULT CURRENT_TIMESTAMP,
+      "modified" datetime DEFAULT CURRENT_TIMESTAMP
+    );""" )
+
+      conn.execute( """CREATE TABLE "transaction_actions" (
+      "transaction" integer NOT NULL,
+      "action" char(10) NOT NULL,
+      "file_path" char(512) NOT NULL
+    );""" )
+
+      conn.execute( 'CREATE INDEX "transactions_package" ON "transactions" ( "package" );' )
+      conn.execute( 'CREATE INDEX "transaction_actions_transaction" ON "transaction_actions" ( "transaction" );' )
+
+      conn.execute( 'UPDATE "control" SET "value" = "5" WHERE "key" = "version";' )
+
+    if version < '6':  # for finding installed files with the same contents
+      conn.execute( 'CREATE INDEX "files_sha256" ON "files" ( "sha256" );' )
+
+      conn.execute( 'UPDATE "control" SET "value" = "6" WHERE "key" = "version";' )
+
     conn.commit()
 
-  def _getHTTP( self, path, proxy, target_file=None ):
-    if proxy:
-      opener = request.build_opener( request.ProxyHandler( { 'http': proxy, 'https': proxy } ) )
-    else:
-      opener = request.build_opener( request.ProxyHandler( {} ) )  # no proxying, not matter what is in the enviornment
+    conn.execute( 'PRAGMA journal_mode=WAL;' )  # persistant, so only needs to be set once, can't be changed inside a transaction
+    conn.close()
 
-    opener.addheaders = [ ( 'User-agent', 'respkg {0}'.format( __VERSION__ ) ) ]
+  @contextlib.contextmanager
+  def transaction( self ):  # everything done inside is commited once at the end, or not at all
+    if self._in_transaction:  # the outer transaction will commit
+      yield
+      return
 
+    self._in_transaction = True
     try:
-      resp = opener.open( path )
+      yield
+      self.conn.commit()
 
-    except request.HTTPError as e:
-      if e.code == 404:
-        print( '"{0}" not found'.format( path ) )
-        return None
+    except Exception:
+      self.conn.rollback()
+      raise
 
-      if e.code == 500:
-        print( 'Server Error retreiving "{0}"'.format( path ) )
-        return None
+    finally:
+      self._in_transaction = False
+
+  def _commit( self ):
+    if not self._in_transaction:
+      self.conn.commit()
 
-    except request.URLError as e:
-      print( 'URLError Requesting "{0}", "{1}"'.format( path, e.reason ) )
+  def _openHTTP( self, path, proxy, headers=None ):  # returns the response, a 304 is returned as a response, errors return None
+    try:
+      resp = self._http.open( path, proxy, headers )
+
+    except HTTPError as e:
+      print( 'Error Requesting "{0}", "{1}"'.format( path, e.reason ) )
       return None
 
-    except socket.error as e:
-      print( 'Socket Error Requesting "{0}", errno: "{1}", "{2}"'.format( path, e.errno, e.message ) )
+    if resp.status in ( 200, 206, 304 ):
+      return resp
+
+    resp.close()
+
+    if resp.status == 404:
+      print( '"{0}" not found'.format( path ) )
+      return None
+
+    if resp.status == 500:
+      print( 'Server Error retreiving "{0}"'.format( path ) )
+      return None
+
+    print( 'HTTP Error "{0}" retreiving "{1}"'.format( resp.status, path ) )
+    return None
+
+  @staticmethod
+  def _expectedSize( resp ):  # the total size of the file being downloaded, None if the server didn't say
+    try:
+      if resp.status == 206:
+        return int( resp.headers[ 'Content-Range' ].split( '/' )[1] )
+
+      return int( resp.headers[ 'Content-Length' ] )
+
+    except ( KeyError, TypeError, IndexError, ValueError ):
       return None
 
-    if target_file:
-      buff = resp.read( 40960 )
-      while( buff ):
-        target_file.write( buff )
-        buff = resp.read( 40960 )
+  # download to target_file hashing as it goes, if the transfer drops, it is resumed with a Range request
+  # returns the sha256 hexdigest of the file, None on error
+  def _download( self, path, proxy, target_file ):
+    sha256 = hashlib.sha256()
+    offset = 0
+    retries = 0
+    while True:
+      headers = {}
+      if offset:
+        headers[ 'Range' ] = 'bytes={0}-'.format( offset )
+
+      resp = self._openHTTP( path, proxy, headers )
+      if resp is None:
+        return None
+
+      if offset and resp.status != 206:  # server ignored the Range, start over
+        target_file.seek( 0 )
+        target_file.truncate()
+        sha256 = hashlib.sha256()
+        offset = 0
+
+      expected_size = self._expectedSize( resp )
+      try:
+        buff = resp.read( self.download_buffer_size )
+        while buff:
+          sha256.update( buff )
+          target_file.write( buff )
+          offset += len( buff )
+          buff = resp.read( self.download_buffer_size )
+
+      except HTTPError as e:
+        print( 'Error Downloading "{0}", "{1}"'.format( path, e.reason ) )
+        if expected_size is None:  # no way to know where to resume from
+          return None
+
+      if expected_size is None or offset >= expected_size:
+        return sha256.hexdigest()
+
+      retries += 1
+      if retries > DOWNLOAD_RETRIES:
+        print( 'Download of "{0}" interrupted at {1} of {2} bytes, giving up'.format( path, offset, expected_size ) )
+        return None
+
+      print( 'Download of "{0}" interrupted at {1} of {2} bytes, resuming'.format( path, offset, expected_size ) )
+
+  def _getManafestCached( self, path, proxy ):  # returns the raw manifest, from the on disk cache if it is still good
+    cache_dir = os.path.join( os.path.dirname( STATE_DB_FILE_NAME ), MANIFEST_CACHE_DIR_NAME )
+    cache_file = os.path.join( cache_dir, '{0}.json'.format( hashlib.sha256( path.encode() ).hexdigest() ) )
+
+    try:
+      cache = json.loads( open( cache_file, 'r' ).read() )
+    except ( OSError, ValueError ):
+      cache = None
+
+    if cache is not None and not self.refresh_manifests and ( time.time() - cache[ 'fetched' ] ) < self.manifest_ttl:
+      return cache[ 'manifest' ]
+
+    headers = {}
+    if cache is not None:
+      if cache[ 'etag' ]:
+        headers[ 'If-None-Match' ] = cache[ 'etag' ]
+      if cache[ 'last_modified' ]:
+        headers[ 'If-Modified-Since' ] = cache[ 'last_modified' ]
+
+    resp = self._openHTTP( path, proxy, headers )
+    if resp is None:
+      return None
 
-      return True
+    if resp.status == 304:
+      resp.close()
+      cache[ 'fetched' ] = time.time()
 
     else:
-      return resp.read()
+      try:
+        manifest = resp.read().decode()
+      except HTTPError as e:
+        print( 'Error Requesting "{0}", "{1}"'.format( path, e.reason ) )
+        return None
+
+      cache = { 'path': path, 'etag': resp.headers.get( 'ETag' ), 'last_modified': resp.headers.get( 'Last-Modified' ), 'fetched': time.time(), 'manifest': manifest }
+
+    try:  # the cache is an optimization, if we can't write it, carry on
+      if not os.path.isdir( cache_dir ):
+        os.makedirs( cache_dir )
+
+      tmp_file = '{0}.{1}.tmp'.format( cache_file, os.getpid() )
+      open( tmp_file, 'w' ).write( json.dumps( cache ) )
+      os.replace( tmp_file, cache_file )
+
+    except OSError:
+      pass
+
+    return cache[ 'manifest' ]
 
   def _getManafest( self, url, component, proxy ):
     path = os.path.join( url, '_repo_{0}'.format( component ), 'MANIFEST_all.json' )
-    manifest = self._getHTTP( path, proxy )
+    try:
+      return self._manifest_map[ path ]
+    except KeyError:
+      pass
+
+    manifest = self._getManafestCached( path, proxy )
     if manifest is None:
       return None
 
@@ -137,22 +327,113 @@ class RespkgManager( object ):
           continue
 
         try:
-          result[ package ][ item[ 'version' ] ] = { 'path': item[ 'path' ], 'sha256': item[ 'sha256' ] }
+          result[ package ][ item[ 'version' ] ] = { 'path': item[ 'path' ], 'sha256': item[ 'sha256' ], 'deltas': {} }
         except KeyError:
-          result[ package ] = { item[ 'version' ]: { 'path': item[ 'path' ], 'sha256': item[ 'sha256' ] } }
+          result[ package ] = { item[ 'version' ]: { 'path': item[ 'path' ], 'sha256': item[ 'sha256' ], 'deltas': {} } }
+
+    for package in manifest:  # deltas are only used if the full package is there to fall back to
+      for item in manifest[ package ]:
+        if item[ 'type' ] != 'respkg-delta':
+          continue
+
+        try:
+          result[ package ][ item[ 'version' ] ][ 'deltas' ][ item[ 'delta_from' ] ] = { 'path': item[ 'path' ], 'sha256': item[ 'sha256' ] }
+        except KeyError:
+          pass
+
+    self._manifest_map[ path ] = result
 
     return result
 
-  def _getPackageFile( self, repo_url, file_path, proxy ):
+  def _getPackageFile( self, repo_url, file_path, proxy, tmp_dir=None ):  # downloads to a new temp file, returns ( the name of it, sha256 of it )
     path = os.path.join( repo_url, file_path )
-    tmpfile = open( '/tmp/respkgdownload.tmp', 'wb' )
-    rc = self._getHTTP( path, proxy, tmpfile )
-    if rc is None:
+    ( fd, local_file ) = tempfile.mkstemp( prefix='respkgdownload.', suffix='.respkg', dir=tmp_dir )
+    try:
+      with os.fdopen( fd, 'wb' ) as tmpfile:
+        sha256 = self._download( path, proxy, tmpfile )
+
+    except BaseException:
+      os.unlink( local_file )
+      raise
+
+    if sha256 is None:
+      os.unlink( local_file )
+      return None
+
+    return ( local_file, sha256 )
+
+  def _packageCacheDir( self ):  # None if the cache is disabled or not usable
+    if not self.package_cache_size:
+      return None
+
+    cache_dir = os.path.join( os.path.dirname( STATE_DB_FILE_NAME ), PACKAGE_CACHE_DIR_NAME )
+    try:
+      if not os.path.isdir( cache_dir ):
+        os.makedirs( cache_dir )
+
+    except OSError:
       return None
 
-    tmpfile.close()
+    if not os.access( cache_dir, os.W_OK ):
+      return None
 
-    return '/tmp/respkgdownload.tmp'
+    return cache_dir
+
+  # remove the least recently used packages until the cache fits in package_cache_size, and downloads left by a killed respkg
+  # packages that are in use are not removed, but count towards the size
+  def _trimPackageCache( self, cache_dir ):
+    with self._package_cache_lock:
+      entry_list = []
+      total = 0
+      stale = time.time() - STALE_DOWNLOAD_AGE
+      for entry in os.scandir( cache_dir ):
+        if not entry.name.endswith( '.respkg' ):
+          continue
+
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+
+        if entry.name.startswith( 'respkgdownload.' ):  # in progress, unless nothing has been written to it in a long time
+          if stat.st_mtime < stale:
+            try:
+              os.unlink( entry.path )
+            except FileNotFoundError:
+              pass
+
+          continue
+
+        total += stat.st_size
+        if entry.path not in self._package_cache_in_use:
+          entry_list.append( ( stat.st_mtime, stat.st_size, entry.path ) )
+
+      for ( _, size, file_path ) in sorted( entry_list ):
+        if total <= self.package_cache_size:
+          break
+
+        try:
+          os.unlink( file_path )
+        except FileNotFoundError:
+          pass
+
+        total -= size
+
+  def isCachedPackageFile( self, file_name ):
+    cache_dir = os.path.join( os.path.dirname( STATE_DB_FILE_NAME ), PACKAGE_CACHE_DIR_NAME )
+    return os.path.dirname( os.path.realpath( file_name ) ) == os.path.realpath( cache_dir )
+
+  def releasePackageFile( self, file_name ):  # done with a file from getPackageFile(s), cached files are left for next time
+    if not self.isCachedPackageFile( file_name ):
+      os.unlink( file_name )
+      return
+
+    with self._package_cache_lock:
+      count = self._package_cache_in_use.pop( file_name, 0 ) - 1
+      if count > 0:
+        self._package_cache_in_use[ file_name ] = count
+
+    self._trimPackageCache( os.path.dirname( file_name ) )  # it may of been kept past the size while it was in use
 
   def packageList( self ):
     result = {}
@@ -185,7 +466,7 @@ class RespkgManager( object ):
       cur.execute( 'INSERT INTO "provides" ( "package", "target" ) VALUES ( ?, ? );', ( name, provides ) )
 
     cur.close()
-    self.conn.commit()
+    self._commit()
 
   def checkDepends( self, name, depends_list ):  # true -> ok to install, ie dependancies met
     cur = self.conn.cursor()
@@ -223,6 +504,25 @@ class RespkgManager( object ):
     cur.close()
     return True
 
+  def getState( self ):  # everything needed to check depends/conflicts for a batch of packages in one go, see RespkgResolver
+    result = { 'installed': {}, 'provides': {}, 'conflicts': {} }
+    cur = self.conn.cursor()
+    cur.execute( 'SELECT "package", "version" FROM "packages";' )
+    for ( package, version ) in cur.fetchall():
+      result[ 'installed' ][ package ] = version
+
+    cur.execute( 'SELECT "package", "target" FROM "provides";' )
+    for ( package, target ) in cur.fetchall():
+      result[ 'provides' ].setdefault( package, [] ).append( target )
+
+    cur.execute( 'SELECT "package", "with" FROM "conflicts";' )
+    for ( package, conflict ) in cur.fetchall():
+      result[ 'conflicts' ].setdefault( package, [] ).append( conflict )
+
+    cur.close()
+
+    return result
+
   def getPackage( self, name ):
     result = {}
     cur = self.conn.cursor()
@@ -257,28 +557,203 @@ class RespkgManager( object ):
     cur.close()
     return result
 
+  def getFileOwners( self, file_list ):  # returns { file_path: package } for the files in file_list that are installed
+    result = {}
+    cur = self.conn.cursor()
+    cur.execute( 'CREATE TEMP TABLE IF NOT EXISTS "new_files" ( "file_path" char(512) NOT NULL );' )
+    cur.execute( 'DELETE FROM "new_files";' )
+    cur.executemany( 'INSERT INTO "new_files" ( "file_path" ) VALUES ( ? );', ( ( file_path, ) for file_path in file_list ) )
+    cur.execute( 'SELECT "files"."file_path", "files"."package" FROM "new_files" INNER JOIN "files" ON "files"."file_path" = "new_files"."file_path" ORDER BY "files"."file_path";' )
+    for ( file_path, owner ) in cur.fetchall():
+      result[ file_path ] = owner
+
+    cur.execute( 'DELETE FROM "new_files";' )
+    cur.close()
+    self._commit()
+
+    return result
+
+  def getFilesByChecksum( self, sha256_list ):  # returns { sha256: [ ( file_path, size, mtime, inode ) ] } of the installed files with those checksums
+    result = {}
+    cur = self.conn.cursor()
+    cur.execute( 'CREATE TEMP TABLE IF NOT EXISTS "wanted_sums" ( "sha256" char(65) NOT NULL );' )
+    cur.execute( 'DELETE FROM "wanted_sums";' )
+    cur.executemany( 'INSERT INTO "wanted_sums" ( "sha256" ) VALUES ( ? );', ( ( sha256, ) for sha256 in set( sha256_list ) ) )
+    cur.execute( 'SELECT "files"."sha256", "files"."file_path", "files"."size", "files"."mtime", "files"."inode" FROM "wanted_sums" INNER JOIN "files" ON "files"."sha256" = "wanted_sums"."sha256" ORDER BY "files"."file_path";' )
+    for ( sha256, file_path, size, mtime, inode ) in cur.fetchall():
+      result.setdefault( sha256, [] ).append( ( file_path, size, mtime, inode ) )
+
+    cur.execute( 'DELETE FROM "wanted_sums";' )
+    cur.close()
+    self._commit()
+
+    return result
+
+  def getFileOverlaps( self, package, file_list ):  # returns { file_path: package } for the files in file_list allready installed by a package other than package
+    return dict( [ ( file_path, owner ) for ( file_path, owner ) in self.getFileOwners( file_list ).items() if owner != package ] )
+
   # no we are not saving the full path name to the table, otherwise installing the file to a new location the second time will cause problems
   # mabey some day add support to detect and move files if full file name is needed
-  def setFileSum( self, package, file_path, sha256 ):
+  def setFileSum( self, package, file_path, sha256, size=None, mtime=None, inode=None ):
+    self.setFileSums( package, [ ( file_path, sha256, size, mtime, inode ) ] )
+
+  # file_list is an iterable of ( file_path, sha256 ) or ( file_path, sha256, size, mtime, inode ), mtime is in ns
+  def setFileSums( self, package, file_list ):
+    file_list = [ ( tuple( item ) + ( None, None, None ) )[ :5 ] for item in file_list ]
     cur = self.conn.cursor()
-    cur.execute( 'SELECT COUNT(*) FROM "files" WHERE "file_path" = ?;', ( file_path, ) )
+    # TODO: check to make sure the package didn't change when doing an update
+    cur.executemany( 'UPDATE "files" SET "sha256" = ?, "size" = ?, "mtime" = ?, "inode" = ?, "modified" = CURRENT_TIMESTAMP WHERE "file_path" = ?;', ( ( sha256, size, mtime, inode, file_path ) for ( file_path, sha256, size, mtime, inode ) in file_list ) )
+    cur.executemany( 'INSERT OR IGNORE INTO "files" ( "file_path", "package", "sha256", "size", "mtime", "inode" ) VALUES( ?, ?, ?, ?, ?, ? );', ( ( file_path, package, sha256, size, mtime, inode ) for ( file_path, sha256, size, mtime, inode ) in file_list ) )
+    cur.close()
+    self._commit()
 
-    ( count, ) = cur.fetchone()
-    if count:  # TODO: check to make sure the package didn't change when doing an update
-      cur.execute( 'UPDATE "files" SET "sha256" = ?, "modified" = CURRENT_TIMESTAMP WHERE "file_path" = ?;', ( sha256, file_path ) )
+  def removeFileSums( self, package, file_list ):
+    cur = self.conn.cursor()
+    cur.executemany( 'DELETE FROM "files" WHERE "package" = ? AND "file_path" = ?;', ( ( package, file_path ) for file_path in file_list ) )
+    cur.close()
+    self._commit()
 
+  # returns { file_path: package } of the files recorded for packages that are not installed (ie: left from a failed install), files
+  # of installed packages are never orphans, including ones outside the package's current target dir, they may be a live install
+  def getOrphanFiles( self, package_list=None ):
+    result = {}
+    cur = self.conn.cursor()
+    sql = 'SELECT "files"."file_path", "files"."package" FROM "files" LEFT OUTER JOIN "packages" ON "files"."package" = "packages"."package" WHERE "packages"."package" IS NULL'
+    if package_list:
+      cur.execute( sql + ' AND "files"."package" IN ({0}) ORDER BY "files"."file_path";'.format( ','.join( '?' * len( package_list ) ) ), package_list )
     else:
-      cur.execute( 'INSERT INTO "files" ( "file_path", "package", "sha256" ) VALUES( ?, ?, ? );', ( file_path, package, sha256 ) )
+      cur.execute( sql + ' ORDER BY "files"."file_path";' )
+
+    for ( file_path, package ) in cur.fetchall():
+      result[ file_path ] = package
+
+    cur.close()
+
+    return result
+
+  def removePackage( self, name ):  # remove everything about package name from the db, the files are up to the caller, returns the backup dirs of it's staged installs to remove
+    backup_dir_list = self.expireTransactions( name )
+    cur = self.conn.cursor()
+    for table in ( 'packages', 'files', 'conflicts', 'provides' ):
+      cur.execute( 'DELETE FROM "{0}" WHERE "package" = ?;'.format( table ), ( name, ) )
 
     cur.close()
-    self.conn.commit()
+    self._commit()
+
+    return backup_dir_list
 
-  def getFileChecksums( self ):
+  def getFileChecksums( self, package_list=None ):
     result = {}
+    for ( file_path, ( sha256, _, _, _ ) ) in self.getFileSignatures( package_list ).items():
+      result[ file_path ] = sha256
+
+    return result
+
+  def getFileSignatures( self, package_list=None ):  # returns { file_path: ( sha256, size, mtime, inode ) }, the stat values are None if not recorded
+    result = {}
+    cur = self.conn.cursor()
+    if package_list:
+      cur.execute( 'SELECT "file_path", "sha256", "size", "mtime", "inode", "target_dir" from "files" LEFT OUTER JOIN "packages" ON "files"."package" = "packages"."package" WHERE "files"."package" IN ({0}) ORDER BY "file_path";'.format( ','.join( '?' * len( package_list ) ) ), package_list )
+    else:
+      cur.execute( 'SELECT "file_path", "sha256", "size", "mtime", "inode", "target_dir" from "files" LEFT OUTER JOIN "packages" ON "files"."package" = "packages"."package" ORDER BY "file_path";')
+
+    for ( file_path, sha256, size, mtime, inode, target_dir ) in cur.fetchall():
+      result[ os.path.join( target_dir or '', file_path ) ] = ( sha256, size, mtime, inode )  # no target_dir for orphans, see getOrphanFiles
+
+    cur.close()
+
+    return result
+
+  def _packageRows( self, name ):  # everything in the db about package name, for putting it back on rollback, None if it is not installed
+    cur = self.conn.cursor()
+    cur.execute( 'SELECT "version", "target_dir", "description", "installed", "pkg_created" FROM "packages" WHERE "package" = ?;', ( name, ) )
+    row = cur.fetchone()
+    if row is None:
+      cur.close()
+      return None
+
+    result = dict( zip( ( 'version', 'target_dir', 'description', 'installed', 'pkg_created' ), row ) )
+    cur.execute( 'SELECT "with" FROM "conflicts" WHERE "package" = ? ORDER BY "with";', ( name, ) )
+    result[ 'conflicts' ] = [ i[0] for i in cur.fetchall() ]
+    cur.execute( 'SELECT "target" FROM "provides" WHERE "package" = ? ORDER BY "target";', ( name, ) )
+    result[ 'provides' ] = [ i[0] for i in cur.fetchall() ]
+    cur.execute( 'SELECT "file_path", "sha256", "size", "mtime", "inode" FROM "files" WHERE "package" = ? ORDER BY "file_path";', ( name, ) )
+    result[ 'files' ] = [ list( i ) for i in cur.fetchall() ]
+    cur.close()
+
+    return result
+
+  # action_list is [ ( action, file_path ) ] of what is about to be done to the files, see RespkgInstaller, this is commited right away,
+  # so if the install is interrupted there is a record of what to undo.  backup_dir is where the replaced files are moved to,
+  # backup_dir_cb( transaction_id ) returns it.  Returns the transaction id
+  def startTransaction( self, package, version, target_dir, backup_dir_cb, action_list ):
+    cur = self.conn.cursor()
+    cur.execute( 'INSERT INTO "transactions" ( "package", "version", "target_dir", "state", "prev_state" ) VALUES ( ?, ?, ?, "started", ? );', ( package, version, target_dir, json.dumps( self._packageRows( package ) ) ) )
+    transaction_id = cur.lastrowid
+    cur.execute( 'UPDATE "transactions" SET "backup_dir" = ? WHERE "id" = ?;', ( backup_dir_cb( transaction_id ), transaction_id ) )
+    cur.executemany( 'INSERT INTO "transaction_actions" ( "transaction", "action", "file_path" ) VALUES ( ?, ?, ? );', ( ( transaction_id, action, file_path ) for ( action, file_path ) in action_list ) )
+    cur.close()
+    self._commit()
+
+    return transaction_id
+
+  def finishTransaction( self, transaction_id ):  # the package has been recorded as installed
     cur = self.conn.cursor()
-    cur.execute( 'SELECT "file_path", "sha256", "target_dir" from "files" LEFT OUTER JOIN "packages" ON "files"."package" = "packages"."package" ORDER BY "file_path";')
-    for ( file_path, sha256, target_dir ) in cur.fetchall():
-      result[ os.path.join( target_dir, file_path ) ] = sha256
+    cur.execute( 'UPDATE "transactions" SET "state" = "done", "modified" = CURRENT_TIMESTAMP WHERE "id" = ?;', ( transaction_id, ) )
+    cur.close()
+    self._commit()
+
+  def _getTransaction( self, where, value ):
+    cur = self.conn.cursor()
+    cur.execute( 'SELECT "id", "package", "version", "target_dir", "backup_dir", "state", "prev_state", "created" FROM "transactions" WHERE {0} = ? ORDER BY "id" DESC LIMIT 1;'.format( where ), ( value, ) )
+    row = cur.fetchone()
+    if row is None:
+      cur.close()
+      return None
+
+    result = dict( zip( ( 'id', 'package', 'version', 'target_dir', 'backup_dir', 'state', 'prev_state', 'created' ), row ) )
+    result[ 'prev_state' ] = json.loads( result[ 'prev_state' ] )
+    cur.execute( 'SELECT "action", "file_path" FROM "transaction_actions" WHERE "transaction" = ? ORDER BY rowid;', ( result[ 'id' ], ) )
+    result[ 'action_list' ] = [ tuple( i ) for i in cur.fetchall() ]
+    cur.close()
+
+    return result
+
+  def getTransaction( self, transaction_id ):  # returns a dict of the transaction, with it's action_list, None if not found
+    return self._getTransaction( '"id"', transaction_id )
+
+  def getLastTransaction( self, package ):  # the most recent transaction of package, see getTransaction
+    return self._getTransaction( '"package"', package )
+
+  def rollbackTransaction( self, transaction_id ):  # put the package's rows back to how they were before, the files are up to the caller
+    transaction = self.getTransaction( transaction_id )
+    cur = self.conn.cursor()
+    if transaction[ 'state' ] == 'done':  # before it's done, the rows of the package have not been touched
+      name = transaction[ 'package' ]
+      prev = transaction[ 'prev_state' ]
+      for table in ( 'packages', 'files', 'conflicts', 'provides' ):
+        cur.execute( 'DELETE FROM "{0}" WHERE "package" = ?;'.format( table ), ( name, ) )
+
+      if prev is not None:
+        cur.execute( 'INSERT INTO "packages" ( "package", "version", "target_dir", "description", "installed", "pkg_created" ) VALUES ( ?, ?, ?, ?, ?, ? );', ( name, prev[ 'version' ], prev[ 'target_dir' ], prev[ 'description' ], prev[ 'installed' ], prev[ 'pkg_created' ] ) )
+        cur.executemany( 'INSERT INTO "conflicts" ( "package", "with" ) VALUES ( ?, ? );', ( ( name, conflict ) for conflict in prev[ 'conflicts' ] ) )
+        cur.executemany( 'INSERT INTO "provides" ( "package", "target" ) VALUES ( ?, ? );', ( ( name, provides ) for provides in prev[ 'provides' ] ) )
+        cur.executemany( 'INSERT INTO "files" ( "file_path", "package", "sha256", "size", "mtime", "inode" ) VALUES( ?, ?, ?, ?, ?, ? );', ( ( file_path, name, sha256, size, mtime, inode ) for ( file_path, sha256, size, mtime, inode ) in prev[ 'files' ] ) )
+
+    cur.execute( 'UPDATE "transactions" SET "state" = "rolledback", "modified" = CURRENT_TIMESTAMP WHERE "id" = ?;', ( transaction_id, ) )
+    cur.close()
+    self._commit()
+
+  def expireTransactions( self, package, keep_id=None ):  # the transactions of package other than keep_id can no longer be rolled back, returns the backup dirs to remove
+    if keep_id is None:
+      keep_id = 0  # ids start at 1
+
+    cur = self.conn.cursor()
+    cur.execute( 'SELECT "backup_dir" FROM "transactions" WHERE "package" = ? AND "id" != ? AND "state" IN ( "started", "done" );', ( package, keep_id ) )
+    result = [ i[0] for i in cur.fetchall() ]
+    cur.execute( 'UPDATE "transactions" SET "state" = "expired", "modified" = CURRENT_TIMESTAMP WHERE "package" = ? AND "id" != ? AND "state" IN ( "started", "done" );', ( package, keep_id ) )
+    cur.close()
+    self._commit()
 
     return result
 
@@ -297,7 +772,7 @@ class RespkgManager( object ):
     cur.execute( 'INSERT INTO "repos" ( "name", "url", "component", "proxy" ) VALUES ( ?, ?, ?, ? );', ( name, url, component, proxy ) )
 
     cur.close()
-    self.conn.commit()
+    self._commit()
 
   def setRepoKey( self, name, pub_key ):
     cur = self.conn.cursor()
@@ -310,21 +785,23 @@ class RespkgManager( object ):
     cur.execute( 'UPDATE "repos" SET "pub_key"="?" WHERE "name"="?";', ( name, pub_key ) )
 
     cur.close()
-    self.conn.commit()
+    self._commit()
 
-  def getPackageFile( self, repo_name, package_name, version=None ):
+  def _getRepo( self, repo_name ):
     cur = self.conn.cursor()
     cur.execute( 'SELECT "url", "component", "proxy", "pub_key" FROM "repos" WHERE "name" = ?;', ( repo_name, ) )
     try:
       ( repo_url, component, proxy, pub_key ) = cur.fetchone()
     except TypeError:
       print( 'Repo "{0}" not known.'.format( repo_name ) )
-      cur.close()
       return None
 
-    cur.close()
+    finally:
+      cur.close()
 
-    manafest = self._getManafest( repo_url, component, proxy )
+    return ( repo_url, component, proxy, pub_key )
+
+  def _downloadPackage( self, repo_url, manafest, proxy, package_name, installed=None ):  # installed is the getPackage of the package if a delta from it can be used
     try:
       package = manafest[ package_name ]
     except KeyError:
@@ -333,14 +810,72 @@ class RespkgManager( object ):
 
     version = max( package.keys() )
 
-    local_file = self._getPackageFile( repo_url, package[ version ][ 'path' ], proxy )
-    sha256 = hashlib.sha256()
-    sha256.update( open( local_file, 'rb' ).read() )
-    if package[ version ][ 'sha256' ] != sha256.hexdigest():
+    if installed and installed[ 'version' ] in package[ version ][ 'deltas' ]:
+      local_file = self._fetchPackage( repo_url, package[ version ][ 'deltas' ][ installed[ 'version' ] ], proxy )
+      if local_file is not None:
+        return local_file
+
+      print( 'Falling back to the full package' )
+
+    return self._fetchPackage( repo_url, package[ version ], proxy )
+
+  def _fetchPackage( self, repo_url, item, proxy ):  # item is { 'path', 'sha256' } from the manafest
+    cache_dir = self._packageCacheDir()
+    if cache_dir is not None:
+      cache_file = os.path.join( cache_dir, '{0}.respkg'.format( item[ 'sha256' ] ) )
+      with self._package_cache_lock:  # so it is not trimmed between checking for it and marking it in use
+        if os.path.isfile( cache_file ):
+          os.utime( cache_file )  # mtime is the last used time for trimming
+          self._package_cache_in_use[ cache_file ] = self._package_cache_in_use.get( cache_file, 0 ) + 1
+          return cache_file
+
+    download = self._getPackageFile( repo_url, item[ 'path' ], proxy, cache_dir )  # into the cache dir, so it can be renamed into place
+    if download is None:
+      return None
+
+    ( local_file, sha256 ) = download
+    if item[ 'sha256' ] != sha256:
       print( 'SHA256 of downloaded file dose not match manifest' )
+      os.unlink( local_file )
       return None
 
-    return local_file
+    if cache_dir is None:
+      return local_file
+
+    os.chmod( local_file, 0o644 )
+    with self._package_cache_lock:
+      os.replace( local_file, cache_file )
+      self._package_cache_in_use[ cache_file ] = self._package_cache_in_use.get( cache_file, 0 ) + 1
+
+    self._trimPackageCache( cache_dir )
+
+    return cache_file
+
+  def getPackageFile( self, repo_name, package_name, version=None ):
+    return self.getPackageFiles( repo_name, [ package_name ], 1 )[0]
+
+  # returns a list of local file names, in the same order as package_list, None for the ones that failed
+  # if target_dir is set, for packages allready installed there, a delta from the installed version is used if the repo has one
+  def getPackageFiles( self, repo_name, package_list, jobs=None, target_dir=None ):
+    repo = self._getRepo( repo_name )
+    if repo is None:
+      return [ None ] * len( package_list )
+
+    ( repo_url, component, proxy, _ ) = repo
+
+    manafest = self._getManafest( repo_url, component, proxy )
+    if manafest is None:
+      return [ None ] * len( package_list )
+
+    installed_map = {}  # the db connection can't be used from the download threads, so look these up first
+    if target_dir is not None:
+      for package_name in package_list:
+        installed = self.getPackage( package_name )
+        if installed and os.path.realpath( installed[ 'target_dir' ] ) == os.path.realpath( target_dir ):
+          installed_map[ package_name ] = installed
+
+    with ThreadPoolExecutor( max_workers=jobs or DOWNLOAD_JOBS ) as executor:
+      return list( executor.map( lambda package_name: self._downloadPackage( repo_url, manafest, proxy, package_name, installed_map.get( package_name ) ), package_list ) )
 
   def repoList( self ):
     result = {}
@@ -353,5 +888,15 @@ class RespkgManager( object ):
 
     return result
 
-  def getRepoPackages( self, name ):
-    pass
+  def getRepoPackages( self, name ):  # returns { package: [ versions ] } of what is in the repo, None if the repo or it's manifest is not available
+    repo = self._getRepo( name )
+    if repo is None:
+      return None
+
+    ( repo_url, component, proxy, _ ) = repo
+
+    manafest = self._getManafest( repo_url, component, proxy )
+    if manafest is None:
+      return None
+
+    return dict( [ ( package, sorted( manafest[ package ].keys() ) ) for package in manafest ] )
@@ -1,17 +1,80 @@
 import os
+import json
+import hashlib
+import time
+import shutil
 import sqlite3
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from respkg import manager
 
-TEST_DB_PATH = '/tmp/respkg_manager_test.db'
+TEST_DIR = '/tmp/respkg_manager_test'
+TEST_DB_PATH = os.path.join( TEST_DIR, 'manager.db' )
+TEST_REPO_DIR = '/tmp/respkg_manager_test_repo'
 
 
 def _init_workspace():
   manager.STATE_DB_FILE_NAME = TEST_DB_PATH
-  try:
-    os.unlink( TEST_DB_PATH )
-  except Exception:
+  shutil.rmtree( TEST_DIR, ignore_errors=True )  # the db and the manifest/package caches
+  os.makedirs( TEST_DIR )
+
+
+class _RepoHandler( SimpleHTTPRequestHandler ):
+  protocol_version = 'HTTP/1.1'
+  request_list = []
+  client_port_set = set()
+  flaky_set = set()  # paths that drop the connection half way though the first time they are requested
+
+  def __init__( self, *args, **kwargs ):
+    super().__init__( *args, directory=TEST_REPO_DIR, **kwargs )
+
+  def log_message( self, *args ):
     pass
 
+  def do_GET( self ):  # SimpleHTTPRequestHandler dosen't do Range requests
+    file_path = os.path.join( TEST_REPO_DIR, self.path.lstrip( '/' ) )
+    range_header = self.headers.get( 'Range' )
+    if ( range_header is None and self.path not in self.flaky_set ) or not os.path.isfile( file_path ):
+      return super().do_GET()
+
+    content = open( file_path, 'rb' ).read()
+    if range_header is None:
+      self.flaky_set.discard( self.path )
+      self.send_response( 200 )
+      self.send_header( 'Content-Length', str( len( content ) ) )
+      self.end_headers()
+      self.wfile.write( content[ :len( content ) // 2 ] )
+      self.close_connection = True
+      return
+
+    start = int( range_header.split( '=' )[1].rstrip( '-' ) )
+    self.send_response( 206 )
+    self.send_header( 'Content-Range', 'bytes {0}-{1}/{2}'.format( start, len( content ) - 1, len( content ) ) )
+    self.send_header( 'Content-Length', str( len( content ) - start ) )
+    self.end_headers()
+    self.wfile.write( content[ start: ] )
+
+  def send_response( self, code, message=None ):
+    self.request_list.append( ( self.path, code ) )
+    self.client_port_set.add( self.client_address[1] )
+    super().send_response( code, message )
+
+
+def _start_repo( manifest, file_map=None ):
+  shutil.rmtree( TEST_REPO_DIR, ignore_errors=True )
+  os.makedirs( os.path.join( TEST_REPO_DIR, '_repo_main' ) )
+  open( os.path.join( TEST_REPO_DIR, '_repo_main', 'MANIFEST_all.json' ), 'w' ).write( json.dumps( manifest ) )
+  for ( file_name, content ) in ( file_map or {} ).items():
+    open( os.path.join( TEST_REPO_DIR, file_name ), 'wb' ).write( content )
+
+  _RepoHandler.request_list = []
+  _RepoHandler.client_port_set = set()
+  _RepoHandler.flaky_set = set()
+  server = ThreadingHTTPServer( ( '127.0.0.1', 0 ), _RepoHandler )
+  threading.Thread( target=server.serve_forever, daemon=True ).start()
+
+  return server, 'http://127.0.0.1:{0}/'.format( server.server_address[1] )
+
 
 def _dump_tables():
   conn = sqlite3.connect( TEST_DB_PATH )
@@ -56,14 +119,14 @@ CREATE TABLE "conflicts" (
       "modified" datetime DEFAULT CURRENT_TIMESTAMP
     );
 CREATE TABLE "control" ( "key" text, "value" text );
-INSERT INTO "control" VALUES('version','2');
+INSERT INTO "control" VALUES('version','6');
 CREATE TABLE "files" (
       "package" char(50) NOT NULL,
       "file_path" char(512) NOT NULL UNIQUE,
       "sha256" char(65) NOT NULL,
       "created" datetime DEFAULT CURRENT_TIMESTAMP,
       "modified" datetime DEFAULT CURRENT_TIMESTAMP
-    );
+    , "size" integer, "mtime" integer, "inode" integer);
 CREATE TABLE "packages" (
       "package" char(50) NOT NULL UNIQUE,
       "version" char(20) NOT NULL,
@@ -89,8 +152,62 @@ CREATE TABLE "repos" (
       "created" datetime DEFAULT CURRENT_TIMESTAMP,
       "modified" datetime DEFAULT CURRENT_TIMESTAMP
     );
+CREATE TABLE "transaction_actions" (
+      "transaction" integer NOT NULL,
+      "action" char(10) NOT NULL,
+      "file_path" char(512) NOT NULL
+    );
+CREATE TABLE "transactions" (
+      "id" integer PRIMARY KEY,
+      "package" char(50) NOT NULL,
+      "version" char(20) NOT NULL,
+      "target_dir" char(200) NOT NULL,
+      "backup_dir" char(512),
+      "state" char(20) NOT NULL,
+      "prev_state" text,
+      "created" datetime DEFAULT CURRENT_TIMESTAMP,
+      "modified" datetime DEFAULT CURRENT_TIMESTAMP
+    );
+CREATE INDEX "files_package" ON "files" ( "package" );
+CREATE INDEX "conflicts_with" ON "conflicts" ( "with" );
+CREATE INDEX "conflicts_package" ON "conflicts" ( "package" );
+CREATE INDEX "provides_package" ON "provides" ( "package" );
+CREATE INDEX "provides_target" ON "provides" ( "target" );
+CREATE INDEX "transactions_package" ON "transactions" ( "package" );
+CREATE INDEX "transaction_actions_transaction" ON "transaction_actions" ( "transaction" );
+CREATE INDEX "files_sha256" ON "files" ( "sha256" );
 COMMIT;"""
 
+  conn = sqlite3.connect( TEST_DB_PATH )
+  ( journal_mode, ) = conn.execute( 'PRAGMA journal_mode;' ).fetchone()
+  conn.close()
+  assert journal_mode == 'wal'
+
+
+def test_upgradefromv2():
+  _init_workspace()
+  conn = sqlite3.connect( TEST_DB_PATH )  # what a version 2 database looked like
+  conn.execute( 'CREATE TABLE "control" ( "key" text, "value" text );' )
+  conn.execute( 'INSERT INTO "control" VALUES ( "version", "2" );' )
+  conn.execute( 'CREATE TABLE "packages" ( "package" char(50) NOT NULL UNIQUE, "version" char(20) NOT NULL, "target_dir" char(200) NOT NULL, "description" char(250), "installed" datetime, "pkg_created" datetime, "created" datetime DEFAULT CURRENT_TIMESTAMP, "modified" datetime DEFAULT CURRENT_TIMESTAMP );' )
+  conn.execute( 'CREATE TABLE "repos" ( "name" char(50) NOT NULL UNIQUE, "url" char(200) NOT NULL, "component" char(50) NOT NULL, "proxy" char(200), "pub_key" text, "created" datetime DEFAULT CURRENT_TIMESTAMP, "modified" datetime DEFAULT CURRENT_TIMESTAMP );' )
+  conn.execute( 'CREATE TABLE "files" ( "package" char(50) NOT NULL, "file_path" char(512) NOT NULL UNIQUE, "sha256" char(65) NOT NULL, "created" datetime DEFAULT CURRENT_TIMESTAMP, "modified" datetime DEFAULT CURRENT_TIMESTAMP );' )
+  conn.execute( 'CREATE TABLE "conflicts" ( "package" char(50) NOT NULL, "with" char(50) NOT NULL, "created" datetime DEFAULT CURRENT_TIMESTAMP, "modified" datetime DEFAULT CURRENT_TIMESTAMP );' )
+  conn.execute( 'CREATE TABLE "provides" ( "package" char(50) NOT NULL, "target" char(50) NOT NULL, "created" datetime DEFAULT CURRENT_TIMESTAMP, "modified" datetime DEFAULT CURRENT_TIMESTAMP );' )
+  conn.execute( 'INSERT INTO "packages" ( "package", "version", "target_dir" ) VALUES ( "thepackage", "1.0-1", "/" );' )
+  conn.execute( 'INSERT INTO "files" ( "package", "file_path", "sha256" ) VALUES ( "thepackage", "/tmp/thepackage_file_1", "1111" );' )
+  conn.commit()
+  conn.close()
+
+  rmgr = manager.RespkgManager()
+  assert rmgr.getInstalledFiles() == [ '/tmp/thepackage_file_1' ]
+  assert rmgr.getFileSignatures() == { '/tmp/thepackage_file_1': ( '1111', None, None, None ) }
+
+  conn = sqlite3.connect( TEST_DB_PATH )
+  assert conn.execute( 'SELECT "value" FROM "control" WHERE "key" = "version";' ).fetchone() == ( '6', )
+  assert [ i[0] for i in conn.execute( 'SELECT "name" FROM "sqlite_master" WHERE "type" = \'index\' AND "sql" IS NOT NULL ORDER BY "name";' ).fetchall() ] == [ 'conflicts_package', 'conflicts_with', 'files_package', 'files_sha256', 'provides_package', 'provides_target', 'transaction_actions_transaction', 'transactions_package' ]
+  conn.close()
+
 
 def test_installing():
   _init_workspace()
@@ -182,6 +299,90 @@ def test_installing():
   assert rmgr.getInstalledFiles() == [ '/tmp/otherpackage_a_file', '/tmp/otherpackage_z_file', '/tmp/thepackage_file_1', '/tmp/thepackage_file_2' ]
 
 
+def test_filesums():
+  _init_workspace()
+  rmgr = manager.RespkgManager()
+
+  rmgr.setFileSums( 'thepackage', [ ( '/tmp/thepackage_file_1', '1111' ), ( '/tmp/thepackage_file_2', '2222' ) ] )
+  assert _dump_tables()[ 'files' ] == [ ( 'thepackage', '/tmp/thepackage_file_1', '1111' ), ( 'thepackage', '/tmp/thepackage_file_2', '2222' ) ]
+
+  rmgr.setFileSums( 'thepackage', iter( [ ( '/tmp/thepackage_file_2', '2323' ), ( '/tmp/thepackage_file_3', '3333' ) ] ) )
+  assert _dump_tables()[ 'files' ] == [ ( 'thepackage', '/tmp/thepackage_file_1', '1111' ), ( 'thepackage', '/tmp/thepackage_file_2', '2323' ), ( 'thepackage', '/tmp/thepackage_file_3', '3333' ) ]
+
+  rmgr.setFileSums( 'thepackage', [] )
+  assert len( _dump_tables()[ 'files' ] ) == 3
+
+  rmgr.removeFileSums( 'thepackage', [ '/tmp/thepackage_file_1', '/tmp/thepackage_file_4' ] )
+  rmgr.removeFileSums( 'otherpackage', [ '/tmp/thepackage_file_2' ] )
+  assert _dump_tables()[ 'files' ] == [ ( 'thepackage', '/tmp/thepackage_file_2', '2323' ), ( 'thepackage', '/tmp/thepackage_file_3', '3333' ) ]
+
+
+def test_fileoverlaps():
+  _init_workspace()
+  rmgr = manager.RespkgManager()
+
+  assert rmgr.getFileOverlaps( 'thepackage', [] ) == {}
+  assert rmgr.getFileOverlaps( 'thepackage', [ '/tmp/thepackage_file_1' ] ) == {}
+
+  rmgr.setFileSums( 'thepackage', [ ( '/tmp/thepackage_file_1', '1111' ), ( '/tmp/thepackage_file_2', '2222' ) ] )
+  rmgr.setFileSums( 'otherpackage', [ ( '/tmp/otherpackage_file_1', '3333' ) ] )
+
+  assert rmgr.getFileOverlaps( 'thepackage', [ '/tmp/thepackage_file_1', '/tmp/thepackage_file_3' ] ) == {}
+  assert rmgr.getFileOverlaps( 'newpackage', [ '/tmp/thepackage_file_1', '/tmp/thepackage_file_3' ] ) == { '/tmp/thepackage_file_1': 'thepackage' }
+  assert rmgr.getFileOverlaps( 'newpackage', [ '/tmp/new_file' ] ) == {}
+  assert rmgr.getFileOverlaps( 'thepackage', iter( [ '/tmp/thepackage_file_2', '/tmp/otherpackage_file_1' ] ) ) == { '/tmp/otherpackage_file_1': 'otherpackage' }
+  assert rmgr.getFileOverlaps( 'newpackage', [ '/tmp/thepackage_file_2', '/tmp/otherpackage_file_1' ] ) == { '/tmp/thepackage_file_2': 'thepackage', '/tmp/otherpackage_file_1': 'otherpackage' }
+
+
+def test_filechecksums():
+  _init_workspace()
+  rmgr = manager.RespkgManager()
+
+  rmgr.packageInstalled( 'thepackage', '1.0-1', 'the test package', 0, '/', [], [] )
+  rmgr.packageInstalled( 'otherpackage', '1.0-1', 'the other test package', 0, '/', [], [] )
+  rmgr.setFileSums( 'thepackage', [ ( '/tmp/thepackage_file_1', '1111' ), ( '/tmp/thepackage_file_2', '2222' ) ] )
+  rmgr.setFileSums( 'otherpackage', [ ( '/tmp/otherpackage_file_1', '3333' ) ] )
+
+  assert rmgr.getFileChecksums() == { '/tmp/thepackage_file_1': '1111', '/tmp/thepackage_file_2': '2222', '/tmp/otherpackage_file_1': '3333' }
+  assert rmgr.getFileChecksums( [ 'otherpackage' ] ) == { '/tmp/otherpackage_file_1': '3333' }
+  assert rmgr.getFileChecksums( [ 'otherpackage', 'thepackage' ] ) == { '/tmp/thepackage_file_1': '1111', '/tmp/thepackage_file_2': '2222', '/tmp/otherpackage_file_1': '3333' }
+  assert rmgr.getFileChecksums( [ 'nopackage' ] ) == {}
+
+  rmgr.setFileSums( 'otherpackage', [ ( '/tmp/otherpackage_file_1', '3434', 10, 1234567890123456789, 1000 ) ] )
+  assert rmgr.getFileSignatures( [ 'otherpackage' ] ) == { '/tmp/otherpackage_file_1': ( '3434', 10, 1234567890123456789, 1000 ) }
+  assert rmgr.getFileSignatures( [ 'thepackage' ] ) == { '/tmp/thepackage_file_1': ( '1111', None, None, None ), '/tmp/thepackage_file_2': ( '2222', None, None, None ) }
+
+
+def test_transaction():
+  _init_workspace()
+  rmgr = manager.RespkgManager()
+
+  with rmgr.transaction():
+    rmgr.setFileSums( 'thepackage', [ ( '/tmp/thepackage_file_1', '1111' ) ] )
+    rmgr.packageInstalled( 'thepackage', '1.0-1', 'the test package', 0, '/', [ 'conflict1' ], [ 'provide1' ] )
+    assert _dump_tables()[ 'packages' ] == []  # not commited yet
+
+  assert _dump_tables() == { 'conflicts': [ ( 'thepackage', 'conflict1' ) ],
+                             'files': [ ( 'thepackage', '/tmp/thepackage_file_1', '1111' ) ],
+                             'packages': [ ( 'thepackage', '1.0-1', '/', 'the test package', 0 ) ],
+                             'provides': [ ( 'thepackage', 'provide1' ) ],
+                             'repos': [] }
+
+  try:
+    with rmgr.transaction():
+      rmgr.setFileSums( 'otherpackage', [ ( '/tmp/otherpackage_file_1', '2222' ) ] )
+      rmgr.packageInstalled( 'otherpackage', '1.0-1', 'the other test package', 0, '/', [], [] )
+      raise ValueError( 'stop' )
+  except ValueError:
+    pass
+
+  assert _dump_tables() == { 'conflicts': [ ( 'thepackage', 'conflict1' ) ],
+                             'files': [ ( 'thepackage', '/tmp/thepackage_file_1', '1111' ) ],
+                             'packages': [ ( 'thepackage', '1.0-1', '/', 'the test package', 0 ) ],
+                             'provides': [ ( 'thepackage', 'provide1' ) ],
+                             'repos': [] }
+
+
 def test_conflicts():
   _init_workspace()
   rmgr = manager.RespkgManager()
@@ -238,5 +439,216 @@ def test_depends():
   assert rmgr.checkDepends( 'newpkg', [ 'provide2', 'oprov1' ] ) is True
 
 
+def test_state():
+  _init_workspace()
+  rmgr = manager.RespkgManager()
+
+  assert rmgr.getState() == { 'installed': {}, 'provides': {}, 'conflicts': {} }
+
+  rmgr.packageInstalled( 'thepackage', '1.0-1', 'the test package', 0, '/', [ 'conflict1', 'conflict2' ], [ 'provide1' ] )
+  rmgr.packageInstalled( 'otherpackage', '2.0-1', 'the other test package', 0, '/', [], [ 'oprov1', 'oprov2' ] )
+
+  state = rmgr.getState()
+  assert state[ 'installed' ] == { 'thepackage': '1.0-1', 'otherpackage': '2.0-1' }
+  assert sorted( state[ 'provides' ][ 'otherpackage' ] ) == [ 'oprov1', 'oprov2' ]
+  assert state[ 'provides' ][ 'thepackage' ] == [ 'provide1' ]
+  assert sorted( state[ 'conflicts' ][ 'thepackage' ] ) == [ 'conflict1', 'conflict2' ]
+  assert 'otherpackage' not in state[ 'conflicts' ]
+
+
 def test_repos():
   _init_workspace()
+
+
+def test_manifestcache():
+  _init_workspace()
+  ( server, url ) = _start_repo( { 'thepackage': [ { 'type': 'respkg', 'version': '1.0', 'path': 'thepackage_1.0.respkg', 'sha256': '1111' } ] } )
+  manifest_path = '/_repo_main/MANIFEST_all.json'
+  try:
+    rmgr = manager.RespkgManager()
+    expected = { 'thepackage': { '1.0': { 'path': 'thepackage_1.0.respkg', 'sha256': '1111', 'deltas': {} } } }
+    assert rmgr._getManafest( url, 'main', None ) == expected
+    assert rmgr._getManafest( url, 'main', None ) == expected
+    assert _RepoHandler.request_list == [ ( manifest_path, 200 ) ]  # once per process
+
+    rmgr = manager.RespkgManager()
+    assert rmgr._getManafest( url, 'main', None ) == expected
+    assert _RepoHandler.request_list == [ ( manifest_path, 200 ) ]  # from the disk cache
+
+    rmgr = manager.RespkgManager()
+    rmgr.refresh_manifests = True
+    assert rmgr._getManafest( url, 'main', None ) == expected
+    assert _RepoHandler.request_list == [ ( manifest_path, 200 ), ( manifest_path, 304 ) ]  # revalidated, not modified
+
+    rmgr = manager.RespkgManager()
+    rmgr.manifest_ttl = 0
+    assert rmgr._getManafest( url, 'main', None ) == expected
+    assert _RepoHandler.request_list == [ ( manifest_path, 200 ), ( manifest_path, 304 ), ( manifest_path, 304 ) ]
+
+    assert rmgr._getManafest( url, 'other', None ) is None
+    assert _RepoHandler.request_list[ -1 ] == ( '/_repo_other/MANIFEST_all.json', 404 )
+
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_download():
+  _init_workspace()
+  content_map = { 'thepackage_1.0.respkg': b'the package' * 1000, 'otherpackage_2.0.respkg': b'the other package' * 1000, 'badpackage_1.0.respkg': b'bad' }
+  manifest = { 'thepackage': [ { 'type': 'respkg', 'version': '1.0', 'path': 'thepackage_1.0.respkg', 'sha256': hashlib.sha256( content_map[ 'thepackage_1.0.respkg' ] ).hexdigest() } ],
+               'otherpackage': [ { 'type': 'respkg', 'version': '2.0', 'path': 'otherpackage_2.0.respkg', 'sha256': hashlib.sha256( content_map[ 'otherpackage_2.0.respkg' ] ).hexdigest() } ],
+               'badpackage': [ { 'type': 'respkg', 'version': '1.0', 'path': 'badpackage_1.0.respkg', 'sha256': '0000' } ] }
+  ( server, url ) = _start_repo( manifest, content_map )
+  try:
+    rmgr = manager.RespkgManager()
+    rmgr.package_cache_size = 0
+    rmgr.addRepo( 'repo', url, 'main', None )
+
+    file_list = rmgr.getPackageFiles( 'repo', [ 'thepackage', 'otherpackage', 'thepackage' ], 1 )
+    assert len( set( file_list ) ) == 3  # each download gets it's own file
+    assert [ open( i, 'rb' ).read() for i in file_list ] == [ content_map[ 'thepackage_1.0.respkg' ], content_map[ 'otherpackage_2.0.respkg' ], content_map[ 'thepackage_1.0.respkg' ] ]
+    assert len( _RepoHandler.client_port_set ) == 1  # all over the one connection
+    for file_name in file_list:
+      os.unlink( file_name )
+
+    file_list = rmgr.getPackageFiles( 'repo', [ 'thepackage', 'badpackage', 'nopackage', 'otherpackage' ], 4 )
+    assert file_list[1:3] == [ None, None ]
+    assert open( file_list[0], 'rb' ).read() == content_map[ 'thepackage_1.0.respkg' ]
+    assert open( file_list[3], 'rb' ).read() == content_map[ 'otherpackage_2.0.respkg' ]
+    for file_name in ( file_list[0], file_list[3] ):
+      os.unlink( file_name )
+
+    assert rmgr.getPackageFiles( 'norepo', [ 'thepackage' ] ) == [ None ]
+
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_downloadresume():
+  _init_workspace()
+  content = os.urandom( 300000 )
+  manifest = { 'thepackage': [ { 'type': 'respkg', 'version': '1.0', 'path': 'thepackage_1.0.respkg', 'sha256': hashlib.sha256( content ).hexdigest() } ] }
+  ( server, url ) = _start_repo( manifest, { 'thepackage_1.0.respkg': content } )
+  _RepoHandler.flaky_set.add( '/thepackage_1.0.respkg' )
+  try:
+    rmgr = manager.RespkgManager()
+    rmgr.package_cache_size = 0
+    rmgr.download_buffer_size = 4096
+    rmgr.addRepo( 'repo', url, 'main', None )
+
+    file_name = rmgr.getPackageFile( 'repo', 'thepackage' )
+    assert open( file_name, 'rb' ).read() == content
+    os.unlink( file_name )
+    assert _RepoHandler.request_list[ -2: ] == [ ( '/thepackage_1.0.respkg', 200 ), ( '/thepackage_1.0.respkg', 206 ) ]
+
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_packagecache():
+  _init_workspace()
+  content_map = { 'thepackage_1.0.respkg': b'1' * 1000, 'thepackage_2.0.respkg': b'2' * 1000, 'otherpackage_1.0.respkg': b'3' * 1000 }
+  manifest = { 'thepackage': [ { 'type': 'respkg', 'version': '1.0', 'path': 'thepackage_1.0.respkg', 'sha256': hashlib.sha256( content_map[ 'thepackage_1.0.respkg' ] ).hexdigest() } ],
+               'otherpackage': [ { 'type': 'respkg', 'version': '1.0', 'path': 'otherpackage_1.0.respkg', 'sha256': hashlib.sha256( content_map[ 'otherpackage_1.0.respkg' ] ).hexdigest() } ] }
+  ( server, url ) = _start_repo( manifest, content_map )
+  cache_dir = os.path.join( TEST_DIR, manager.PACKAGE_CACHE_DIR_NAME )
+  try:
+    rmgr = manager.RespkgManager()
+    rmgr.package_cache_size = 2500
+    rmgr.addRepo( 'repo', url, 'main', None )
+
+    file_name = rmgr.getPackageFile( 'repo', 'thepackage' )
+    assert file_name == os.path.join( cache_dir, '{0}.respkg'.format( manifest[ 'thepackage' ][0][ 'sha256' ] ) )
+    assert open( file_name, 'rb' ).read() == content_map[ 'thepackage_1.0.respkg' ]
+    assert rmgr.isCachedPackageFile( file_name )
+    rmgr.releasePackageFile( file_name )
+    assert os.path.isfile( file_name )
+
+    request_count = len( _RepoHandler.request_list )
+    assert rmgr.getPackageFile( 'repo', 'thepackage' ) == file_name
+    assert len( _RepoHandler.request_list ) == request_count  # no network
+
+    os.utime( file_name, ( 1000, 1000 ) )  # make it the oldest
+    stale_file = os.path.join( cache_dir, 'respkgdownload.stale.respkg' )  # left by a killed download
+    open( stale_file, 'wb' ).write( b'partial' )
+    os.utime( stale_file, ( 1000, 1000 ) )
+    active_file = os.path.join( cache_dir, 'respkgdownload.active.respkg' )  # still being written to
+    open( active_file, 'wb' ).write( b'partial' )
+    other_file_name = rmgr.getPackageFile( 'repo', 'otherpackage' )
+    assert sorted( os.listdir( cache_dir ) ) == sorted( [ os.path.basename( file_name ), os.path.basename( other_file_name ), os.path.basename( active_file ) ] )
+    os.unlink( active_file )
+
+    manifest[ 'thepackage' ].append( { 'type': 'respkg', 'version': '2.0', 'path': 'thepackage_2.0.respkg', 'sha256': hashlib.sha256( content_map[ 'thepackage_2.0.respkg' ] ).hexdigest() } )
+    open( os.path.join( TEST_REPO_DIR, '_repo_main', 'MANIFEST_all.json' ), 'w' ).write( json.dumps( manifest ) )
+    os.utime( os.path.join( TEST_REPO_DIR, '_repo_main', 'MANIFEST_all.json' ), ( time.time() + 10, time.time() + 10 ) )  # so If-Modified-Since sees the change
+    rmgr = manager.RespkgManager()
+    rmgr.package_cache_size = 2500
+    rmgr.refresh_manifests = True
+    new_file_name = rmgr.getPackageFile( 'repo', 'thepackage' )
+    assert open( new_file_name, 'rb' ).read() == content_map[ 'thepackage_2.0.respkg' ]
+    assert sorted( os.listdir( cache_dir ) ) == sorted( [ os.path.basename( new_file_name ), os.path.basename( other_file_name ) ] )  # the least recently used was removed
+
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_packagecache_batch():  # a batch bigger than the cache, nothing handed out is removed until it is released
+  _init_workspace()
+  content_map = dict( [ ( 'package{0}_1.0.respkg'.format( i ), str( i ).encode() * 1000 ) for i in range( 3 ) ] )
+  manifest = dict( [ ( 'package{0}'.format( i ), [ { 'type': 'respkg', 'version': '1.0', 'path': 'package{0}_1.0.respkg'.format( i ), 'sha256': hashlib.sha256( content_map[ 'package{0}_1.0.respkg'.format( i ) ] ).hexdigest() } ] ) for i in range( 3 ) ] )
+  ( server, url ) = _start_repo( manifest, content_map )
+  cache_dir = os.path.join( TEST_DIR, manager.PACKAGE_CACHE_DIR_NAME )
+  try:
+    rmgr = manager.RespkgManager()
+    rmgr.package_cache_size = 2500
+    rmgr.addRepo( 'repo', url, 'main', None )
+
+    file_list = rmgr.getPackageFiles( 'repo', [ 'package0', 'package1', 'package2' ], 1 )
+    for ( i, file_name ) in enumerate( file_list ):
+      assert open( file_name, 'rb' ).read() == content_map[ 'package{0}_1.0.respkg'.format( i ) ]
+
+    for file_name in file_list:
+      rmgr.releasePackageFile( file_name )
+
+    assert len( os.listdir( cache_dir ) ) == 2  # trimmed back to the size once released
+
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_downloaddelta():
+  _init_workspace()
+  content_map = { 'thepackage_2.0.respkg': b'full' * 1000, 'thepackage_1.0_2.0.respkg': b'delta', 'otherpackage_2.0.respkg': b'other' * 1000, 'otherpackage_1.0_2.0.respkg': b'bad' }
+  manifest = { 'thepackage': [ { 'type': 'respkg', 'version': '2.0', 'path': 'thepackage_2.0.respkg', 'sha256': hashlib.sha256( content_map[ 'thepackage_2.0.respkg' ] ).hexdigest() },
+                               { 'type': 'respkg-delta', 'version': '2.0', 'delta_from': '1.0', 'path': 'thepackage_1.0_2.0.respkg', 'sha256': hashlib.sha256( b'delta' ).hexdigest() } ],
+               'otherpackage': [ { 'type': 'respkg-delta', 'version': '2.0', 'delta_from': '1.0', 'path': 'otherpackage_1.0_2.0.respkg', 'sha256': '0000' },
+                                 { 'type': 'respkg', 'version': '2.0', 'path': 'otherpackage_2.0.respkg', 'sha256': hashlib.sha256( content_map[ 'otherpackage_2.0.respkg' ] ).hexdigest() } ] }
+  ( server, url ) = _start_repo( manifest, content_map )
+  try:
+    rmgr = manager.RespkgManager()
+    rmgr.package_cache_size = 0
+    rmgr.addRepo( 'repo', url, 'main', None )
+
+    assert rmgr.getRepoPackages( 'repo' ) == { 'thepackage': [ '2.0' ], 'otherpackage': [ '2.0' ] }
+    assert rmgr.getRepoPackages( 'norepo' ) is None
+
+    file_list = rmgr.getPackageFiles( 'repo', [ 'thepackage' ], 1, '/tmp' )  # not installed, full package
+    assert open( file_list[0], 'rb' ).read() == content_map[ 'thepackage_2.0.respkg' ]
+
+    rmgr.packageInstalled( 'thepackage', '1.0', 'the package', '2020-01-01', '/tmp', [], [] )
+    rmgr.packageInstalled( 'otherpackage', '1.0', 'the other package', '2020-01-01', '/tmp', [], [] )
+    file_list = rmgr.getPackageFiles( 'repo', [ 'thepackage', 'otherpackage' ], 1, '/tmp' )
+    assert open( file_list[0], 'rb' ).read() == b'delta'
+    assert open( file_list[1], 'rb' ).read() == content_map[ 'otherpackage_2.0.respkg' ]  # delta is bad, falls back
+
+    file_list = rmgr.getPackageFiles( 'repo', [ 'thepackage' ], 1, '/var' )  # installed somewhere else
+    assert open( file_list[0], 'rb' ).read() == content_map[ 'thepackage_2.0.respkg' ]
+
+  finally:
+    server.shutdown()
+    server.server_close()
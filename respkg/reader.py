@@ -1,16 +1,175 @@
 import os
+import pwd
+import grp
 import json
+import shutil
+import hashlib
+import tempfile
 from datetime import datetime
-from gzip import GzipFile
 from tarfile import TarFile
 
+from respkg.compression import detectCodec, openReader
+from respkg.verifier import hashLink
+
+SPOOL_BUFFER_SIZE = 1024 * 1024
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+SUPPORTED_VERSIONS = ( '1', '2' )
+RECORDED_TYPES = ( 'file', 'link', 'symlink' )  # the member types extract() passes to cb, what is recorded for a package
+
+
+class _Section( object ):  # read only view of length bytes of fileobj, starting at offset
+  def __init__( self, fileobj, offset, length ):
+    self.fileobj = fileobj
+    self.position = offset
+    self.end = offset + length
+
+  def read( self, size=-1 ):
+    remaining = self.end - self.position
+    if size is None or size < 0 or size > remaining:
+      size = remaining
+
+    self.fileobj.seek( self.position )
+    buff = self.fileobj.read( size )
+    self.position += len( buff )
+    return buff
+
+  def close( self ):
+    pass
+
 
 class RespkgReader( object ):
-  def __init__( self, file_name ):
-    tar = GzipFile( file_name, 'r' )
-    self.source = TarFile( fileobj=tar )
+  # respkg_version 1: a compressed tar of CONTROL, INIT and DATA, DATA is an uncompressed tar of the contents
+  #   the outer archive is read as a stream, CONTROL and INIT are at the front, so loading them does not
+  #   require decompressing DATA.  DATA is spooled to a temp file the first time it is needed, that way the
+  #   package is only decompressed once, and listing/extracting can seek around the spooled copy.
+  # respkg_version 2: an uncompressed tar of CONTROL, INDEX, INIT and DATA, DATA is each file compressed on
+  #   it's own, one after the other.  INDEX has the metadata, sha256 and location in DATA of each file, so
+  #   listing does not touch DATA, and any one file can be read without reading the rest.
+  # For version 1, with keep_data_file DATA is spooled to a named file that is left after close, data_file_name is it's name, so
+  # another reader of the same package (ie: in another process) can be given it as data_file_name instead of spooling DATA again.
+  # Removing the file is up to the caller.
+  def __init__( self, file_name, tmp_dir=None, data_file_name=None, keep_data_file=False ):
+    self._file = open( file_name, 'rb' )
+    self.tmp_dir = tmp_dir
+    self.data_file_name = data_file_name
+    self.keep_data_file = keep_data_file
+    self.control = None
+    self.init = None
+    self.index = None
+    self.checksums = None
+    self._data_member = None
+    self._data_file = None
+    self._data_tar = None
+    self._random_access = detectCodec( self._file ) == 'none'
+
+    if self._random_access:
+      self._openRandomAccess()
+    else:
+      self._openStream()
+
+    if self.control is None:
+      raise ValueError( 'CONTROL not found in package' )
+
+    if self.format_version not in SUPPORTED_VERSIONS:
+      raise ValueError( 'Unsupported respkg version "{0}"'.format( self.format_version ) )
+
+  def _openStream( self ):
+    self.source = TarFile.open( fileobj=openReader( self._file ), mode='r|' )  # compression is detected from the file
+    for member in self.source:
+      if member.name == './CONTROL':
+        self.control = json.loads( self.source.extractfile( member ).read().decode() )
+
+      elif member.name == './INIT':
+        self.init = self.source.extractfile( member ).read().decode()
+
+      elif member.name == './CHECKSUMS':
+        self.checksums = json.loads( self.source.extractfile( member ).read().decode() )
+
+      elif member.name == './DATA':
+        self._data_member = member
+        if self.control is not None:
+          break
+
+        self._spoolData()  # not where we expect it, have to spool it now before we move past it, CONTROL is still to come
+
+    if self._data_tar is not None:  # spooled, nothing left to read from the package
+      self._closeSource()
+
+  def _openRandomAccess( self ):
+    self.source = TarFile( fileobj=self._file )
+    try:
+      self.control = json.loads( self.source.extractfile( './CONTROL' ).read().decode() )
+    except KeyError:
+      return
+
+    try:
+      self.init = self.source.extractfile( './INIT' ).read().decode()
+    except KeyError:
+      pass
+
+    try:
+      self._data_member = self.source.getmember( './DATA' )
+    except KeyError:
+      pass
 
-    self.control = json.loads( self.source.extractfile( './CONTROL' ).read().decode() )
+    if self.format_version == '2':
+      self.index = json.loads( self.source.extractfile( './INDEX' ).read().decode() )
+      self.checksums = dict( [ ( entry[ 'name' ], entry[ 'sha256' ] ) for entry in self.index if entry[ 'type' ] == 'file' ] )
+
+    else:
+      try:
+        self.checksums = json.loads( self.source.extractfile( './CHECKSUMS' ).read().decode() )
+      except KeyError:
+        pass
+
+  def _spoolData( self ):
+    if self._data_member is None:
+      raise ValueError( 'DATA not found in package' )
+
+    if self.data_file_name is not None:  # allready spooled by another reader
+      self._data_file = open( self.data_file_name, 'rb' )
+
+    else:
+      if self.keep_data_file:
+        ( fd, self.data_file_name ) = tempfile.mkstemp( prefix='respkgdata.', dir=self.tmp_dir )
+        self._data_file = os.fdopen( fd, 'w+b' )
+      else:
+        self._data_file = tempfile.TemporaryFile( dir=self.tmp_dir )
+
+      shutil.copyfileobj( self.source.extractfile( self._data_member ), self._data_file, SPOOL_BUFFER_SIZE )
+      self._data_file.seek( 0 )
+
+    self._data_tar = TarFile( fileobj=self._data_file )
+
+  def _closeSource( self ):
+    self.source.close()
+    self._file.close()
+
+  def _getDataTar( self ):
+    if self._data_tar is None:
+      if self._random_access:
+        if self._data_member is None:
+          raise ValueError( 'DATA not found in package' )
+
+        self._data_tar = TarFile( fileobj=self.source.extractfile( self._data_member ) )  # uncompressed, no need to spool it
+
+      else:
+        self._spoolData()
+        self._closeSource()
+
+    return self._data_tar
+
+  def close( self ):
+    self._closeSource()
+    if self._data_tar is not None:
+      self._data_tar.close()
+
+    if self._data_file is not None:
+      self._data_file.close()
+
+  @property
+  def format_version( self ):
+    return self.control.get( 'respkg_version', '1' )
 
   @property
   def name( self ):
@@ -40,26 +199,238 @@ class RespkgReader( object ):
   def provides( self ):
     return self.control.get( 'provides', [] )
 
+  @property
+  def delta_from( self ):  # the version this is a delta from, None if this is a full package
+    return self.control.get( 'delta_from', None )
+
+  @property
+  def removed( self ):  # for deltas, the files in delta_from that are not in this version
+    return self.control.get( 'removed', [] )
+
   def readInit( self ):
+    return self.init
+
+  # list of the members, each a dict of name, type, mode, mtime, uid, gid, uname, gname, linkname, size, offset, length and sha256
+  # offset, length and sha256 are None for version 1 packages
+  def getIndex( self ):
+    if self.index is not None:
+      return self.index
+
+    result = []
+    for member in self._getDataTar().getmembers():  # the member index is built once, from the headers of the spooled DATA
+      if member.name in ( '/', '' ):
+        continue
+
+      if member.isfile():
+        member_type = 'file'
+      elif member.isdir():
+        member_type = 'dir'
+      elif member.issym():
+        member_type = 'symlink'
+      elif member.islnk():
+        member_type = 'link'
+      elif member.isfifo():
+        member_type = 'fifo'
+      else:
+        member_type = 'other'
+
+      result.append( { 'name': member.name, 'type': member_type, 'mode': member.mode, 'mtime': member.mtime, 'uid': member.uid, 'gid': member.gid,
+                       'uname': member.uname, 'gname': member.gname, 'linkname': member.linkname, 'size': member.size,
+                       'offset': None, 'length': None, 'sha256': None } )
+
+    return result
+
+  def getChecksums( self ):  # { name: sha256 } as computed when the package was built, empty for packages built before checksums were included
+    return self.checksums or {}
+
+  def getFileList( self ):
+    return [ entry[ 'name' ] for entry in self.getIndex() if entry[ 'type' ] == 'file' ]
+
+  def readFile( self, name ):  # returns a file like object of the contents of the file name
+    if self.index is None:
+      return self._getDataTar().extractfile( name )
+
+    for entry in self.index:
+      if entry[ 'name' ] == name and entry[ 'type' ] == 'file':
+        return self._readEntry( entry )
+
+    raise KeyError( 'File "{0}" not found in package'.format( name ) )
+
+  def _readEntry( self, entry ):
+    return openReader( _Section( self._file, self._data_member.offset_data + entry[ 'offset' ], entry[ 'length' ] ), self.control[ 'compression' ] )
+
+  # write the file while hashing it, so it dosen't have to be re-read to get the checksum.  It is written to a temp file next to
+  # target_path that replaces it only once the checksum matches, so a corrupt package never leaves a bad file in place, that also
+  # means hardlinks to the old file (that may not be ours) are not written through
+  def _writeFile( self, source, name, target_path ):
+    upper_dirs = os.path.dirname( target_path )
+    if upper_dirs:
+      os.makedirs( upper_dirs, exist_ok=True )  # exist_ok, other packages may be extracting into the same directories at the same time
+
+    ( fd, tmp_path ) = tempfile.mkstemp( prefix='.respkg.', dir=upper_dirs or '.' )
     try:
-      return self.source.extractfile( './INIT' ).read().decode()
+      sha256 = hashlib.sha256()
+      with os.fdopen( fd, 'wb' ) as target:
+        buff = source.read( EXTRACT_BUFFER_SIZE )
+        while buff:
+          sha256.update( buff )
+          target.write( buff )
+          buff = source.read( EXTRACT_BUFFER_SIZE )
+
+      sha256 = sha256.hexdigest()
+      if self.checksums is not None and self.checksums.get( name, sha256 ) != sha256:
+        raise ValueError( 'Checksum of "{0}" does not match the package, package is corrupt'.format( name ) )
+
+      os.replace( tmp_path, target_path )
+
+    except BaseException:
+      os.unlink( tmp_path )
+      raise
+
+    return sha256
+
+  @staticmethod
+  def entryOwner( entry ):  # ( uid, gid ) of the entry here, same as tarfile, by name if it exists here, else by id
+    try:
+      gid = grp.getgrnam( entry[ 'gname' ] ).gr_gid
     except KeyError:
-      return None
+      gid = entry[ 'gid' ]
 
-  def getFileList( self ):
-    results = []
-    for member in TarFile( fileobj=self.source.extractfile( './DATA' ) ).getmembers():
-      if member.isfile():
-        results.append( member.name )
+    try:
+      uid = pwd.getpwnam( entry[ 'uname' ] ).pw_uid
+    except KeyError:
+      uid = entry[ 'uid' ]
+
+    return ( uid, gid )
 
-    return results
+  @classmethod
+  def setAttributes( cls, entry, target_path ):  # same as tarfile, if root, set the owner from entryOwner, chown errors are ignored
+    if hasattr( os, 'geteuid' ) and os.geteuid() == 0:
+      ( uid, gid ) = cls.entryOwner( entry )
+      try:
+        if entry[ 'type' ] == 'symlink':
+          os.lchown( target_path, uid, gid )
+        else:
+          os.chown( target_path, uid, gid )
 
-  def extract( self, path, cb=None ):
-    tarfile = TarFile( fileobj=self.source.extractfile( './DATA' ) )
+      except OSError:
+        pass
+
+    if entry[ 'type' ] != 'symlink':
+      os.chmod( target_path, entry[ 'mode' ] )
+      os.utime( target_path, ( entry[ 'mtime' ], entry[ 'mtime' ] ) )
+
+  def _extractV1( self, path, cb, progress_cb, skip ):
+    tarfile = self._getDataTar()
+    checksum_map = dict( self.getChecksums() )  # for the hardlinks, with what is written for packages without checksums
     for member in tarfile.getmembers():
       if member.name in ( '/', '' ):  # extract can't handle making '/' when installing '/'
         continue
 
-      tarfile.extract( member, path )
-      if member.isfile() and cb:
-        cb( self.name, os.path.join( path, member.name ) )
+      if member.isfile() and member.name in skip:
+        continue
+
+      target_path = os.path.join( path, member.name )
+      if progress_cb:
+        progress_cb( self.name, target_path )
+
+      if member.isfile():
+        sha256 = self._writeFile( tarfile.extractfile( member ), member.name, target_path )
+        checksum_map[ member.name ] = sha256
+        tarfile.chown( member, target_path, False )
+        tarfile.chmod( member, target_path )
+        tarfile.utime( member, target_path )
+        if cb:
+          cb( self.name, target_path, sha256 )
+
+      else:
+        upper_dirs = os.path.dirname( target_path )
+        if upper_dirs:  # tarfile's check then makedirs races with other packages extracting into the same directories
+          os.makedirs( upper_dirs, exist_ok=True )
+
+        if not member.isdir() and os.path.lexists( target_path ) and ( os.path.islink( target_path ) or not os.path.isdir( target_path ) ):
+          os.unlink( target_path )  # tarfile would write through what is there, which may be linked to files that are not ours
+
+        if member.islnk():  # tarfile falls back to copying the data when the link fails, do it ourselves so that can't happen
+          os.link( os.path.join( path, member.linkname ), target_path )
+          tarfile.chown( member, target_path, False )
+          tarfile.chmod( member, target_path )
+          tarfile.utime( member, target_path )
+          if cb and member.linkname in checksum_map:
+            cb( self.name, target_path, checksum_map[ member.linkname ] )
+
+        elif member.issym():
+          os.symlink( member.linkname, target_path )
+          tarfile.chown( member, target_path, False )
+          if cb:
+            cb( self.name, target_path, hashLink( member.linkname ) )
+
+        else:
+          tarfile.extract( member, path )
+
+  def _extractV2( self, path, cb, progress_cb, skip ):
+    dir_list = []
+    checksum_map = self.getChecksums()
+    for entry in self.index:
+      if entry[ 'type' ] == 'file' and entry[ 'name' ] in skip:
+        continue
+
+      target_path = os.path.join( path, entry[ 'name' ] )
+      if progress_cb:
+        progress_cb( self.name, target_path )
+
+      upper_dirs = os.path.dirname( target_path )
+      if upper_dirs:
+        os.makedirs( upper_dirs, exist_ok=True )
+
+      if entry[ 'type' ] == 'file':
+        sha256 = self._writeFile( self._readEntry( entry ), entry[ 'name' ], target_path )
+        self.setAttributes( entry, target_path )
+        if cb:
+          cb( self.name, target_path, sha256 )
+
+        continue
+
+      if entry[ 'type' ] == 'dir':
+        try:
+          os.mkdir( target_path )
+        except FileExistsError:
+          if not os.path.isdir( target_path ):
+            raise
+
+        dir_list.append( ( entry, target_path ) )  # set after, adding the contents will change the mtime
+        continue
+
+      if os.path.lexists( target_path ):
+        os.unlink( target_path )
+
+      if entry[ 'type' ] == 'symlink':
+        os.symlink( entry[ 'linkname' ], target_path )
+      elif entry[ 'type' ] == 'link':
+        os.link( os.path.join( path, entry[ 'linkname' ] ), target_path )
+      elif entry[ 'type' ] == 'fifo':
+        os.mkfifo( target_path )
+      else:
+        raise ValueError( 'Unknown type "{0}" for "{1}"'.format( entry[ 'type' ], entry[ 'name' ] ) )
+
+      self.setAttributes( entry, target_path )
+      if cb and entry[ 'type' ] == 'symlink':
+        cb( self.name, target_path, hashLink( entry[ 'linkname' ] ) )
+      elif cb and entry[ 'type' ] == 'link' and entry[ 'linkname' ] in checksum_map:
+        cb( self.name, target_path, checksum_map[ entry[ 'linkname' ] ] )
+
+    for ( entry, target_path ) in reversed( dir_list ):
+      self.setAttributes( entry, target_path )
+
+  # cb( package, file_path, sha256 ) is called for each regular file, hardlink (with the sha256 of the file) and symlink (see
+  # hashLink), progress_cb( package, file_path ) for every member
+  # files are checked against the checksums in the package as they are written, ValueError is raised if one does not match
+  # skip is a collection of names of files to leave alone, they are not read or written
+  def extract( self, path, cb=None, progress_cb=None, skip=None ):
+    if skip is None:
+      skip = ()
+
+    if self.index is None:
+      self._extractV1( path, cb, progress_cb, skip )
+    else:
+      self._extractV2( path, cb, progress_cb, skip )
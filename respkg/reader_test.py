@@ -0,0 +1,291 @@
+import os
+import shutil
+import hashlib
+import tarfile
+from datetime import datetime
+from respkg import RespkgBuilder, RespkgReader
+from respkg import compression
+from respkg.verifier import hashLink
+
+TEST_WORK_DIR = '/tmp/respkg_reader_test'
+
+
+def _init_workspace():
+  shutil.rmtree( TEST_WORK_DIR, ignore_errors=True )
+  os.makedirs( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'thing' ) )
+  os.makedirs( os.path.join( TEST_WORK_DIR, 'target' ) )
+  open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'thing', 'config' ), 'w' ).write( 'the config\n' )
+  open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'other' ), 'wb' ).write( b'\x00\x01' * 50000 )
+  os.symlink( 'thing/config', os.path.join( TEST_WORK_DIR, 'data', 'etc', 'config_link' ) )
+  os.link( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'other' ), os.path.join( TEST_WORK_DIR, 'data', 'etc', 'thing', 'other_hard' ) )
+
+
+def _build( init=None, codec=None, format_version=None, jobs=None, reproducible=False ):
+  builder = RespkgBuilder()
+  builder.jobs = jobs
+  builder.reproducible = reproducible
+  builder.created = datetime( 2020, 1, 1 )
+  if codec is not None:
+    builder.compression = codec
+  if format_version is not None:
+    builder.format_version = format_version
+  builder.data = os.path.join( TEST_WORK_DIR, 'data' )
+  builder.name = 'thepackage'
+  builder.version = '1.0-1'
+  builder.description = 'the test package'
+  builder.depends = 'dep1'
+  if init is not None:
+    builder.setInit( init )
+
+  file_name = os.path.join( TEST_WORK_DIR, 'thepackage.respkg' )
+  builder.write( file_name )
+  return file_name
+
+
+def test_readcontrol():
+  _init_workspace()
+  reader = RespkgReader( _build() )
+  assert reader.name == 'thepackage'
+  assert reader.version == '1.0-1'
+  assert reader.description == 'the test package'
+  assert reader.depends == [ 'dep1' ]
+  assert reader.conflicts == []
+  assert reader.readInit() is None
+
+  reader = RespkgReader( _build( '#!/bin/sh\necho hi\n' ) )
+  assert reader.readInit() == '#!/bin/sh\necho hi\n'
+
+
+def test_extract():
+  for format_version in ( 1, 2 ):
+    _init_workspace()
+    reader = RespkgReader( _build( format_version=format_version ) )
+    assert reader.format_version == str( format_version )
+    assert sorted( reader.getFileList() ) == [ 'etc/other', 'etc/thing/config' ]
+
+    file_list = []
+    target = os.path.join( TEST_WORK_DIR, 'target' )
+    reader.extract( target, lambda package, file_path, sha256: file_list.append( ( package, file_path, sha256 ) ) )
+    assert sorted( file_list ) == [ ( 'thepackage', os.path.join( target, 'etc/config_link' ), hashLink( 'thing/config' ) ),
+                                    ( 'thepackage', os.path.join( target, 'etc/other' ), hashlib.sha256( b'\x00\x01' * 50000 ).hexdigest() ),
+                                    ( 'thepackage', os.path.join( target, 'etc/thing/config' ), hashlib.sha256( b'the config\n' ).hexdigest() ),
+                                    ( 'thepackage', os.path.join( target, 'etc/thing/other_hard' ), hashlib.sha256( b'\x00\x01' * 50000 ).hexdigest() ) ]
+    assert open( os.path.join( target, 'etc', 'thing', 'config' ), 'r' ).read() == 'the config\n'
+    assert open( os.path.join( target, 'etc', 'other' ), 'rb' ).read() == b'\x00\x01' * 50000
+    assert os.readlink( os.path.join( target, 'etc', 'config_link' ) ) == 'thing/config'
+    assert os.stat( os.path.join( target, 'etc', 'thing', 'other_hard' ) ).st_ino == os.stat( os.path.join( target, 'etc', 'other' ) ).st_ino
+    assert os.stat( os.path.join( target, 'etc', 'other' ) ).st_mtime == os.stat( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'other' ) ).st_mtime
+
+    assert sorted( reader.getFileList() ) == [ 'etc/other', 'etc/thing/config' ]  # still works after extracting
+    assert reader.readFile( 'etc/thing/config' ).read() == b'the config\n'
+    reader.close()
+
+    os.unlink( os.path.join( target, 'etc', 'other' ) )
+    os.unlink( os.path.join( target, 'etc', 'thing', 'other_hard' ) )
+    open( os.path.join( target, 'etc', 'thing', 'config' ), 'w' ).write( 'mine\n' )
+    reader = RespkgReader( _build( format_version=format_version ) )
+    file_list = []
+    reader.extract( target, lambda package, file_path, sha256: file_list.append( file_path ), skip=set( [ 'etc/thing/config' ] ) )
+    assert sorted( file_list ) == [ os.path.join( target, i ) for i in ( 'etc/config_link', 'etc/other', 'etc/thing/other_hard' ) ]
+    assert open( os.path.join( target, 'etc', 'thing', 'config' ), 'r' ).read() == 'mine\n'
+    assert os.path.exists( os.path.join( target, 'etc', 'thing', 'other_hard' ) )
+    reader.close()
+
+
+def test_index():
+  _init_workspace()
+  reader = RespkgReader( _build( format_version=2 ) )
+  index = dict( [ ( entry[ 'name' ], entry ) for entry in reader.getIndex() ] )
+  assert sorted( index ) == [ 'etc', 'etc/config_link', 'etc/other', 'etc/thing', 'etc/thing/config', 'etc/thing/other_hard' ]
+  assert [ index[ i ][ 'type' ] for i in sorted( index ) ] == [ 'dir', 'symlink', 'file', 'dir', 'file', 'link' ]
+  assert index[ 'etc/other' ][ 'size' ] == 100000
+  assert index[ 'etc/other' ][ 'sha256' ] == hashlib.sha256( b'\x00\x01' * 50000 ).hexdigest()
+  assert index[ 'etc/thing/other_hard' ][ 'linkname' ] == 'etc/other'
+  assert reader.readFile( 'etc/other' ).read() == b'\x00\x01' * 50000
+
+  try:
+    reader.readFile( 'etc/nothing' )
+    assert False
+  except KeyError:
+    pass
+
+  reader.close()
+
+  reader = RespkgReader( _build( format_version=1 ) )  # version 1 index comes from the DATA tar
+  assert [ ( entry[ 'name' ], entry[ 'type' ] ) for entry in reader.getIndex() ] == [ ( i, index[ i ][ 'type' ] ) for i in sorted( index ) ]
+  reader.close()
+
+
+def test_compression():
+  for codec in compression.CODEC_LIST:
+    if codec == 'zstd' and compression.zstandard is None:
+      continue
+
+    for format_version in ( 1, 2 ):
+      _init_workspace()
+      file_name = _build( '#!/bin/sh\n', codec, format_version )
+      if format_version == 1:
+        assert compression.detectCodec( open( file_name, 'rb' ) ) == codec
+      else:  # version 2 compresses each file, not the package
+        assert compression.detectCodec( open( file_name, 'rb' ) ) == 'none'
+
+      reader = RespkgReader( file_name )
+      assert reader.name == 'thepackage'
+      assert reader.readInit() == '#!/bin/sh\n'
+      assert sorted( reader.getFileList() ) == [ 'etc/other', 'etc/thing/config' ]
+
+      target = os.path.join( TEST_WORK_DIR, 'target' )
+      reader.extract( target )
+      assert open( os.path.join( target, 'etc', 'other' ), 'rb' ).read() == b'\x00\x01' * 50000
+      reader.close()
+
+  builder = RespkgBuilder()
+  builder.data = os.path.join( TEST_WORK_DIR, 'data' )
+  builder.compression = 'lz4'
+  try:
+    builder.write( os.path.join( TEST_WORK_DIR, 'bad.respkg' ) )
+    assert False
+  except ValueError:
+    pass
+
+
+def test_checksums():
+  for format_version in ( 1, 2 ):
+    _init_workspace()
+    file_name = _build( codec='none', format_version=format_version )
+    reader = RespkgReader( file_name )
+    assert reader.getChecksums() == { 'etc/other': hashlib.sha256( b'\x00\x01' * 50000 ).hexdigest(),
+                                      'etc/thing/config': hashlib.sha256( b'the config\n' ).hexdigest() }
+    reader.close()
+
+    package = open( file_name, 'rb' ).read()  # flip a byte of the config in DATA, it is not compressed so it's easy to find
+    open( file_name, 'wb' ).write( package.replace( b'the config\n', b'the cOnfig\n' ) )
+    os.makedirs( os.path.join( TEST_WORK_DIR, 'target', 'etc', 'thing' ) )
+    open( os.path.join( TEST_WORK_DIR, 'target', 'etc', 'thing', 'config' ), 'w' ).write( 'old config\n' )
+    reader = RespkgReader( file_name )
+    try:
+      reader.extract( os.path.join( TEST_WORK_DIR, 'target' ) )
+      assert False
+    except ValueError:
+      pass
+
+    reader.close()
+    assert open( os.path.join( TEST_WORK_DIR, 'target', 'etc', 'thing', 'config' ), 'r' ).read() == 'old config\n'  # the bad copy is not left in place
+    assert os.listdir( os.path.join( TEST_WORK_DIR, 'target', 'etc', 'thing' ) ) == [ 'config' ]
+
+
+def test_parallelbuild():
+  _init_workspace()
+  for i in range( 0, 100 ):
+    open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'file{0:03}'.format( i ) ), 'wb' ).write( os.urandom( i * 500 ) )
+
+  for ( codec, format_version ) in ( ( 'gzip', 1 ), ( 'xz', 1 ), ( 'gzip', 2 ) ):
+    package_list = []
+    for jobs in ( 1, 4 ):
+      package_list.append( open( _build( codec=codec, format_version=format_version, jobs=jobs ), 'rb' ).read() )
+
+    assert package_list[ 0 ] == package_list[ 1 ]
+
+    reader = RespkgReader( os.path.join( TEST_WORK_DIR, 'thepackage.respkg' ) )
+    assert len( reader.getFileList() ) == 102
+    reader.extract( os.path.join( TEST_WORK_DIR, 'target' ) )
+    assert open( os.path.join( TEST_WORK_DIR, 'target', 'etc', 'file099' ), 'rb' ).read() == open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'file099' ), 'rb' ).read()
+    reader.close()
+
+
+def test_reproducible():
+  for format_version in ( 1, 2 ):
+    _init_workspace()
+    os.environ[ 'SOURCE_DATE_EPOCH' ] = '1600000000'
+    try:
+      package = open( _build( format_version=format_version, reproducible=True ), 'rb' ).read()
+      os.utime( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'other' ), ( 1234, 1234 ) )
+      os.utime( os.path.join( TEST_WORK_DIR, 'data', 'etc' ), None )
+      assert open( _build( format_version=format_version, reproducible=True ), 'rb' ).read() == package
+
+      reader = RespkgReader( os.path.join( TEST_WORK_DIR, 'thepackage.respkg' ) )
+      assert reader.created == '2020-09-13T12:26:40'
+      index = dict( [ ( entry[ 'name' ], entry ) for entry in reader.getIndex() ] )
+      assert index[ 'etc/other' ][ 'mtime' ] == 1600000000
+      assert index[ 'etc/other' ][ 'uname' ] == 'root'
+      reader.close()
+
+    finally:
+      del os.environ[ 'SOURCE_DATE_EPOCH' ]
+
+
+def test_delta():
+  for format_version in ( 1, 2 ):
+    _init_workspace()
+    base = _build( format_version=format_version )
+    os.rename( base, os.path.join( TEST_WORK_DIR, 'base.respkg' ) )
+    base = os.path.join( TEST_WORK_DIR, 'base.respkg' )
+
+    open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'thing', 'config' ), 'w' ).write( 'the new config\n' )
+    open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'new' ), 'w' ).write( 'new\n' )
+    os.unlink( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'thing', 'other_hard' ) )
+    os.unlink( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'other' ) )
+    os.symlink( 'new', os.path.join( TEST_WORK_DIR, 'data', 'etc', 'other' ) )
+
+    builder = RespkgBuilder()
+    builder.format_version = format_version
+    builder.data = os.path.join( TEST_WORK_DIR, 'data' )
+    builder.name = 'thepackage'
+    builder.version = '1.0-2'
+    builder.delta_base = base
+    builder.write( os.path.join( TEST_WORK_DIR, 'delta.respkg' ) )
+
+    reader = RespkgReader( os.path.join( TEST_WORK_DIR, 'delta.respkg' ) )
+    assert reader.delta_from == '1.0-1'
+    assert reader.removed == [ 'etc/other' ]
+    assert sorted( reader.getFileList() ) == [ 'etc/new', 'etc/thing/config' ]
+    reader.close()
+
+    builder.delta_base = None
+    builder.write( os.path.join( TEST_WORK_DIR, 'full.respkg' ) )
+    open( os.path.join( TEST_WORK_DIR, 'data', 'etc', 'new' ), 'w' ).write( 'not new\n' )  # unchanged files are left out
+    builder.delta_base = os.path.join( TEST_WORK_DIR, 'full.respkg' )
+    builder.version = '1.0-3'
+    builder.write( os.path.join( TEST_WORK_DIR, 'delta2.respkg' ) )
+    reader = RespkgReader( os.path.join( TEST_WORK_DIR, 'delta2.respkg' ) )
+    assert reader.getFileList() == [ 'etc/new' ]
+    assert reader.removed == []
+    reader.close()
+
+    assert RespkgReader( base ).delta_from is None
+
+    builder.delta_base = os.path.join( TEST_WORK_DIR, 'delta.respkg' )  # only has what changed, so what was removed can't be worked out
+    try:
+      builder.write( os.path.join( TEST_WORK_DIR, 'delta3.respkg' ) )
+      assert False
+    except ValueError:
+      pass
+
+    builder.delta_base = os.path.join( TEST_WORK_DIR, 'full.respkg' )
+
+    builder.name = 'otherpackage'
+    try:
+      builder.write( os.path.join( TEST_WORK_DIR, 'delta3.respkg' ) )
+      assert False
+    except ValueError:
+      pass
+
+
+def test_data_first():
+  _init_workspace()
+  file_name = _build( codec='gzip', format_version=1 )
+  source = tarfile.open( file_name, 'r:gz' )  # rebuild it with DATA before CONTROL
+  member_list = sorted( source.getmembers(), key=lambda member: member.name != './DATA' )
+  assert member_list[ 0 ].name == './DATA'
+  target = tarfile.open( os.path.join( TEST_WORK_DIR, 'data_first.respkg' ), 'w:gz' )
+  for member in member_list:
+    target.addfile( member, source.extractfile( member ) )
+  target.close()
+  source.close()
+
+  reader = RespkgReader( os.path.join( TEST_WORK_DIR, 'data_first.respkg' ) )
+  assert reader.name == 'thepackage'
+  assert reader.getChecksums()[ 'etc/thing/config' ] == hashlib.sha256( b'the config\n' ).hexdigest()
+  reader.extract( os.path.join( TEST_WORK_DIR, 'target' ) )
+  assert open( os.path.join( TEST_WORK_DIR, 'target', 'etc', 'thing', 'config' ), 'r' ).read() == 'the config\n'
+  reader.close()
@@ -0,0 +1,93 @@
+class ResolveError( Exception ):
+  pass
+
+
+class RespkgResolver( object ):
+  # works out the order to install a batch of packages in, from what is allready installed (from RespkgManager.getState) and
+  # the control info of the packages in the batch.  Packages are added with add(), missing() is what the batch still needs that
+  # is not installed or in the batch, add those and repeat until there is nothing more to add, then plan() for the install order.
+  def __init__( self, state ):
+    self.state = state
+    self.package_map = {}
+
+  def add( self, name, version, depends, conflicts, provides ):
+    self.package_map[ name ] = { 'version': version, 'depends': list( depends ), 'conflicts': list( conflicts ), 'provides': list( provides ) }
+
+  def _installedTargets( self ):  # names and provides of the installed packages that are not being replaced by the batch
+    result = set()
+    for ( name, provides_list ) in self.state[ 'provides' ].items():
+      if name not in self.package_map:
+        result.update( provides_list )
+
+    result.update( [ name for name in self.state[ 'installed' ] if name not in self.package_map ] )
+    return result
+
+  def _batchProviders( self ):  # { target: set( names of packages in the batch that are or provide target ) }
+    result = {}
+    for ( name, package ) in self.package_map.items():
+      result.setdefault( name, set() ).add( name )
+      for target in package[ 'provides' ]:
+        result.setdefault( target, set() ).add( name )
+
+    return result
+
+  def missing( self ):  # sorted list of depends that are not installed, provided or in the batch
+    installed = self._installedTargets()
+    providers = self._batchProviders()
+    result = set()
+    for package in self.package_map.values():
+      for depend in package[ 'depends' ]:
+        if depend not in installed and depend not in providers:
+          result.add( depend )
+
+    return sorted( result )
+
+  # returns a list of steps, each a sorted list of package names, each step only depends on what is installed and the steps before it
+  # so the packages in a step can be installed in any order, or at the same time.  Raises ResolveError if the batch can't be installed
+  def plan( self ):
+    error_list = []
+    for depend in self.missing():
+      needed_by = sorted( [ name for ( name, package ) in self.package_map.items() if depend in package[ 'depends' ] ] )
+      error_list.append( 'Package(s) "{0}" depend on "{1}" which is not installed, provided or available'.format( '", "'.join( needed_by ), depend ) )
+
+    installed_names = set( self.state[ 'installed' ] ) - set( self.package_map )
+    for ( name, package ) in sorted( self.package_map.items() ):
+      for conflict in package[ 'conflicts' ]:
+        if conflict in installed_names:
+          error_list.append( 'Package "{0}" conflicts with installed package "{1}"'.format( name, conflict ) )
+        elif conflict in self.package_map and conflict != name:
+          error_list.append( 'Package "{0}" conflicts with package "{1}", which is also being installed'.format( name, conflict ) )
+
+    for ( installed, with_list ) in sorted( self.state[ 'conflicts' ].items() ):
+      if installed in self.package_map:  # it's being replaced, it's new conflicts are checked above
+        continue
+
+      for name in sorted( set( with_list ) & set( self.package_map ) ):
+        error_list.append( 'Package "{0}" is conflicted by installed package "{1}"'.format( name, installed ) )
+
+    if error_list:
+      raise ResolveError( '\n'.join( error_list ) )
+
+    installed = self._installedTargets()
+    providers = self._batchProviders()
+    after_map = dict( [ ( name, set() ) for name in self.package_map ] )  # name -> names in the batch that have to be installed first
+    for ( name, package ) in self.package_map.items():
+      for depend in package[ 'depends' ]:
+        if depend in self.package_map:
+          after_map[ name ].add( depend )
+        elif depend not in installed:
+          after_map[ name ].update( providers[ depend ] )
+
+      after_map[ name ].discard( name )
+
+    result = []
+    done = set()
+    while len( done ) < len( after_map ):
+      step = sorted( [ name for ( name, after ) in after_map.items() if name not in done and after <= done ] )
+      if not step:
+        raise ResolveError( 'Circular dependancy between packages "{0}"'.format( '", "'.join( sorted( set( after_map ) - done ) ) ) )
+
+      result.append( step )
+      done.update( step )
+
+    return result
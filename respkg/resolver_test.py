@@ -0,0 +1,72 @@
+from respkg.resolver import RespkgResolver, ResolveError
+
+
+def _state( installed=None, provides=None, conflicts=None ):
+  return { 'installed': installed or {}, 'provides': provides or {}, 'conflicts': conflicts or {} }
+
+
+def _plan_error( resolver ):
+  try:
+    resolver.plan()
+  except ResolveError as e:
+    return str( e )
+
+  assert False
+
+
+def test_order():
+  resolver = RespkgResolver( _state() )
+  assert resolver.plan() == []
+
+  resolver.add( 'app', '1.0', [ 'lib', 'config' ], [], [] )
+  assert resolver.missing() == [ 'config', 'lib' ]
+
+  resolver.add( 'lib', '1.0', [ 'base' ], [], [] )
+  resolver.add( 'config', '1.0', [], [], [] )
+  assert resolver.missing() == [ 'base' ]
+  assert 'depend on "base"' in _plan_error( resolver )
+
+  resolver.add( 'base', '1.0', [], [], [] )
+  assert resolver.missing() == []
+  assert resolver.plan() == [ [ 'base', 'config' ], [ 'lib' ], [ 'app' ] ]
+
+
+def test_installed():
+  resolver = RespkgResolver( _state( { 'base': '1.0', 'other': '1.0' }, { 'other': [ 'virtual' ] } ) )
+  resolver.add( 'app', '1.0', [ 'base', 'virtual' ], [], [] )
+  resolver.add( 'lib', '2.0', [ 'base' ], [], [] )
+  assert resolver.missing() == []
+  assert resolver.plan() == [ [ 'app', 'lib' ] ]
+
+  resolver.add( 'other', '2.0', [], [], [] )  # the upgrade of other does not provide virtual anymore
+  assert resolver.missing() == [ 'virtual' ]
+
+  resolver.add( 'provider', '1.0', [], [], [ 'virtual' ] )
+  assert resolver.missing() == []
+  assert resolver.plan() == [ [ 'lib', 'other', 'provider' ], [ 'app' ] ]
+
+
+def test_conflicts():
+  resolver = RespkgResolver( _state( { 'old': '1.0', 'strict': '1.0' }, conflicts={ 'strict': [ 'app' ], 'old': [ 'lib' ] } ) )
+  resolver.add( 'app', '1.0', [], [ 'old', 'lib2' ], [] )
+  resolver.add( 'lib', '1.0', [], [], [] )
+  resolver.add( 'lib2', '1.0', [], [], [] )
+  error = _plan_error( resolver )
+  assert 'Package "app" conflicts with installed package "old"' in error
+  assert 'Package "app" conflicts with package "lib2", which is also being installed' in error
+  assert 'Package "app" is conflicted by installed package "strict"' in error
+  assert 'Package "lib" is conflicted by installed package "old"' in error
+
+  resolver = RespkgResolver( _state( { 'old': '1.0' }, conflicts={ 'old': [ 'lib' ] } ) )
+  resolver.add( 'lib', '1.0', [], [], [] )
+  resolver.add( 'old', '2.0', [], [], [] )  # the new version of old does not conflict with lib
+  assert resolver.plan() == [ [ 'lib', 'old' ] ]
+
+
+def test_circular():
+  resolver = RespkgResolver( _state() )
+  resolver.add( 'a', '1.0', [ 'b' ], [], [] )
+  resolver.add( 'b', '1.0', [ 'c' ], [], [] )
+  resolver.add( 'c', '1.0', [ 'a' ], [], [] )
+  resolver.add( 'd', '1.0', [], [], [] )
+  assert _plan_error( resolver ) == 'Circular dependancy between packages "a", "b", "c"'
@@ -0,0 +1,175 @@
+import base64
+import threading
+from http import client
+from urllib.parse import urlsplit, urljoin, unquote
+
+MAX_REDIRECTS = 5
+CONNECTION_TIMEOUT = 60  # seconds
+PROXY_PORT = 80  # when the proxy url does not have one
+
+
+def _parseProxy( proxy ):  # returns ( host, port, Proxy-Authorization header value or None ) of the proxy url, the scheme is optional
+  parts = urlsplit( proxy if '://' in proxy else 'http://{0}'.format( proxy ) )
+  auth = None
+  if parts.username is not None:
+    credentials = '{0}:{1}'.format( unquote( parts.username ), unquote( parts.password or '' ) )
+    auth = 'Basic {0}'.format( base64.b64encode( credentials.encode() ).decode() )
+
+  return ( parts.hostname, parts.port or PROXY_PORT, auth )
+
+
+class HTTPError( Exception ):
+  def __init__( self, url, reason ):
+    super().__init__( 'Error requesting "{0}": {1}'.format( url, reason ) )
+    self.url = url
+    self.reason = reason
+
+
+class HTTPResponse( object ):
+  def __init__( self, http_client, key, url, connection, response ):
+    self._client = http_client
+    self.url = url
+    self._key = key
+    self._connection = connection
+    self._response = response
+    self.status = response.status
+    self.headers = response.msg
+
+  def read( self, size=None ):
+    try:
+      if size is None:
+        buff = self._response.read()
+      else:
+        buff = self._response.read( size )
+
+    except ( OSError, client.HTTPException ) as e:
+      self._response.close()
+      self._connection.close()
+      self._connection = None
+      raise HTTPError( self.url, str( e ) )
+
+    if not buff or self._response.isclosed():
+      self.close()
+
+    return buff
+
+  def close( self ):  # if everything was read the connection goes back to the pool to be used again
+    if self._connection is None:
+      return
+
+    if not self._response.isclosed() and self._response.length == 0:  # ie: 304, nothing to read, but still need to finish the response
+      self._response.read()
+
+    if self._response.isclosed():
+      self._client._release( self._key, self._connection )
+    else:
+      self._response.close()
+      self._connection.close()
+
+    self._connection = None
+
+
+class HTTPClient( object ):
+  # keeps idle connections per server/proxy, so a connection can be re-used by the next request to the same place
+  # safe to share between threads, each request has it's own connection while it is in progress
+  def __init__( self, user_agent ):
+    self.user_agent = user_agent
+    self._idle_map = {}
+    self._lock = threading.Lock()
+
+  def _connect( self, key ):
+    ( scheme, netloc, proxy ) = key
+    if proxy:
+      ( host, port, auth ) = _parseProxy( proxy )
+      if scheme == 'https':  # CONNECT through the proxy
+        connection = client.HTTPSConnection( host, port, timeout=CONNECTION_TIMEOUT )
+        connection.set_tunnel( netloc, headers={ 'Proxy-Authorization': auth } if auth else None )
+        return connection
+
+      return client.HTTPConnection( host, port, timeout=CONNECTION_TIMEOUT )
+
+    if scheme == 'https':
+      return client.HTTPSConnection( netloc, timeout=CONNECTION_TIMEOUT )
+
+    return client.HTTPConnection( netloc, timeout=CONNECTION_TIMEOUT )
+
+  def _acquire( self, key ):
+    with self._lock:
+      try:
+        return ( self._idle_map[ key ].pop(), True )
+      except ( KeyError, IndexError ):
+        pass
+
+    return ( self._connect( key ), False )
+
+  def _release( self, key, connection ):
+    with self._lock:
+      self._idle_map.setdefault( key, [] ).append( connection )
+
+  def close( self ):
+    with self._lock:
+      for connection_list in self._idle_map.values():
+        for connection in connection_list:
+          connection.close()
+
+      self._idle_map = {}
+
+  def _request( self, url, proxy, headers ):
+    parts = urlsplit( url )
+    if parts.scheme not in ( 'http', 'https' ):
+      raise HTTPError( url, 'unsupported scheme "{0}"'.format( parts.scheme ) )
+
+    key = ( parts.scheme, parts.netloc, proxy )
+    if proxy and parts.scheme == 'http':
+      target = url
+    else:
+      target = parts.path or '/'
+      if parts.query:
+        target += '?' + parts.query
+
+    headers = dict( headers or {} )
+    headers[ 'User-Agent' ] = self.user_agent
+    if proxy and parts.scheme == 'http':  # for https it is sent with the CONNECT, see _connect
+      auth = _parseProxy( proxy )[2]
+      if auth:
+        headers[ 'Proxy-Authorization' ] = auth
+
+    ( connection, reused ) = self._acquire( key )
+    try:
+      connection.request( 'GET', target, headers=headers )
+      response = connection.getresponse()
+
+    except ( client.RemoteDisconnected, ConnectionResetError, BrokenPipeError ) as e:
+      connection.close()
+      if not reused:
+        raise HTTPError( url, str( e ) )
+
+      # the server timed out the idle connection, try again on a fresh one
+      connection = self._connect( key )
+      try:
+        connection.request( 'GET', target, headers=headers )
+        response = connection.getresponse()
+      except ( OSError, client.HTTPException ) as e:
+        connection.close()
+        raise HTTPError( url, str( e ) )
+
+    except ( OSError, client.HTTPException ) as e:
+      connection.close()
+      raise HTTPError( url, str( e ) )
+
+    return HTTPResponse( self, key, url, connection, response )
+
+  def open( self, url, proxy=None, headers=None ):  # follows redirects, raises HTTPError for connection problems, the caller must check the status
+    for _ in range( 0, MAX_REDIRECTS + 1 ):
+      response = self._request( url, proxy, headers )
+      if response.status not in ( 301, 302, 303, 307, 308 ):
+        return response
+
+      location = response.headers.get( 'Location' )
+      response.read()
+      if not location:
+        return response
+
+      url = urljoin( url, location )
+
+    raise HTTPError( url, 'too many redirects' )
@@ -0,0 +1,75 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_BUFFER_SIZE = 1024 * 1024
+BATCH_SIZE = 1024  # files handed to the pool at a time, so we are not holding a future for every file
+
+
+def hashFile( file_path ):
+  sha256 = hashlib.sha256()
+  with open( file_path, 'rb' ) as fp:
+    buff = fp.read( HASH_BUFFER_SIZE )
+    while buff:
+      sha256.update( buff )
+      buff = fp.read( HASH_BUFFER_SIZE )
+
+  return sha256.hexdigest()
+
+
+def hashLink( linkname ):  # what is recorded for a symlink, the sha256 of where it points
+  return hashlib.sha256( os.fsencode( linkname ) ).hexdigest()
+
+
+class RespkgVerifier( object ):
+  # hashlib releases the GIL while hashing, so threads are enough to keep the disks and cpus busy
+  def __init__( self, jobs=None ):
+    self.jobs = jobs or os.cpu_count() or 1
+
+  @staticmethod
+  def _checkFile( file_path, sha256, signature ):
+    try:
+      if signature is not None:
+        stat = os.lstat( file_path )
+        if signature == ( stat.st_size, stat.st_mtime_ns, stat.st_ino ):
+          return 'good'
+
+      if os.path.islink( file_path ):
+        actual = hashLink( os.readlink( file_path ) )
+      else:
+        actual = hashFile( file_path )
+
+      if actual == sha256:
+        return 'good'
+      else:
+        return 'bad'
+
+    except FileNotFoundError:
+      return 'missing'
+
+    except OSError:  # ie: replaced by a directory, or not readable
+      return 'error'
+
+  # signature_map is { file_path: ( sha256, size, mtime, inode ) } as returned by RespkgManager.getFileSignatures
+  # files who's size, mtime and inode still match what was recorded are not re-hashed unless full is True
+  # cb( file_path, status ) is called for each file in file_path order
+  # returns { 'good': [], 'bad': [], 'missing': [], 'error': [] } of the file_paths, error is for files that could not be read
+  def verify( self, signature_map, cb=None, full=False ):
+    def _check( file_path ):
+      ( sha256, size, mtime, inode ) = signature_map[ file_path ]
+      if full or None in ( size, mtime, inode ):
+        return self._checkFile( file_path, sha256, None )
+
+      return self._checkFile( file_path, sha256, ( size, mtime, inode ) )
+
+    result = { 'good': [], 'bad': [], 'missing': [], 'error': [] }
+    file_list = sorted( signature_map )
+    with ThreadPoolExecutor( max_workers=self.jobs ) as executor:
+      for start in range( 0, len( file_list ), BATCH_SIZE ):
+        batch = file_list[ start:start + BATCH_SIZE ]
+        for ( file_path, status ) in zip( batch, executor.map( _check, batch ) ):
+          result[ status ].append( file_path )
+          if cb:
+            cb( file_path, status )
+
+    return result
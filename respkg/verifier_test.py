@@ -0,0 +1,31 @@
+import os
+import shutil
+import hashlib
+from respkg.verifier import RespkgVerifier
+
+TEST_WORK_DIR = '/tmp/respkg_verifier_test'
+
+
+def _init_workspace():
+  shutil.rmtree( TEST_WORK_DIR, ignore_errors=True )
+  os.makedirs( TEST_WORK_DIR )
+
+
+def test_verify():
+  _init_workspace()
+  signature_map = {}
+  for name in ( 'good', 'bad', 'missing', 'dir' ):
+    file_path = os.path.join( TEST_WORK_DIR, name )
+    open( file_path, 'w' ).write( name )
+    signature_map[ file_path ] = ( hashlib.sha256( name.encode() ).hexdigest(), None, None, None )
+
+  open( os.path.join( TEST_WORK_DIR, 'bad' ), 'w' ).write( 'changed' )
+  os.unlink( os.path.join( TEST_WORK_DIR, 'missing' ) )
+  os.unlink( os.path.join( TEST_WORK_DIR, 'dir' ) )
+  os.mkdir( os.path.join( TEST_WORK_DIR, 'dir' ) )  # replaced by a directory
+
+  status_map = {}
+  result = RespkgVerifier( 2 ).verify( signature_map, lambda file_path, status: status_map.__setitem__( os.path.basename( file_path ), status ) )
+  assert result == { 'good': [ os.path.join( TEST_WORK_DIR, 'good' ) ], 'bad': [ os.path.join( TEST_WORK_DIR, 'bad' ) ],
+                     'missing': [ os.path.join( TEST_WORK_DIR, 'missing' ) ], 'error': [ os.path.join( TEST_WORK_DIR, 'dir' ) ] }
+  assert status_map == { 'good': 'good', 'bad': 'bad', 'missing': 'missing', 'dir': 'error' }